@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+"""admission.py
+
+Admission queue for conferences that open registration to a burst of
+users.  When a conference has admissionQueue set, registering only
+writes an AdmissionTicket in the user's own entity group, which never
+contends with anyone else, and returns.  A worker on the single-flight
+'admission' push queue drains the pending tickets in arrival order and
+admits a whole batch in one transaction, so the seat counter sees one
+writer instead of a storm of competing, retrying transactions.
+
+A burst of requests shares one named kick task per second.  The kick
+starts the conference's drain chain unless one is running, in which
+case it only asks that chain to look again before it stops.  The chain
+state lives in an AdmissionDrain entity: every step is enqueued
+transactionally as the step number advances, and a task whose step is
+not the current one does nothing, so there is one chain per conference.
+
+"""
+
+import time
+from datetime import datetime
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import AdmissionDrain
+from models import AdmissionTicket
+from models import AdmissionTicketForm
+from models import Registration
+import announcements
+import cache
+import seats
+
+ADMISSION_QUEUE = 'admission'
+DRAIN_URL = '/tasks/drain_admissions'
+# tickets admitted per transaction; each is one entity group (the
+# attendee's Profile), leaving room for MAX_BATCH_SHARDS seat shards
+# within the 25 entity group limit of a cross-group transaction
+ADMISSION_BATCH_SIZE = 20
+MAX_BATCH_SHARDS = 5
+# a burst of requests within this many seconds shares one kick task
+DRAIN_COALESCE_WINDOW = 1
+# passes in a row that decide nothing, because the pending query still
+# returns decided tickets, before the chain stops
+MAX_IDLE_PASSES = 3
+
+PENDING = 'PENDING'
+ADMITTED = 'ADMITTED'
+REJECTED = 'REJECTED'
+CANCELLED = 'CANCELLED'
+
+
+def ticketKey(p_key, wsck):
+    """Return the key of a user's ticket for a conference."""
+    return ndb.Key(AdmissionTicket, wsck, parent=p_key)
+
+
+def _scheduleDrain(wsck):
+    """Enqueue a kick of the conference's drain chain, once per window."""
+    window = int(time.time() // DRAIN_COALESCE_WINDOW)
+    try:
+        taskqueue.add(queue_name=ADMISSION_QUEUE, url=DRAIN_URL,
+                      name='admit-%s-%d' % (wsck, window),
+                      params={'websafeConferenceKey': wsck})
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        # a kick for this window is already queued
+        pass
+
+
+def _drainKey(wsck):
+    return ndb.Key(AdmissionDrain, wsck)
+
+
+def _enqueueStep(wsck, step, countdown=0):
+    """Enqueue a step of the drain chain; call inside the transaction that
+    stored the step."""
+    taskqueue.add(queue_name=ADMISSION_QUEUE, url=DRAIN_URL, transactional=True,
+                  countdown=countdown,
+                  params={'websafeConferenceKey': wsck, 'step': step})
+
+
+@ndb.transactional()
+def kick(wsck):
+    """Start the conference's drain chain, or have the running one look
+    again before it stops."""
+    drainer = _drainKey(wsck).get() or AdmissionDrain(key=_drainKey(wsck))
+    if drainer.active:
+        if not drainer.rerun:
+            drainer.rerun = True
+            drainer.put()
+        return
+    drainer.active, drainer.rerun, drainer.idle = True, False, 0
+    drainer.step += 1
+    drainer.put()
+    _enqueueStep(wsck, drainer.step)
+
+
+@ndb.transactional()
+def _advanceTxn(wsck, step, found, decided):
+    """Move the chain on to its next step, or stop it once the queue looks
+    empty and no kick asked it to look again."""
+    drainer = _drainKey(wsck).get()
+    if not drainer or not drainer.active or drainer.step != step:
+        return
+    drainer.idle = 0 if decided else drainer.idle + 1
+    if not found or drainer.idle >= MAX_IDLE_PASSES:
+        if not drainer.rerun:
+            drainer.active = False
+            drainer.put()
+            return
+        drainer.rerun, drainer.idle = False, 0
+    drainer.step += 1
+    drainer.put()
+    # the pending query is eventually consistent; if it only returned
+    # tickets that were already decided, give the index a moment
+    _enqueueStep(wsck, drainer.step, countdown=0 if decided else 1)
+
+
+@ndb.transactional()
+def _enqueueTxn(t_key, c_key):
+    ticket = t_key.get()
+    if ticket and ticket.status in (PENDING, ADMITTED):
+        return ticket
+    ticket = AdmissionTicket(key=t_key, conference=c_key)
+    ticket.put()
+    return ticket
+
+
+def enqueue(p_key, wsck):
+    """Queue a registration request and return its ticket.
+
+    A user has at most one live ticket per conference, so repeated
+    requests return the ticket they already have.
+    """
+    if ndb.Key(Registration, wsck, parent=p_key).get():
+        return AdmissionTicket(key=ticketKey(p_key, wsck), status=ADMITTED,
+                               conference=ndb.Key(urlsafe=wsck))
+    ticket = _enqueueTxn(ticketKey(p_key, wsck), ndb.Key(urlsafe=wsck))
+    if ticket.status == PENDING:
+        _scheduleDrain(wsck)
+    return ticket
+
+
+@ndb.transactional()
+def cancel(p_key, wsck):
+    """Withdraw a pending ticket; returns True if there was one."""
+    ticket = ticketKey(p_key, wsck).get()
+    if not ticket or ticket.status != PENDING:
+        return False
+    ticket.status = CANCELLED
+    ticket.decided = datetime.now()
+    ticket.put()
+    return True
+
+
+def getTicket(p_key, wsck):
+    """Return a user's ticket for a conference, or None."""
+    return ticketKey(p_key, wsck).get()
+
+
+def _pendingQuery(c_key):
+    return AdmissionTicket.query(AdmissionTicket.conference == c_key,
+                                 AdmissionTicket.status == PENDING
+                                 ).order(AdmissionTicket.created)
+
+
+def _batchShards(conf, wanted):
+    """Pick the open shards with the most seats, enough for wanted seats."""
+    shard_keys = seats.openShards(conf)
+    shards = sorted([shard for shard in ndb.get_multi(shard_keys) if shard],
+                    key=lambda shard: -shard.seatsAvailable)[:MAX_BATCH_SHARDS]
+    picked, total = [], 0
+    for shard in shards:
+        if total >= wanted:
+            break
+        picked.append(shard.key)
+        total += shard.seatsAvailable
+    return picked
+
+
+@ndb.transactional(xg=True)
+def _admitBatchTxn(c_key, t_keys, shard_keys):
+    """Admit tickets in order while the given shards have seats.
+
+    With no shards the conference is sold out and the tickets are
+    rejected.  Returns the profile keys of the admitted users and the
+    number of tickets decided.
+    """
+    wsck = c_key.urlsafe()
+    r_keys = [ndb.Key(Registration, wsck, parent=t_key.parent()) for t_key in t_keys]
+    entities = ndb.get_multi(t_keys + r_keys + shard_keys)
+    tickets = entities[:len(t_keys)]
+    registrations = entities[len(t_keys):2 * len(t_keys)]
+    shards = [shard for shard in entities[2 * len(t_keys):] if shard]
+
+    now = datetime.now()
+    admitted, to_put = [], []
+    for ticket, registration, r_key in zip(tickets, registrations, r_keys):
+        if not ticket or ticket.status != PENDING:
+            continue
+        if registration:
+            ticket.status, ticket.reason = REJECTED, 'Already registered'
+        elif not shard_keys:
+            ticket.status, ticket.reason = REJECTED, 'There are no seats available.'
+        else:
+            shard = next((shard for shard in shards if shard.seatsAvailable > 0), None)
+            if shard is None:
+                # these shards ran dry; the rest wait for the next batch
+                break
+            shard.seatsAvailable -= 1
+            to_put.append(Registration(key=r_key, conference=c_key))
+            ticket.status = ADMITTED
+            admitted.append(r_key.parent())
+        ticket.decided = now
+        to_put.append(ticket)
+    ndb.put_multi(to_put + shards)
+    return admitted, sum(1 for ticket in to_put if isinstance(ticket, AdmissionTicket))
+
+
+def drain(wsck, step):
+    """Decide one batch of a conference's pending tickets, in order, and
+    move the chain on; a stale step does nothing."""
+    drainer = _drainKey(wsck).get()
+    if not drainer or not drainer.active or drainer.step != step:
+        return
+    conf = ndb.Key(urlsafe=wsck).get()
+    if not conf:
+        _advanceTxn(wsck, step, False, 0)
+        return
+    t_keys = _pendingQuery(conf.key).fetch(ADMISSION_BATCH_SIZE, keys_only=True)
+    decided = 0
+    if t_keys:
+        admitted, decided = _admitBatchTxn(conf.key, t_keys,
+                                           _batchShards(conf, len(t_keys)))
+        if admitted:
+            announcements.track(conf, seats.updateCache(conf.key, -len(admitted)))
+            cache.invalidateConference(wsck)
+            for p_key in admitted:
+                cache.invalidateAttending(p_key.id())
+    _advanceTxn(wsck, step, bool(t_keys), decided)
+
+
+def ticketToForm(ticket):
+    """Copy an AdmissionTicket to an AdmissionTicketForm."""
+    return AdmissionTicketForm(websafeConferenceKey=ticket.key.id(),
+                               status=ticket.status, reason=ticket.reason,
+                               created=str(ticket.created) if ticket.created else None)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+"""announcements.py
+
+Nearly sold out announcement.  The conferences with at most
+NEARLY_SOLD_OUT_SEATS seats left are kept in one NearlySoldOut entity
+that creation, import and registration update when a conference starts
+out in it or crosses a threshold, so the announcement is rendered from a
+single entity instead of a scan of every conference.  The hourly cron
+re-checks the members of the set and the conferences created with few
+seats, which is where a missed update would show.
+
+"""
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import NearlySoldOut
+import seats
+
+MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
+ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
+                    'are nearly sold out: %s')
+NEARLY_SOLD_OUT_SEATS = 5
+REBUILD_BATCH_SIZE = 100
+
+
+def _setKey():
+    return ndb.Key(NearlySoldOut, 'nearly_sold_out')
+
+
+def isNearlySoldOut(seats_left):
+    """Return True if a conference with seats_left belongs in the set."""
+    return seats_left is not None and 0 < seats_left <= NEARLY_SOLD_OUT_SEATS
+
+
+def render(conferences):
+    """Return the announcement for a {websafe key: name} dict."""
+    if not conferences:
+        return ""
+    return ANNOUNCEMENT_TPL % ', '.join(sorted(conferences.values()))
+
+
+def getAnnouncement():
+    """Return the current announcement, from memcache or the set entity."""
+    announcement = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
+    if announcement is None:
+        nso = _setKey().get()
+        announcement = render(nso.conferences if nso else {})
+        memcache.add(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+    return announcement
+
+
+@ndb.transactional()
+def _updateTxn(wsck, name):
+    """Add (name given) or remove (name None) one conference from the set.
+
+    Returns the new set, or None if it did not change.
+    """
+    nso = _setKey().get() or NearlySoldOut(key=_setKey(), conferences={})
+    conferences = dict(nso.conferences or {})
+    if name is None:
+        if wsck not in conferences:
+            return None
+        del conferences[wsck]
+    else:
+        if conferences.get(wsck) == name:
+            return None
+        conferences[wsck] = name
+    nso.conferences = conferences
+    nso.put()
+    return conferences
+
+
+def track(conf, seats_left):
+    """Keep conf's membership in the set in line with its seat count.
+
+    Only counts near the thresholds can change membership, so every
+    other call returns without touching the datastore.
+    """
+    if seats_left is not None and seats_left > NEARLY_SOLD_OUT_SEATS + 1:
+        return
+    if seats_left is None:
+        seats_left = seats.getSeats(conf)
+    name = conf.name if isNearlySoldOut(seats_left) else None
+    conferences = _updateTxn(conf.key.urlsafe(), name)
+    if conferences is not None:
+        memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, render(conferences))
+
+
+def _candidateKeys(members):
+    """Yield the keys of the conferences rebuild() checks: the members,
+    then those whose stored seatsAvailable puts them in the set."""
+    for wsck in members:
+        yield ndb.Key(urlsafe=wsck)
+    query = Conference.query(Conference.seatsAvailable > 0,
+                             Conference.seatsAvailable <= NEARLY_SOLD_OUT_SEATS)
+    for c_key in query.iter(keys_only=True):
+        if c_key.urlsafe() not in members:
+            yield c_key
+
+
+def _recheck(c_keys, members):
+    """Bring the set in line with the seat counters of some conferences."""
+    totals = seats.getSeatsMulti(c_keys)
+    for c_key, conf in zip(c_keys, ndb.get_multi(c_keys)):
+        name = None
+        if conf:
+            seats_left = totals[c_key]
+            if seats_left is None:
+                seats_left = conf.seatsAvailable
+            if isNearlySoldOut(seats_left):
+                name = conf.name
+        if name != members.get(c_key.urlsafe()):
+            _updateTxn(c_key.urlsafe(), name)
+
+
+def rebuild():
+    """Check the set against the seat counters and repair any drift.
+
+    The current members are re-checked, and so are the conferences whose
+    stored seatsAvailable is within the threshold, so one that started
+    out nearly sold out but was never tracked is added.  Each change goes
+    through the same transaction as track() so a concurrent registration
+    is never overwritten.  Used by the announcement cron; returns the
+    announcement.
+    """
+    nso = _setKey().get()
+    members = dict(nso.conferences or {}) if nso else {}
+    batch = []
+    for c_key in _candidateKeys(members):
+        batch.append(c_key)
+        if len(batch) >= REBUILD_BATCH_SIZE:
+            _recheck(batch, members)
+            batch = []
+    if batch:
+        _recheck(batch, members)
+
+    nso = _setKey().get()
+    announcement = render(nso.conferences if nso else {})
+    memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+    return announcement
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+"""bench_admission.py
+
+Benchmark of a registration burst on one conference: every user running
+the inline registration transaction against the seat shards at once,
+versus every user queueing an admission ticket and the single drain
+worker admitting them in batches.
+
+    PYTHONPATH=$APPENGINE_SDK python benchmarks/bench_admission.py [users] [seats]
+
+Both paths run against the testbed stubs with one thread per user.
+Reported per path: registrations per second, registrations that failed
+(TransactionFailedError after ndb's retries) and datastore RPCs.  users
+defaults to 200 and seats to 150, so the burst also oversubscribes the
+conference.
+
+"""
+
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from harness import RpcCounter, activateStubs
+
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+
+import admission
+import seats
+from conference import ConferenceApi
+from models import Conference, Registration
+
+
+def makeConference(seats_available, admission_queue):
+    conf = Conference(parent=ndb.Key('Profile', 'organizer@example.com'),
+                      name='Flash Sale', organizerUserId='organizer@example.com',
+                      maxAttendees=seats_available, seatsAvailable=seats_available,
+                      admissionQueue=admission_queue)
+    conf.put()
+    seats.initSeats(conf.key, seats_available)
+    return conf
+
+
+def burst(users, register):
+    """Run register(profile key) on one thread per user, all at once.
+
+    Returns the number of calls that raised TransactionFailedError.
+    """
+    failures = []
+    start = threading.Event()
+
+    def run(i):
+        start.wait()
+        try:
+            register(ndb.Key('Profile', 'user%d@example.com' % i))
+        except datastore_errors.TransactionFailedError:
+            failures.append(i)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(users)]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+    return len(failures)
+
+
+def inlineRegistration(users, seats_available):
+    conf = makeConference(seats_available, False)
+    wsck = conf.key.urlsafe()
+    api = ConferenceApi()
+
+    def register(p_key):
+        for shard_key in seats.openShards(conf):
+            try:
+                api._registrationTxn(p_key, wsck, shard_key)
+                return
+            except seats.ShardEmptyError:
+                continue
+
+    return conf, burst(users, register)
+
+
+def queuedRegistration(users, seats_available):
+    conf = makeConference(seats_available, True)
+    wsck = conf.key.urlsafe()
+    failures = burst(users, lambda p_key: admission.enqueue(p_key, wsck))
+    # what the kick and drain task chain do, run in line
+    while admission._pendingQuery(conf.key).get(keys_only=True):
+        admission.kick(wsck)
+        drainer = admission._drainKey(wsck).get()
+        while drainer.active:
+            admission.drain(wsck, drainer.step)
+            drainer = admission._drainKey(wsck).get()
+    return conf, failures
+
+
+def run(name, path, users, seats_available, counter):
+    counter.reset()
+    started = time.time()
+    conf, failures = path(users, seats_available)
+    elapsed = time.time() - started
+    registered = Registration.query(Registration.conference == conf.key).count()
+    print('%-8s %5d registered in %7.1f ms   %7.1f reg/s   %4d failed   %6d datastore RPCs' % (
+        name, registered, elapsed * 1e3, registered / elapsed if elapsed else 0,
+        failures, counter.datastoreRpcs()))
+
+
+if __name__ == '__main__':
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    seats_available = int(sys.argv[2]) if len(sys.argv) > 2 else 150
+    tb = activateStubs()
+    counter = RpcCounter()
+    try:
+        print('%d users, %d seats, %d seat shards, batches of %d' % (
+            users, seats_available, seats.NUM_SHARDS, admission.ADMISSION_BATCH_SIZE))
+        run('inline', inlineRegistration, users, seats_available, counter)
+        run('queued', queuedRegistration, users, seats_available, counter)
+    finally:
+        tb.deactivate()
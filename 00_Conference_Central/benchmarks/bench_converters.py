@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+"""bench_converters.py
+
+Micro-benchmark of entity-to-form copying: the reflective all_fields()
+loop the API used to run per entity versus the precompiled converters.
+
+    PYTHONPATH=$APPENGINE_SDK python benchmarks/bench_converters.py [count]
+
+Entities are built in memory; no datastore is touched.
+
+"""
+
+import os
+import sys
+import timeit
+from datetime import date, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('APPLICATION_ID', 'dev~bench')
+
+import dev_appserver
+dev_appserver.fix_sys_path()
+
+from google.appengine.ext import ndb
+
+import converters
+from models import Conference, ConferenceForm, Session, SessionForm
+
+
+def reflectiveCopy(entity, form_cls):
+    """The per-entity copy loop the converters replaced."""
+    form = form_cls()
+    for field in form.all_fields():
+        if hasattr(entity, field.name):
+            if field.name.endswith('Date') or field.name in ('date', 'startTime'):
+                setattr(form, field.name, str(getattr(entity, field.name)))
+            else:
+                setattr(form, field.name, getattr(entity, field.name))
+        elif field.name == "websafeKey":
+            setattr(form, field.name, entity.key.urlsafe())
+    form.check_initialized()
+    return form
+
+
+def makeConferences(count):
+    p_key = ndb.Key('Profile', 'bench@example.com')
+    return [Conference(key=ndb.Key(Conference, i + 1, parent=p_key),
+                       name='Conference %d' % i, description='Description %d' % i,
+                       organizerUserId='bench@example.com', topics=['Web', 'Python'],
+                       city='London', startDate=date(2016, 5, 1), month=5,
+                       endDate=date(2016, 5, 3), maxAttendees=100, seatsAvailable=50)
+            for i in range(count)]
+
+
+def makeSessions(count):
+    c_key = ndb.Key('Profile', 'bench@example.com', Conference, 1)
+    return [Session(key=ndb.Key(Session, i + 1, parent=c_key),
+                    name='Session %d' % i, highlights='Highlights', speaker='Speaker',
+                    duration='1', typeOfSession='Theory', date=date(2016, 5, 1),
+                    startTime=time(10, 30), speakerEmail='speaker@example.com')
+            for i in range(count)]
+
+
+def bench(label, entities, form_cls, converter, repeat=5):
+    before = min(timeit.repeat(
+        lambda: [reflectiveCopy(e, form_cls) for e in entities], number=1, repeat=repeat))
+    after = min(timeit.repeat(
+        lambda: converter.convertMulti(entities), number=1, repeat=repeat))
+    count = len(entities)
+    print('%-12s reflective %7.1f us/item   converter %7.1f us/item   %.1fx' % (
+        label, before / count * 1e6, after / count * 1e6, before / after))
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    bench('Conference', makeConferences(count), ConferenceForm, converters.CONFERENCE_FORM)
+    bench('Session', makeSessions(count), SessionForm, converters.SESSION_FORM)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""bench_search.py
+
+Benchmark of conference search over a synthetic corpus: the client-side
+workaround (pull every conference and filter its text) versus decoding
+the posting shards of the query terms and ranking them with textsearch.
+
+    PYTHONPATH=$APPENGINE_SDK python benchmarks/bench_search.py [count]
+
+The index is built in memory exactly as textsearch lays it out in the
+datastore, including the compressed JSON encoding of every shard; no
+datastore is touched.  count defaults to 100000 conferences.
+
+"""
+
+import json
+import os
+import random
+import sys
+import timeit
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('APPLICATION_ID', 'dev~bench')
+
+import dev_appserver
+dev_appserver.fix_sys_path()
+
+from google.appengine.ext import ndb
+
+import textsearch
+from models import Conference
+
+TOPICS = ['Web', 'Python', 'Cloud', 'Mobile', 'Security', 'Data', 'Design',
+          'Devops', 'Machine Learning', 'Games']
+WORDS = ['summit', 'meetup', 'workshop', 'annual', 'global', 'developer',
+         'community', 'engineering', 'startup', 'scale', 'open', 'source',
+         'frontend', 'backend', 'distributed', 'systems', 'research', 'applied',
+         'hands', 'talks', 'keynote', 'panel', 'networking', 'training']
+QUERIES = ['python', 'cloud security', 'machine learning workshop',
+           'distributed systems research', 'zzznomatch']
+
+
+def makeConferences(count, seed=42):
+    rnd = random.Random(seed)
+    p_key = ndb.Key('Profile', 'bench@example.com')
+    confs = []
+    for i in range(count):
+        topics = rnd.sample(TOPICS, 2)
+        name = '%s %s %d' % (topics[0], rnd.choice(WORDS).title(), i)
+        description = ' '.join(rnd.choice(WORDS) for _ in range(12))
+        confs.append(Conference(key=ndb.Key(Conference, i + 1, parent=p_key),
+                                name=name, description=description, topics=topics,
+                                organizerUserId='bench@example.com'))
+    return confs
+
+
+def buildIndex(confs):
+    """Return {posting key id: compressed JSON postings}, as stored."""
+    shards = {}
+    for conf in confs:
+        doc_id = conf.key.urlsafe()
+        shard = textsearch.postingShard(doc_id)
+        for term, weight in textsearch.documentTerms(conf).items():
+            shards.setdefault(textsearch.postingKey('Conference', term, shard).id(),
+                              {})[doc_id] = weight
+    return dict((key, zlib.compress(json.dumps(postings)))
+                for key, postings in shards.items())
+
+
+def clientSideSearch(confs, query):
+    """The workaround: scan every conference for all the query terms."""
+    terms = textsearch.tokenize(query)
+    matches = []
+    for conf in confs:
+        text = ' '.join([conf.name or '', conf.description or ''] + conf.topics).lower()
+        if all(term in text for term in terms):
+            matches.append(conf.key.urlsafe())
+    return matches
+
+
+def indexSearch(index, doc_count, query):
+    """Decode the posting shards of the query terms and rank them."""
+    posting_lists = {}
+    for term in set(textsearch.tokenize(query)):
+        postings = {}
+        for shard in range(textsearch.NUM_POSTING_SHARDS):
+            blob = index.get(textsearch.postingKey('Conference', term, shard).id())
+            if blob:
+                postings.update(json.loads(zlib.decompress(blob)))
+        posting_lists[term] = postings
+    return textsearch.rank(posting_lists, doc_count)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    confs = makeConferences(count)
+    index = buildIndex(confs)
+    print('%d conferences, %d posting shards, largest shard %.1f KB compressed' % (
+        count, len(index), max(len(blob) for blob in index.values()) / 1024.0))
+    for query in QUERIES:
+        scan = min(timeit.repeat(lambda: clientSideSearch(confs, query),
+                                 number=1, repeat=3))
+        ranked = min(timeit.repeat(lambda: indexSearch(index, count, query),
+                                   number=1, repeat=3))
+        results = len(indexSearch(index, count, query))
+        print('%-32r scan %8.1f ms   index %8.1f ms   %5d results   %.1fx' % (
+            query, scan * 1e3, ranked * 1e3, results, scan / ranked if ranked else 0))
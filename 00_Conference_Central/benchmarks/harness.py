@@ -0,0 +1,487 @@
+#!/usr/bin/env python
+
+"""harness.py
+
+Endpoint benchmark harness.  Boots ConferenceApi against the testbed
+datastore, memcache and taskqueue stubs (no network), seeds a synthetic
+data set at each scale and drives every endpoint, reporting per endpoint:
+latency percentiles, datastore RPCs, critical-path RPC depth, entities
+read and written, and the memcache hit ratio.
+
+    PYTHONPATH=$APPENGINE_SDK python benchmarks/harness.py \\
+        [--scales 1000,10000,100000] [--iterations 50] [--output results.json] \\
+        [--baseline results.json] [--tolerance 0.25]
+
+A scale is the number of conferences; sessions and profiles are seeded in
+proportion.  Results are written as JSON.  With --baseline, endpoints
+whose p50 latency, datastore RPC count or RPC depth grew by more than
+the tolerance are listed and the exit status is 1.
+
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import date, time as dtime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('APPLICATION_ID', 'dev~bench')
+
+import dev_appserver
+dev_appserver.fix_sys_path()
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+from protorpc import message_types
+from protorpc import remote
+
+import conference
+import speakers
+import textsearch
+from conference import ConferenceApi
+from models import AdmissionTicket
+from models import Conference, ConferenceForm, ConferenceQueryForm, ConferenceQueryForms
+from models import ListView, Profile, ProfileMiniForm, Registration, Session
+from models import SessionForm, SessionQueryForm, SessionQueryForms
+from models import WishlistEntry
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFERENCES_PER_ORGANIZER = 10
+SESSIONS_PER_CONFERENCE = 2
+REGISTRATIONS_PER_PROFILE = 5
+WISHLIST_PER_PROFILE = 5
+# every this many conferences, one uses the admission queue
+ADMISSION_EVERY = 10
+SEED_BATCH_SIZE = 500
+CITIES = ['London', 'Paris', 'Chicago', 'Tokyo', 'Berlin', 'Singapore']
+TOPICS = ['Web', 'Python', 'Cloud', 'Mobile', 'Security', 'Data']
+TYPES = ['Workshop', 'Lecture', 'Keynote']
+WORDS = ['summit', 'meetup', 'annual', 'global', 'developer', 'community',
+         'engineering', 'scale', 'distributed', 'systems', 'applied', 'talks']
+
+
+# - - - Stubs & instrumentation - - - - - - - - - - - - - - - -
+
+def activateStubs():
+    """Activate the testbed stubs the API touches; returns the testbed."""
+    tb = testbed.Testbed()
+    tb.activate()
+    tb.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+    tb.init_memcache_stub()
+    tb.init_taskqueue_stub(root_path=APP_DIR)
+    tb.init_app_identity_stub()
+    tb.init_mail_stub()
+    tb.init_urlfetch_stub()
+    tb.init_user_stub()
+    return tb
+
+
+class RpcCounter(object):
+    """Counts API calls and datastore entities through a post-call hook.
+
+    The pre-call hook measures the critical-path RPC depth: the number of
+    times an RPC is issued while no other RPC is in flight, so RPCs that
+    overlap count once.
+    """
+
+    def __init__(self):
+        self.reset()
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'bench_rpc_depth', self._preHook)
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'bench_rpc_counter', self._hook)
+
+    def reset(self):
+        self.calls = {}
+        self.read = 0
+        self.written = 0
+        self.inflight = 0
+        self.depth = 0
+
+    def _preHook(self, service, call, request, response):
+        if not self.inflight:
+            self.depth += 1
+        self.inflight += 1
+
+    def _hook(self, service, call, request, response):
+        self.inflight = max(self.inflight - 1, 0)
+        name = '%s.%s' % (service, call)
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if service != 'datastore_v3':
+            return
+        if call == 'Get':
+            self.read += len(request.key_list())
+        elif call in ('RunQuery', 'Next'):
+            self.read += response.result_size()
+        elif call == 'Put':
+            self.written += len(request.entity_list())
+        elif call == 'Delete':
+            self.written += len(request.key_list())
+
+    def datastoreRpcs(self):
+        return sum(count for name, count in self.calls.items()
+                   if name.startswith('datastore_v3.'))
+
+
+def actAs(email):
+    """Make endpoints.get_current_user() return email for the next calls."""
+    os.environ['ENDPOINTS_AUTH_EMAIL'] = email
+    os.environ['ENDPOINTS_AUTH_DOMAIN'] = 'gmail.com'
+
+
+# - - - Seeding - - - - - - - - - - - - - - - - - - - - - - - -
+
+def _putAll(entities):
+    for i in range(0, len(entities), SEED_BATCH_SIZE):
+        ndb.put_multi(entities[i:i + SEED_BATCH_SIZE])
+
+
+def seed(scale, rnd):
+    """Seed `scale` conferences plus their profiles, sessions, registrations
+    and wishlists; returns the keys the scenarios pick from."""
+    organizers = ['organizer%d@example.com' % i
+                  for i in range(max(scale // CONFERENCES_PER_ORGANIZER, 1))]
+    attendees = ['attendee%d@example.com' % i for i in range(max(scale // 10, 10))]
+    _putAll([Profile(key=ndb.Key(Profile, email), displayName=email.split('@')[0],
+                     mainEmail=email, teeShirtSize='NOT_SPECIFIED')
+             for email in organizers + attendees])
+
+    conferences = []
+    for i in range(scale):
+        organizer = organizers[i % len(organizers)]
+        p_key = ndb.Key(Profile, organizer)
+        start = date(2016, rnd.randint(1, 12), rnd.randint(1, 28))
+        conferences.append(Conference(
+            key=ndb.Key(Conference, 'seed-%d' % i, parent=p_key),
+            name='%s %s %d' % (rnd.choice(TOPICS), rnd.choice(WORDS).title(), i),
+            description=' '.join(rnd.choice(WORDS) for _ in range(10)),
+            organizerUserId=organizer, organizerDisplayName=organizer.split('@')[0],
+            topics=rnd.sample(TOPICS, 2),
+            city=rnd.choice(CITIES), startDate=start, month=start.month,
+            endDate=start, maxAttendees=100, seatsAvailable=100,
+            admissionQueue=i % ADMISSION_EVERY == 0))
+    _putAll(conferences)
+    c_keys = [conf.key for conf in conferences]
+    admission_keys = [conf.key for conf in conferences if conf.admissionQueue]
+
+    sessions = []
+    for c_key in c_keys:
+        for j in range(SESSIONS_PER_CONFERENCE):
+            speaker = rnd.randint(0, max(scale // 5, 1))
+            sessions.append(Session(
+                key=ndb.Key(Session, 'seed-%d' % j, parent=c_key),
+                name='%s %s' % (rnd.choice(WORDS).title(), rnd.choice(WORDS)),
+                highlights=' '.join(rnd.choice(WORDS) for _ in range(6)),
+                speaker='Speaker %d' % speaker,
+                speakerEmail='speaker%d@example.com' % speaker,
+                duration=str(rnd.choice([30, 60, 90])),
+                typeOfSession=rnd.choice(TYPES), date=date(2016, 5, 1),
+                startTime=dtime(rnd.randint(8, 21), 0)))
+    _putAll(sessions)
+    s_keys = [ses.key for ses in sessions]
+
+    links = []
+    for email in attendees:
+        p_key = ndb.Key(Profile, email)
+        for c_key in rnd.sample(c_keys, min(REGISTRATIONS_PER_PROFILE, len(c_keys))):
+            links.append(Registration(key=ndb.Key(Registration, c_key.urlsafe(),
+                                                  parent=p_key), conference=c_key))
+        for s_key in rnd.sample(s_keys, min(WISHLIST_PER_PROFILE, len(s_keys))):
+            links.append(WishlistEntry(key=ndb.Key(WishlistEntry, s_key.urlsafe(),
+                                                   parent=p_key), session=s_key))
+    # every attendee has a pending ticket for one admission queue conference
+    tickets = []
+    for email in attendees:
+        c_key = rnd.choice(admission_keys)
+        links.append(AdmissionTicket(key=ndb.Key(AdmissionTicket, c_key.urlsafe(),
+                                                 parent=ndb.Key(Profile, email)),
+                                     conference=c_key))
+        tickets.append((email, c_key.urlsafe()))
+    _putAll(links)
+
+    # build the speaker and search indexes with the backfills the app uses
+    cursor = speakers.backfill()
+    while cursor:
+        cursor = speakers.backfill(cursor)
+    for kind in textsearch.MODELS:
+        cursor = textsearch.backfill(kind)
+        while cursor:
+            cursor = textsearch.backfill(kind, cursor)
+
+    return {'organizers': organizers, 'attendees': attendees,
+            'conferences': c_keys, 'admissionConferences': admission_keys,
+            'tickets': tickets, 'sessions': sessions}
+
+
+# - - - Scenarios - - - - - - - - - - - - - - - - - - - - - - -
+
+def req(message, **fields):
+    """Build a request for an endpoint taking message (or a ResourceContainer)."""
+    cls = getattr(message, 'combined_message_class', message)
+    return cls(**fields)
+
+
+def _organizerConf(data, rnd):
+    c_key = rnd.choice(data['conferences'])
+    return c_key.parent().id(), c_key.urlsafe()
+
+
+def _attendee(data, rnd):
+    return rnd.choice(data['attendees'])
+
+
+def _newSession():
+    return SessionForm(name='Bench session', highlights='bench', speaker='Bench Speaker',
+                       speakerEmail='bench@example.com', duration='60',
+                       typeOfSession='Workshop', date='2016-05-01', startTime='10:00')
+
+
+def _updateConference(rnd, data):
+    user, wsck = _organizerConf(data, rnd)
+    return user, req(conference.CONF_POST_REQUEST, websafeConferenceKey=wsck,
+                     description='updated')
+
+
+def _getConferenceAttendees(rnd, data):
+    user, wsck = _organizerConf(data, rnd)
+    return user, req(conference.CONF_ATTENDEES_REQUEST, websafeConferenceKey=wsck)
+
+
+def _createSession(rnd, data):
+    user, wsck = _organizerConf(data, rnd)
+    form = _newSession()
+    return user, req(conference.SESS_POST_REQUEST, websafeConferenceKey=wsck,
+                     **dict((f.name, getattr(form, f.name)) for f in SessionForm.all_fields()))
+
+
+def _createSessionsBatch(rnd, data):
+    user, wsck = _organizerConf(data, rnd)
+    return user, req(conference.SESS_BATCH_POST_REQUEST, websafeConferenceKey=wsck,
+                     items=[_newSession() for _ in range(20)])
+
+
+def _getSessionsBySpeakerAndMail(rnd, data):
+    ses = rnd.choice(data['sessions'])
+    return _attendee(data, rnd), req(conference.SES_GET_SPEAKERMAIL_REQUEST,
+                                     speaker=ses.speaker, speakerEmail=ses.speakerEmail)
+
+
+def _getAdmissionTicket(rnd, data):
+    user, wsck = rnd.choice(data['tickets'])
+    return user, req(conference.CONF_GET_REQUEST, websafeConferenceKey=wsck)
+
+
+# endpoint method name -> rnd, data -> (user email, request)
+SCENARIOS = {
+    'getProfile': lambda rnd, d: (
+        _attendee(d, rnd), message_types.VoidMessage()),
+    'saveProfile': lambda rnd, d: (
+        _attendee(d, rnd), ProfileMiniForm(displayName='renamed%d' % rnd.randint(0, 9))),
+    'createConference': lambda rnd, d: (
+        rnd.choice(d['organizers']),
+        ConferenceForm(name='Bench conference', city='London', topics=['Web'],
+                       startDate='2016-06-01', endDate='2016-06-02', maxAttendees=50)),
+    'updateConference': _updateConference,
+    'getConference': lambda rnd, d: (
+        _attendee(d, rnd), req(conference.CONF_CONDITIONAL_GET_REQUEST,
+                               websafeConferenceKey=rnd.choice(d['conferences']).urlsafe())),
+    'getConferencesCreated': lambda rnd, d: (
+        rnd.choice(d['organizers']), req(conference.CONF_LIST_REQUEST)),
+    'queryConferences': lambda rnd, d: (
+        _attendee(d, rnd), ConferenceQueryForms(filters=[ConferenceQueryForm(
+            field='CITY', operator='EQ', value=rnd.choice(CITIES))])),
+    'queryConferencesSummary': lambda rnd, d: (
+        _attendee(d, rnd), ConferenceQueryForms(filters=[ConferenceQueryForm(
+            field='CITY', operator='EQ', value=rnd.choice(CITIES))], view=ListView.SUMMARY)),
+    'searchConferences': lambda rnd, d: (
+        _attendee(d, rnd), req(conference.CONF_SEARCH_REQUEST,
+                               q='%s %s' % (rnd.choice(TOPICS), rnd.choice(WORDS)))),
+    'getConferencesToAttend': lambda rnd, d: (
+        _attendee(d, rnd), req(conference.CONF_ATTENDING_REQUEST)),
+    'getConferenceAttendees': _getConferenceAttendees,
+    'registerForConference': lambda rnd, d: (
+        _attendee(d, rnd), req(conference.CONF_GET_REQUEST,
+                               websafeConferenceKey=rnd.choice(d['conferences']).urlsafe())),
+    'unregisterFromConference': lambda rnd, d: (
+        _attendee(d, rnd), req(conference.CONF_GET_REQUEST,
+                               websafeConferenceKey=rnd.choice(d['conferences']).urlsafe())),
+    'requestConferenceAdmission': lambda rnd, d: (
+        _attendee(d, rnd), req(conference.CONF_GET_REQUEST,
+                               websafeConferenceKey=rnd.choice(
+                                   d['admissionConferences']).urlsafe())),
+    'getAdmissionTicket': _getAdmissionTicket,
+    'getAnnouncement': lambda rnd, d: (
+        _attendee(d, rnd), req(conference.ANNOUNCEMENT_GET_REQUEST)),
+    'createSession': _createSession,
+    'createSessionsBatch': _createSessionsBatch,
+    'getConferenceSessions': lambda rnd, d: (
+        _attendee(d, rnd), req(conference.SES_GET_BY_CONF_REQUEST,
+                               websafeConferenceKey=rnd.choice(d['conferences']).urlsafe())),
+    'getConferenceSessionsByType': lambda rnd, d: (
+        _attendee(d, rnd), req(conference.SES_GET_BY_TYPE_REQUEST,
+                               websafeConferenceKey=rnd.choice(d['conferences']).urlsafe(),
+                               typeOfSession=rnd.choice(TYPES))),
+    'getConferenceSessionsByDuration': lambda rnd, d: (
+        _attendee(d, rnd), req(conference.SES_GET_BY_DURATION_REQUEST,
+                               websafeConferenceKey=rnd.choice(d['conferences']).urlsafe(),
+                               duration='60')),
+    'getSessionsBeforeSeven': lambda rnd, d: (
+        _attendee(d, rnd), req(conference.SES_GET_BEFORE_SEVEN_REQUEST,
+                               websafeConferenceKey=rnd.choice(d['conferences']).urlsafe())),
+    'getSessionsBySpeaker': lambda rnd, d: (
+        _attendee(d, rnd), req(conference.SES_GET_SPEAKER_REQUEST,
+                               speaker=rnd.choice(d['sessions']).speaker)),
+    'getSessionsBySpeakerAndMail': _getSessionsBySpeakerAndMail,
+    'querySessions': lambda rnd, d: (
+        _attendee(d, rnd), SessionQueryForms(filters=[SessionQueryForm(
+            field='TYPE', operator='EQ', value=rnd.choice(TYPES))])),
+    'searchSessions': lambda rnd, d: (
+        _attendee(d, rnd), req(conference.SES_SEARCH_REQUEST, q=rnd.choice(WORDS))),
+    'getFeaturedSpeaker': lambda rnd, d: (
+        _attendee(d, rnd), req(conference.SES_GET_FEATURED_REQUEST,
+                               websafeConferenceKey=rnd.choice(d['conferences']).urlsafe())),
+    'addSessionToWishlist': lambda rnd, d: (
+        _attendee(d, rnd), req(conference.SES_ADD_TO_WISHLIST,
+                               websafeSessionKey=rnd.choice(d['sessions']).key.urlsafe())),
+    'getSessionsInWishlist': lambda rnd, d: (
+        _attendee(d, rnd), req(conference.CONF_LIST_REQUEST)),
+    'getConfFromSessionsInWishlist': lambda rnd, d: (
+        _attendee(d, rnd), message_types.VoidMessage()),
+    'deleteSessionInWishlist': lambda rnd, d: (
+        _attendee(d, rnd), req(conference.SES_DELETE_FROM_WISHLIST,
+                               websafeSessionKey=rnd.choice(d['sessions']).key.urlsafe())),
+}
+# scenarios that call an endpoint under another name
+METHODS = {'queryConferencesSummary': 'queryConferences'}
+
+
+# - - - Measuring - - - - - - - - - - - - - - - - - - - - - - -
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def _memcacheCounts():
+    stats = memcache.get_stats() or {}
+    return stats.get('hits', 0), stats.get('misses', 0)
+
+
+def measure(name, data, counter, iterations, rnd):
+    """Call one endpoint `iterations` times and summarize the calls."""
+    method = getattr(ConferenceApi, METHODS.get(name, name))
+    latencies, rpcs, depths, reads, writes, errors = [], [], [], [], [], 0
+    hits_before, misses_before = _memcacheCounts()
+    for _ in range(iterations):
+        user, request = SCENARIOS[name](rnd, data)
+        actAs(user)
+        # every call is a new request: fresh service, empty ndb context cache
+        ndb.get_context().clear_cache()
+        counter.reset()
+        start = time.time()
+        try:
+            method(ConferenceApi(), request)
+        except remote.ApplicationError:
+            errors += 1
+        latencies.append((time.time() - start) * 1000.0)
+        rpcs.append(counter.datastoreRpcs())
+        depths.append(counter.depth)
+        reads.append(counter.read)
+        writes.append(counter.written)
+    hits_after, misses_after = _memcacheCounts()
+    hits, misses = hits_after - hits_before, misses_after - misses_before
+    return {
+        'calls': iterations,
+        'errors': errors,
+        'latency_ms': dict(('p%d' % p, round(percentile(latencies, p), 3))
+                           for p in (50, 90, 99)),
+        'datastore_rpcs': round(float(sum(rpcs)) / iterations, 2),
+        'rpc_depth': round(float(sum(depths)) / iterations, 2),
+        'entities_read': round(float(sum(reads)) / iterations, 2),
+        'entities_written': round(float(sum(writes)) / iterations, 2),
+        'memcache_hit_ratio': round(float(hits) / (hits + misses), 3)
+                              if hits + misses else None,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return a line for every endpoint that regressed against baseline."""
+    regressions = []
+    for scale, endpoints in results['results'].items():
+        for name, now in endpoints.items():
+            before = baseline.get('results', {}).get(scale, {}).get(name)
+            if not before:
+                continue
+            for label, old, new in (
+                    ('p50 latency', before['latency_ms']['p50'], now['latency_ms']['p50']),
+                    ('datastore RPCs', before['datastore_rpcs'], now['datastore_rpcs']),
+                    ('RPC depth', before.get('rpc_depth'), now['rpc_depth'])):
+                if old is None:
+                    continue
+                if new > old * (1 + tolerance) and new - old > 0.5:
+                    regressions.append('%s @ %s: %s %.2f -> %.2f' % (
+                        name, scale, label, old, new))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--scales', default='1000,10000',
+                        help='comma separated conference counts (e.g. 1000,10000,100000)')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--endpoints', help='comma separated subset of endpoints')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='write the JSON results here')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    names = args.endpoints.split(',') if args.endpoints else sorted(SCENARIOS)
+    results = {'meta': {'iterations': args.iterations, 'seed': args.seed,
+                        'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())},
+               'results': {}}
+    for scale in [int(s) for s in args.scales.split(',')]:
+        tb = activateStubs()
+        try:
+            rnd = random.Random(args.seed)
+            started = time.time()
+            data = seed(scale, rnd)
+            sys.stderr.write('seeded %d conferences in %.1fs\n' % (scale, time.time() - started))
+            counter = RpcCounter()
+            per_endpoint = results['results'][str(scale)] = {}
+            for name in names:
+                per_endpoint[name] = measure(name, data, counter, args.iterations, rnd)
+                sys.stderr.write('%-8d %-34s p50 %8.2f ms  %6.1f rpcs  depth %5.1f\n' % (
+                    scale, name, per_endpoint[name]['latency_ms']['p50'],
+                    per_endpoint[name]['datastore_rpcs'], per_endpoint[name]['rpc_depth']))
+        finally:
+            apiproxy_stub_map.apiproxy.GetPreCallHooks().Clear()
+            apiproxy_stub_map.apiproxy.GetPostCallHooks().Clear()
+            tb.deactivate()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            sys.stderr.write('REGRESSION %s\n' % line)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
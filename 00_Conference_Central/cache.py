@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+"""cache.py
+
+Read-through memcache caching of built ProtoRPC forms and Profiles, and
+the ETags of read endpoints.
+
+Every cached form is stored together with the generation numbers of the
+things it was built from.  Writers bump those generations after they
+commit, so an entry built from data read before the write carries old
+generations and is never served again, even if it reaches memcache after
+the invalidation did.
+
+The same generations make up the ETags of conferences and attendance
+lists, so a conditional request is answered from memcache alone.
+
+"""
+
+import hashlib
+import logging
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from protorpc import protobuf
+
+from models import ConferenceForm
+import instrument
+
+MEMCACHE_CONF_FORM_KEY = 'CONF_FORM:%s'
+MEMCACHE_CONF_GEN_KEY = 'CONF_GEN:%s'
+MEMCACHE_ORGANIZER_GEN_KEY = 'ORGANIZER_GEN:%s'
+MEMCACHE_PROFILE_KEY = 'PROFILE:%s'
+MEMCACHE_PROFILE_GEN_KEY = 'PROFILE_GEN:%s'
+MEMCACHE_PROFILE_STATS_KEY = 'PROFILE_CACHE_STATS:%s'
+MEMCACHE_SUMMARY_KEY = 'SUMMARY:%s'
+MEMCACHE_ATTENDING_GEN_KEY = 'ATTENDING_GEN:%s'
+MEMCACHE_ATTENDING_PAGE_KEY = 'ATTENDING_PAGE:%s:%s:%s'
+FORM_CACHE_TIME = 60 * 60
+PROFILE_CACHE_TIME = 60 * 60
+# where a profile lookup was answered from
+PROFILE_CACHE_TIERS = ('request', 'memcache', 'datastore')
+
+
+def _initialGeneration():
+    """Return a starting generation that is newer than any evicted one."""
+    return int(time.time() * 1000)
+
+
+def getGenerations(gen_keys):
+    """Return the current generation for each key, creating missing ones."""
+    gens = memcache.get_multi(gen_keys)
+    missing = [key for key in gen_keys if key not in gens]
+    if missing:
+        memcache.add_multi(dict((key, _initialGeneration()) for key in missing))
+        gens.update(memcache.get_multi(missing))
+    return tuple(gens.get(key) for key in gen_keys)
+
+
+def bumpGeneration(gen_key):
+    """Invalidate everything cached against gen_key."""
+    memcache.incr(gen_key, initial_value=_initialGeneration())
+
+
+def makeETag(*parts):
+    """Return an ETag for content versioned by the given parts."""
+    return '"%s"' % hashlib.md5(repr(parts)).hexdigest()
+
+
+def _generationETag(*gens):
+    """Return an ETag for content versioned by generations, or None when
+    memcache could not supply all of them (the content is unversioned
+    then, and an ETag would match stale data)."""
+    if None in gens:
+        return None
+    return makeETag(*gens)
+
+
+def _conferenceGenKeys(wsck):
+    """Return the generation keys a conference's form depends on."""
+    organizer_id = ndb.Key(urlsafe=wsck).parent().id()
+    return [MEMCACHE_CONF_GEN_KEY % wsck,
+            MEMCACHE_ORGANIZER_GEN_KEY % organizer_id]
+
+
+def conferenceETag(wsck):
+    """Return the ETag of the current ConferenceForm of wsck, or None."""
+    return _generationETag(*getGenerations(_conferenceGenKeys(wsck)))
+
+
+def getConferenceForm(wsck, build):
+    """Return the ConferenceForm for wsck with its ETag, calling build()
+    on a cache miss."""
+    form_key = MEMCACHE_CONF_FORM_KEY % wsck
+
+    # read the generations before the datastore, never after
+    gens = getGenerations(_conferenceGenKeys(wsck))
+    entry = memcache.get(form_key)
+    if entry and entry[0] == gens:
+        form = protobuf.decode_message(ConferenceForm, entry[1])
+    else:
+        form = build()
+        if None not in gens:
+            memcache.set(form_key, (gens, protobuf.encode_message(form)),
+                         time=FORM_CACHE_TIME)
+    form.etag = _generationETag(*gens)
+    return form
+
+
+def invalidateConference(wsck):
+    """Invalidate the cached form of one conference."""
+    bumpGeneration(MEMCACHE_CONF_GEN_KEY % wsck)
+
+
+def invalidateOrganizer(user_id):
+    """Invalidate the cached forms of every conference organized by user_id."""
+    bumpGeneration(MEMCACHE_ORGANIZER_GEN_KEY % user_id)
+
+
+def _summaryGenKeys(key):
+    """Return the generation keys a summary depends on; Sessions are
+    never updated, so theirs depend on nothing."""
+    if key.kind() == 'Conference':
+        return [MEMCACHE_CONF_GEN_KEY % key.urlsafe()]
+    return []
+
+
+def getSummaries(keys, message_cls, build):
+    """Return a summary form of message_cls for each key, or None for
+    entities that do not exist.
+
+    Summaries are cached per entity; build(keys) is called once with
+    every key that missed and returns their forms in the same order.
+    """
+    gen_keys = dict((key, _summaryGenKeys(key)) for key in keys)
+    all_gen_keys = sorted(set(k for ks in gen_keys.values() for k in ks))
+    all_gens = dict(zip(all_gen_keys, getGenerations(all_gen_keys)))
+    gens = dict((key, tuple(all_gens[k] for k in gen_keys[key])) for key in keys)
+
+    cache_keys = dict((key, MEMCACHE_SUMMARY_KEY % key.urlsafe()) for key in keys)
+    entries = memcache.get_multi(cache_keys.values())
+    summaries = {}
+    for key in keys:
+        entry = entries.get(cache_keys[key])
+        if entry and entry[0] == gens[key]:
+            summaries[key] = protobuf.decode_message(message_cls, entry[1])
+
+    missing = [key for key in keys if key not in summaries]
+    if missing:
+        to_cache = {}
+        for key, form in zip(missing, build(missing)):
+            summaries[key] = form
+            if form is not None and None not in gens[key]:
+                to_cache[cache_keys[key]] = (gens[key], protobuf.encode_message(form))
+        memcache.set_multi(to_cache, time=FORM_CACHE_TIME)
+    return [summaries[key] for key in keys]
+
+
+def attendingGeneration(user_id):
+    """Return the generation of the set of conferences user_id attends."""
+    return getGenerations([MEMCACHE_ATTENDING_GEN_KEY % user_id])[0]
+
+
+def invalidateAttending(user_id):
+    """Invalidate the ETags of user_id's attendance list."""
+    bumpGeneration(MEMCACHE_ATTENDING_GEN_KEY % user_id)
+
+
+def _pageETag(gen, page, wscks):
+    gen_keys = [key for wsck in wscks for key in _conferenceGenKeys(wsck)]
+    gens = getGenerations(gen_keys)
+    if gen is None or None in gens:
+        return None
+    return makeETag(gen, page, gens)
+
+
+def attendingETag(user_id, page, gen, wscks):
+    """Return the ETag of one page of user_id's attendance list, or None
+    if memcache could not version it.
+
+    page identifies the page and its view; gen must be read before the
+    page was queried.  The page's conferences are remembered so the ETag
+    can later be recomputed without a query.
+    """
+    if gen is not None:
+        memcache.set(MEMCACHE_ATTENDING_PAGE_KEY % (user_id, gen, page),
+                     wscks, time=FORM_CACHE_TIME)
+    return _pageETag(gen, page, wscks)
+
+
+def cachedAttendingETag(user_id, page):
+    """Return the current ETag of a page of user_id's attendance list, or
+    None if the page has to be queried again."""
+    gen = attendingGeneration(user_id)
+    wscks = memcache.get(MEMCACHE_ATTENDING_PAGE_KEY % (user_id, gen, page))
+    if gen is None or wscks is None:
+        return None
+    return _pageETag(gen, page, wscks)
+
+
+def getProfile(p_key):
+    """Return the Profile for p_key from memcache or the datastore, or None."""
+    user_id = p_key.id()
+    gen_key = MEMCACHE_PROFILE_GEN_KEY % user_id
+    gens = getGenerations([gen_key])
+    entry = memcache.get(MEMCACHE_PROFILE_KEY % user_id)
+    if entry and entry[0] == gens:
+        recordProfileLookup('memcache')
+        return entry[1]
+
+    recordProfileLookup('datastore')
+    profile = p_key.get()
+    if profile and None not in gens:
+        memcache.set(MEMCACHE_PROFILE_KEY % user_id, (gens, profile),
+                     time=PROFILE_CACHE_TIME)
+    return profile
+
+
+def storeProfile(profile):
+    """Invalidate older cached copies of a just-written Profile and cache it."""
+    user_id = profile.key.id()
+    gen = memcache.incr(MEMCACHE_PROFILE_GEN_KEY % user_id,
+                        initial_value=_initialGeneration())
+    if gen is not None:
+        memcache.set(MEMCACHE_PROFILE_KEY % user_id, ((gen,), profile),
+                     time=PROFILE_CACHE_TIME)
+
+
+def recordProfileLookup(tier):
+    """Count a profile lookup answered from the given tier; the counts
+    are written once, at the end of the request."""
+    logging.debug('profile cache lookup answered from %s', tier)
+    instrument.count(MEMCACHE_PROFILE_STATS_KEY % tier)
+
+
+def getProfileCacheStats():
+    """Return {tier: lookups} counted since the counters were last evicted."""
+    stats = memcache.get_multi(
+        [MEMCACHE_PROFILE_STATS_KEY % tier for tier in PROFILE_CACHE_TIERS])
+    return dict((tier, stats.get(MEMCACHE_PROFILE_STATS_KEY % tier, 0))
+                for tier in PROFILE_CACHE_TIERS)
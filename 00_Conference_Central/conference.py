@@ -16,28 +16,50 @@ from protorpc import messages
 from protorpc import message_types
 from protorpc import remote
 
+from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
+from models import AdmissionTicketForm
 from models import ConflictException
 from models import Profile
 from models import ProfileMiniForm
 from models import ProfileForm
+from models import ProfileForms
+from models import Registration
+from models import WishlistEntry
 from models import BooleanMessage
 from models import Conference
 from models import ConferenceForm
+from models import ConferenceSummaryForm
 from models import ConferenceForms
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
 from models import TeeShirtSize
+from models import ListView
 from models import Session
 from models import SessionForm
 from models import SessionForms
+from models import SessionSummaryForm
+from models import SessionBatchResult
+from models import SessionBatchResults
+from models import SessionQueryForms
 from models import SpeakerName
 
 
 from utils import getUserId
+import admission
+import announcements
+import cache
+import instrument
+import converters
+import notifications
+import seats
+import sessionquery
+import speakers
+import textsearch
 
 from settings import WEB_CLIENT_ID
 
@@ -48,11 +70,16 @@ from google.appengine.api import taskqueue
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
-MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
-ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
-                    'are nearly sold out: %s')
 MEMCACHE_SPEAKERS_KEY = 'FEATURED SPEAKERS'
 EMAIL_REGEX = re.compile(r"[^@]+@[^@]+\.[^@]+")
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+MIGRATION_BATCH_SIZE = 50
+MAX_BATCH_SIZE = 500
+BATCH_WRITE_SIZE = 100
+# speakers indexed per batch transaction; with the conference's own group
+# that is the 25 entity group limit of a cross-group transaction
+BATCH_TXN_SPEAKERS = 24
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -61,6 +88,7 @@ DEFAULTS = {
     "maxAttendees": 0,
     "seatsAvailable": 0,
     "topics": [ "Default", "Topic" ],
+    "admissionQueue": False,
 }
 
 #------Session starts
@@ -98,22 +126,38 @@ SES_GET_BY_TYPE_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
     typeOfSession=messages.StringField(2),
+    view=messages.EnumField(ListView, 3),
 )
 
 SES_GET_BY_CONF_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
+    view=messages.EnumField(ListView, 4),
 )
 
 SES_GET_SPEAKER_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     speaker=messages.StringField(1),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
+    view=messages.EnumField(ListView, 4),
+)
+
+CONF_LIST_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    pageSize=messages.IntegerField(1, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(2),
+    view=messages.EnumField(ListView, 3),
 )
 
 SES_GET_SPEAKERMAIL_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     speaker=messages.StringField(1),
     speakerEmail=messages.StringField(2),
+    pageSize=messages.IntegerField(3, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(4),
 )
 
 SES_ADD_TO_WISHLIST = endpoints.ResourceContainer(
@@ -131,9 +175,23 @@ SESS_POST_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
+SESS_BATCH_POST_REQUEST = endpoints.ResourceContainer(
+    SessionForms,
+    websafeConferenceKey=messages.StringField(1),
+)
+
 SES_DELETE_FROM_WISHLIST = endpoints.ResourceContainer(
     SessionForm,
-    websafeSessionKey=messages.StringField(1)
+    websafeSessionKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
+)
+
+CONF_ATTENDEES_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
 )
 
 SES_GET_BY_DURATION_REQUEST = endpoints.ResourceContainer(
@@ -146,6 +204,46 @@ SES_GET_BEFORE_SEVEN_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
 )
+
+SES_GET_FEATURED_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    ifNoneMatch=messages.StringField(2),
+)
+
+CONF_CONDITIONAL_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    ifNoneMatch=messages.StringField(2),
+)
+
+CONF_ATTENDING_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    pageSize=messages.IntegerField(1, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(2),
+    ifNoneMatch=messages.StringField(3),
+    view=messages.EnumField(ListView, 4),
+)
+
+ANNOUNCEMENT_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    ifNoneMatch=messages.StringField(1),
+)
+
+CONF_SEARCH_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    q=messages.StringField(1),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
+)
+
+SES_SEARCH_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    q=messages.StringField(1),
+    websafeConferenceKey=messages.StringField(2),
+    pageSize=messages.IntegerField(3, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(4),
+)
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 
@@ -157,57 +255,139 @@ class ConferenceApi(remote.Service):
 
 # - - - Conference objects - - - - - - - - - - - - - - - - -
 
-    def _copyConferenceToForm(self, conf, displayName):
+    def _copyConferenceToForm(self, conf, seatsAvailable=None):
         """Copy relevant fields from Conference to ConferenceForm."""
-        cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
-        if displayName:
-            setattr(cf, 'organizerDisplayName', displayName)
-        cf.check_initialized()
+        cf = converters.CONFERENCE_FORM(conf)
+        # seats come from the sharded counter rather than the entity
+        if seatsAvailable is not None:
+            cf.seatsAvailable = seatsAvailable
         return cf
 
+    def _copyConferencesToForms(self, confs, totals):
+        """Copy a batch of Conferences, with available seats by conference key."""
+        forms = converters.CONFERENCE_FORM.convertMulti(confs)
+        for conf, cf in zip([conf for conf in confs if conf], forms):
+            if totals.get(conf.key) is not None:
+                cf.seatsAvailable = totals[conf.key]
+        return forms
+
 #----------------session starts----------------
     def _copySessionToForm(self, ses):
         """Copy relevant fields from Session to SessionForm."""
-        sf = SessionForm()
-        for field in sf.all_fields():
-            if hasattr(ses, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(sf, field.name, str(getattr(ses, field.name)))
-                elif field.name == 'startTime':
-                    setattr(sf, field.name, str(getattr(ses, field.name)))
-                else:
-                    setattr(sf, field.name, getattr(ses, field.name))
-            elif field.name == "websafeKey":
-                setattr(sf, field.name, ses.key.urlsafe())
-        sf.check_initialized()
-        return sf
+        return converters.SESSION_FORM(ses)
+
+    def _copySessionsToForms(self, sessions):
+        """Copy a batch of Sessions to SessionForms."""
+        return converters.SESSION_FORM.convertMulti(sessions)
+
+    def _sessionSummaries(self, s_keys):
+        """Return SessionSummaryForms for session keys from the summary cache."""
+        forms = cache.getSummaries(s_keys, SessionSummaryForm, lambda keys:
+            converters.SESSION_SUMMARY.convertMulti(ndb.get_multi(keys), keep_missing=True))
+        return [form for form in forms if form]
 #----------------session ends----------------
 
-    def _createConferenceObject(self, request):
-        """Create or update Conference object, returning ConferenceForm/request."""
-        # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+    def _conferenceSummaries(self, c_keys):
+        """Return ConferenceSummaryForms for conference keys from the summary
+        cache, with seats from the counter."""
+        forms = cache.getSummaries(c_keys, ConferenceSummaryForm, lambda keys:
+            converters.CONFERENCE_SUMMARY.convertMulti(ndb.get_multi(keys), keep_missing=True))
+        totals = seats.getSeatsMulti(c_keys)
+        summaries = []
+        for c_key, form in zip(c_keys, forms):
+            if form:
+                # conferences created before the counter keep their stored value
+                if totals[c_key] is not None:
+                    form.seatsAvailable = totals[c_key]
+                summaries.append(form)
+        return summaries
+
+    def _summaryView(self, request):
+        """Return True if a list endpoint was asked for summaries only."""
+        return request.view == ListView.SUMMARY
+
+    def _getSeats(self, confs):
+        """Return {conference key: available seats} from the sharded counter."""
+        return self._fillSeats(confs, seats.getSeatsMulti([conf.key for conf in confs]))
+
+    def _fillSeats(self, confs, totals):
+        # conferences created before the counter keep their stored value
+        for conf in confs:
+            if totals[conf.key] is None:
+                totals[conf.key] = conf.seatsAvailable
+        return totals
+
+    @ndb.tasklet
+    def _conferencesWithSeatsAsync(self, c_keys):
+        """Fetch Conferences and their available seats concurrently;
+        returns (conferences, {conference key: available seats})."""
+        confs, totals = yield (ndb.get_multi_async(c_keys),
+                               seats.getSeatsMultiAsync(c_keys))
+        confs = [conf for conf in confs if conf]
+        raise ndb.Return(confs, self._fillSeats(confs, totals))
+
+    def _pageSize(self, request):
+        """Return the requested page size, bounded by MAX_PAGE_SIZE."""
+        page_size = request.pageSize or DEFAULT_PAGE_SIZE
+        if page_size < 0:
+            raise endpoints.BadRequestException("'pageSize' must be positive")
+        return min(page_size, MAX_PAGE_SIZE)
+
+    def _pageArgs(self, request):
+        """Return (page_size, start_cursor) from optional pageSize/pageToken fields."""
+        page_size = self._pageSize(request)
+        cursor = None
+        if request.pageToken:
+            try:
+                cursor = Cursor(urlsafe=request.pageToken)
+            except datastore_errors.BadValueError:
+                raise endpoints.BadRequestException("Invalid 'pageToken'")
+        return page_size, cursor
+
+    def _pageSlice(self, items, request):
+        """Return one page of an in-memory list as (items, nextPageToken).
+
+        The token is the offset of the next page.
+        """
+        page_size = self._pageSize(request)
+        try:
+            offset = int(request.pageToken or 0)
+        except ValueError:
+            raise endpoints.BadRequestException("Invalid 'pageToken'")
+        if offset < 0:
+            raise endpoints.BadRequestException("Invalid 'pageToken'")
+        end = offset + page_size
+        return items[offset:end], str(end) if end < len(items) else None
+
+    def _fetchPage(self, query, request, **options):
+        """Fetch one page of query results, returning (entities, nextPageToken)."""
+        page_size, cursor = self._pageArgs(request)
+        results, next_cursor, more = query.fetch_page(page_size, start_cursor=cursor,
+                                                      **options)
+        if more and next_cursor:
+            return results, next_cursor.urlsafe()
+        return results, None
+
+    def _ifNoneMatch(self, request):
+        """Return the ETag a conditional GET was made with, if any.
+
+        Taken from the ifNoneMatch field, or else the If-None-Match header.
+        """
+        if request.ifNoneMatch:
+            return request.ifNoneMatch
+        headers = getattr(getattr(self, 'request_state', None), 'headers', None)
+        return headers.get('If-None-Match') if headers else None
 
+    def _conferenceDataFromForm(self, request):
+        """Validate a ConferenceForm and return its Conference fields as a dict."""
         if not request.name:
             raise endpoints.BadRequestException("Conference 'name' field required")
 
         # copy ConferenceForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
         del data['websafeKey']
-        del data['organizerDisplayName']
+        del data['etag']
+        del data['notModified']
 
         # add default values for those missing (both data model & outbound Message)
         for df in DEFAULTS:
@@ -216,17 +396,32 @@ class ConferenceApi(remote.Service):
                 setattr(request, df, DEFAULTS[df])
 
         # convert dates from strings to Date objects; set month based on start_date
-        if data['startDate']:
-            data['startDate'] = datetime.strptime(data['startDate'][:10], "%Y-%m-%d").date()
-            data['month'] = data['startDate'].month
-        else:
-            data['month'] = 0
-        if data['endDate']:
-            data['endDate'] = datetime.strptime(data['endDate'][:10], "%Y-%m-%d").date()
+        try:
+            if data['startDate']:
+                data['startDate'] = datetime.strptime(data['startDate'][:10], "%Y-%m-%d").date()
+                data['month'] = data['startDate'].month
+            else:
+                data['month'] = 0
+            if data['endDate']:
+                data['endDate'] = datetime.strptime(data['endDate'][:10], "%Y-%m-%d").date()
+        except ValueError:
+            raise endpoints.BadRequestException(
+                "Conference 'startDate' and 'endDate' must be YYYY-MM-DD")
 
         # set seatsAvailable to be same as maxAttendees on creation
         if data["maxAttendees"] > 0:
-            data["seatsAvailable"] = data["maxAttendees"]
+            data["seatsAvailable"] = request.seatsAvailable = data["maxAttendees"]
+        return data
+
+    def _createConferenceObject(self, request):
+        """Create or update Conference object, returning ConferenceForm/request."""
+        # preload necessary data items
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+        data = self._conferenceDataFromForm(request)
+
         # generate Profile Key based on user ID and Conference
         # ID based on Profile key get Conference key from ID
         p_key = ndb.Key(Profile, user_id)
@@ -234,19 +429,28 @@ class ConferenceApi(remote.Service):
         c_key = ndb.Key(Conference, c_id, parent=p_key)
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
+        # stored on the conference so that reads need not fetch the Profile;
+        # saveProfile pushes a changed name out to the conferences
+        data['organizerDisplayName'] = request.organizerDisplayName = \
+            self._getProfileFromUser().displayName
 
         # create Conference, send email to organizer confirming
         # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
-        # confirmation email sending task to queue
-        taskqueue.add(params={'email': user.email(),
-            'conferenceInfo': repr(request)},
-            url='/tasks/send_confirmation_email'
+        conf = Conference(**data)
+        conf.put()
+        seats.initSeats(c_key, data['seatsAvailable'])
+        if announcements.isNearlySoldOut(data['seatsAvailable']):
+            announcements.track(conf, data['seatsAvailable'])
+        textsearch.enqueue([c_key])
+        # confirmation email, sent with the organizer's next digest
+        notifications.enqueue(user.email(),
+            'You created a new Conference!',
+            'Hi, you have created a following '
+            'conference:\r\n\r\n%s' % repr(request)
         )
         return request
 
 
-    @ndb.transactional()
     def _updateConferenceObject(self, request):
         """update Conference object, returning ConferenceForm/request."""        
         user = endpoints.get_current_user()
@@ -254,9 +458,23 @@ class ConferenceApi(remote.Service):
             raise endpoints.UnauthorizedException('Authorization required')
         user_id = getUserId(user)
 
-        # copy ConferenceForm/ProtoRPC Message into dict
-        data = {field.name: getattr(request, field.name) for field in request.all_fields()}
+        # seat changes are applied to the counter shards, so make sure
+        # a conference created before the counter has them
+        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        if conf:
+            seats.ensureShards(conf)
+
+        conf = self._updateConferenceTxn(request, user_id)
+        cache.invalidateConference(request.websafeConferenceKey)
+        textsearch.enqueue([conf.key])
+        # a renamed conference has to be renamed in the announcement too
+        announcements.track(conf, None)
+        return self._copyConferenceToForm(conf, seats.getSeats(conf))
 
+
+    @ndb.transactional()
+    def _updateConferenceTxn(self, request, user_id):
+        """Copy the provided fields onto the Conference inside a transaction."""
         # update existing conference
         conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
         # check that conference exists
@@ -271,8 +489,13 @@ class ConferenceApi(remote.Service):
 
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
+        oldMaxAttendees = conf.maxAttendees or 0
         for field in request.all_fields():
             data = getattr(request, field.name)
+            # seatsAvailable is owned by the seat counter, and
+            # organizerDisplayName by the organizer's Profile
+            if field.name in ('seatsAvailable', 'organizerDisplayName'):
+                continue
             # only copy fields where we get data
             if data not in (None, []):
                 # special handling for dates (convert string to Date)
@@ -283,8 +506,15 @@ class ConferenceApi(remote.Service):
                 # write to Conference object
                 setattr(conf, field.name, data)
         conf.put()
-        prof = ndb.Key(Profile, user_id).get()
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        # grow or shrink the seat counter along with maxAttendees
+        delta = (conf.maxAttendees or 0) - oldMaxAttendees
+        if delta:
+            taskqueue.add(params={'websafeConferenceKey': request.websafeConferenceKey,
+                'delta': delta},
+                url='/tasks/adjust_seats',
+                transactional=True
+            )
+        return conf
 
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
@@ -294,13 +524,8 @@ class ConferenceApi(remote.Service):
         return self._createConferenceObject(request)
 
 #------------session starts-----------------------
-    def _createSessionObject(self, request):
-        """Create or update Session object, returning SessionForm/request."""
-        # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+    def _sessionDataFromForm(self, request):
+        """Validate a SessionForm and return its Session fields as a dict."""
         """check mandatory fiels are populated starts"""
         if not request.name:
             raise endpoints.BadRequestException("session 'name' field required")
@@ -315,8 +540,8 @@ class ConferenceApi(remote.Service):
             raise endpoints.BadRequestException("session 'speaker email' valid format required")
         """check mandatory fiels are populated ends"""
 
-        # copy ConferenceForm/ProtoRPC Message into dict
-        data = {field.name: getattr(request, field.name) for field in request.all_fields()}
+        # copy SessionForm/ProtoRPC Message into dict
+        data = {field.name: getattr(request, field.name) for field in SessionForm.all_fields()}
         del data['websafeKey']
         
         # add default values for those missing (both data model & outbound Message)
@@ -325,30 +550,47 @@ class ConferenceApi(remote.Service):
                 data[df] = DEFAULTSSESSION[df]
                 setattr(request, df, DEFAULTSSESSION[df])
                 
-        if data['date']:
-            data['date'] = datetime.strptime(data['date'][:10], "%Y-%m-%d").date()
-        if data['startTime']:
-            data['startTime'] = datetime.strptime(data['startTime'], "%H:%M").time()
+        try:
+            if data['date']:
+                data['date'] = datetime.strptime(data['date'][:10], "%Y-%m-%d").date()
+            if data['startTime']:
+                data['startTime'] = datetime.strptime(data['startTime'], "%H:%M").time()
+        except ValueError:
+            raise endpoints.BadRequestException(
+                "session 'date' must be YYYY-MM-DD and 'startTime' HH:MM")
+        return data
+
+    def _createSessionObject(self, request):
+        """Create or update Session object, returning SessionForm/request."""
+        return self._createSessionObjectAsync(request).get_result()
+
+    @ndb.tasklet
+    def _createSessionObjectAsync(self, request):
+        # preload necessary data items
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+        data = self._sessionDataFromForm(request)
 
         #get conference key based on websafe conference key
         wsck = request.websafeConferenceKey
         c_key = ndb.Key(urlsafe=wsck)
-        if not c_key.get():
+        # the conference check and the id allocation are independent
+        conf, (s_id, _) = yield (c_key.get_async(),
+                                 Session.allocate_ids_async(size=1, parent=c_key))
+        if not conf:
             raise endpoints.NotFoundException('No conference found with key: %s' % wsck)
 
-        s_id = Session.allocate_ids(size=1, parent=c_key)[0]
         s_key = ndb.Key(Session, s_id, parent=c_key)
         data['key'] = s_key
         #data['organizerUserId'] = request.organizerUserId = user_id
 
-        del data['websafeConferenceKey']
-
-        # creation of Session & return (modified) SessionForm
-        Session(**data).put()
-        session = s_key.get()
-
-        #get the conference based on session created
-        conf = session.key.parent().get()
+        # creation of Session & return (modified) SessionForm; the entity
+        # just written is returned as is rather than read back
+        session = Session(**data)
+        self._putSessionTxn(session)
+        textsearch.enqueue([s_key])
         """task for setting featured speakers by sending
            speaker email,speaker name and websafeconferencekey"""
         if data['speaker'] and data['speakerEmail']:
@@ -357,12 +599,131 @@ class ConferenceApi(remote.Service):
                           url='/tasks/set_featured_speaker'
                           )
         #send email to conference owner regarding new session
-        taskqueue.add(params={'email': user.email(),'confName': conf.name,
-            'sessionInfo': repr(request)},
-            url='/tasks/send_session_confirmation_email'
-        )                
-        return self._copySessionToForm(session)
+        notifications.enqueue(user.email(),
+            'New session is created in %s !' % conf.name,
+            'Hi, you have created a following '
+            'session:\r\n\r\n%s' % repr(request)
+        )
+        raise ndb.Return(self._copySessionToForm(session))
+
+
+
+    @ndb.transactional(xg=True)
+    def _putSessionTxn(self, session):
+        """Write a new Session and index it under its Speaker atomically."""
+        session.put()
+        return speakers.indexSessions(speakers.speakerKey(session.speakerEmail), [session])
+
 
+    @ndb.transactional(xg=True)
+    def _putSessionsTxn(self, sessions):
+        """Write new Sessions of one conference and index them under their
+        Speakers atomically; at most BATCH_TXN_SPEAKERS speakers."""
+        by_speaker = {}
+        for ses in sessions:
+            by_speaker.setdefault(speakers.speakerKey(ses.speakerEmail), []).append(ses)
+        futures = ndb.put_multi_async(sessions) + [
+            speakers.indexSessionsAsync(sp_key, group)
+            for sp_key, group in by_speaker.items()]
+        for future in futures:
+            future.get_result()
+
+
+    @staticmethod
+    def _sessionChunks(by_speaker):
+        """Split {speaker key: [(result, session)]} into the rows of one
+        _putSessionsTxn each."""
+        chunks, chunk, chunk_speakers = [], [], set()
+        for sp_key, group in by_speaker.items():
+            for i in range(0, len(group), BATCH_WRITE_SIZE):
+                piece = group[i:i + BATCH_WRITE_SIZE]
+                if chunk and (len(chunk) + len(piece) > BATCH_WRITE_SIZE or
+                              len(chunk_speakers | set([sp_key])) > BATCH_TXN_SPEAKERS):
+                    chunks.append(chunk)
+                    chunk, chunk_speakers = [], set()
+                chunk.extend(piece)
+                chunk_speakers.add(sp_key)
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+
+    def _createSessionsBatch(self, request):
+        """Create many Sessions in one conference, returning per-row results."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        if len(request.items) > MAX_BATCH_SIZE:
+            raise endpoints.BadRequestException(
+                "At most %d sessions can be created at once" % MAX_BATCH_SIZE)
+
+        # validate every row up front; invalid rows are reported, not written
+        results = [SessionBatchResult(index=i) for i in range(len(request.items))]
+        rows = []
+        for result, form in zip(results, request.items):
+            try:
+                rows.append((result, form, self._sessionDataFromForm(form)))
+            except endpoints.BadRequestException as e:
+                result.error = str(e)
+
+        # verify the conference once for the whole batch
+        wsck = request.websafeConferenceKey
+        c_key = ndb.Key(urlsafe=wsck)
+        conf = c_key.get()
+        if not conf:
+            raise endpoints.NotFoundException('No conference found with key: %s' % wsck)
+        if not rows:
+            return SessionBatchResults(items=results)
+
+        # one id allocation for all rows
+        first, last = Session.allocate_ids(size=len(rows), parent=c_key)
+        by_speaker = {}
+        for s_id, (result, form, data) in zip(range(first, last + 1), rows):
+            data['key'] = ndb.Key(Session, s_id, parent=c_key)
+            session = Session(**data)
+            by_speaker.setdefault(speakers.speakerKey(session.speakerEmail), []).append(
+                (result, session))
+
+        # like createSession, every session is written together with its
+        # speaker index entry; the sessions all share the conference's
+        # entity group, so the transactions run one after the other
+        sessions = []
+        for chunk in self._sessionChunks(by_speaker):
+            try:
+                self._putSessionsTxn([session for result, session in chunk])
+            except datastore_errors.Error as e:
+                for result, session in chunk:
+                    result.error = 'Not created: %s' % e
+                continue
+            for result, session in chunk:
+                result.websafeKey = session.key.urlsafe()
+                sessions.append(session)
+        if not sessions:
+            return SessionBatchResults(items=results)
+        textsearch.enqueue([ses.key for ses in sessions])
+        by_speaker = {}
+        for ses in sessions:
+            by_speaker.setdefault(speakers.speakerKey(ses.speakerEmail), []).append(ses)
+
+        # one featured speaker task per speaker, enqueued together
+        tasks = [taskqueue.Task(params={'speaker': group[0].speaker,
+                                        'speakerEmail': group[0].speakerEmail,
+                                        'confName': conf.name,
+                                        'websafeConferenceKey': wsck},
+                                url='/tasks/set_featured_speaker')
+                 for group in by_speaker.values()]
+        queue = taskqueue.Queue()
+        for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+            queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+
+        # a single confirmation for the whole batch
+        notifications.enqueue(user.email(),
+            '%d new sessions are created in %s !' % (len(sessions), conf.name),
+            'Hi, you have created the following '
+            'sessions:\r\n\r\n%s' % '\r\n\r\n'.join(
+                repr(form) for result, form, data in rows if result.websafeKey)
+        )
+        return SessionBatchResults(items=results)
 
 
     @endpoints.method(SESS_POST_REQUEST, SessionForm,
@@ -372,14 +733,30 @@ class ConferenceApi(remote.Service):
         """Create new session."""
         return self._createSessionObject(request)
 
+    @endpoints.method(SESS_BATCH_POST_REQUEST, SessionBatchResults,
+                      path='sessions',
+                      http_method='POST', name='createSessionsBatch')
+    def createSessionsBatch(self, request):
+        """Create many sessions in one conference."""
+        return self._createSessionsBatch(request)
+
     @endpoints.method(SES_GET_SPEAKER_REQUEST, SessionForms,
             path='getSessionsBySpeaker',
             http_method='POST', name='getSessionsBySpeaker')
     def getSessionsBySpeaker(self, request):
         """Return sessions based on speaker."""
-        sessions = Session.query(Session.speaker == request.speaker)
+        # the Speaker index files session keys by exact name, so the page
+        # is cut from the keys and only its sessions are fetched
+        s_keys, next_token = self._pageSlice(
+            speakers.sessionKeysByName(request.speaker), request)
+        sessions = [ses for ses in ndb.get_multi(s_keys) if ses]
+        if self._summaryView(request):
+            return SessionForms(
+                summaries=converters.SESSION_SUMMARY.convertMulti(sessions),
+                nextPageToken=next_token)
         return SessionForms(
-            items=[self._copySessionToForm(ses) for ses in sessions]
+            items=self._copySessionsToForms(sessions),
+            nextPageToken=next_token
         )
 
     @endpoints.method(SES_GET_SPEAKERMAIL_REQUEST, SessionForms,
@@ -397,10 +774,16 @@ class ConferenceApi(remote.Service):
         elif not EMAIL_REGEX.match(request.speakerEmail):
             raise endpoints.BadRequestException("session 'speaker email' valid format required")
         
-        sessions = Session.query(Session.speaker == request.speaker)
-        sessions = sessions.filter(Session.speakerEmail == request.speakerEmail)
+        # one keyed get for the speaker, one get_multi for a page of the
+        # keys filed under this name
+        speaker = speakers.speakerKey(request.speakerEmail).get()
+        s_keys, next_token = self._pageSlice(
+            speakers.sessionKeysByName(request.speaker, speaker) if speaker else [],
+            request)
+        sessions = [ses for ses in ndb.get_multi(s_keys) if ses]
         return SessionForms(
-            items=[self._copySessionToForm(ses) for ses in sessions]
+            items=self._copySessionsToForms(sessions),
+            nextPageToken=next_token
         )
 
     @endpoints.method(SES_GET_BY_TYPE_REQUEST, SessionForms,
@@ -410,8 +793,11 @@ class ConferenceApi(remote.Service):
         """Return sessions based on type of session."""
         sessions = Session.query(ancestor=ndb.Key(urlsafe=request.websafeConferenceKey))
         sessions = sessions.filter(Session.typeOfSession == request.typeOfSession)
+        if self._summaryView(request):
+            return SessionForms(
+                summaries=self._sessionSummaries(sessions.fetch(keys_only=True)))
         return SessionForms(
-            items=[self._copySessionToForm(ses) for ses in sessions]
+            items=self._copySessionsToForms(sessions)
         )
 
     @endpoints.method(SES_GET_BY_DURATION_REQUEST, SessionForms,
@@ -422,7 +808,7 @@ class ConferenceApi(remote.Service):
         sessions = Session.query(ancestor=ndb.Key(urlsafe=request.websafeConferenceKey))
         sessions = sessions.filter(Session.duration == request.duration)
         return SessionForms(
-            items=[self._copySessionToForm(ses) for ses in sessions]
+            items=self._copySessionsToForms(sessions)
         )
 
     @endpoints.method(SES_GET_BY_CONF_REQUEST, SessionForms,
@@ -431,11 +817,26 @@ class ConferenceApi(remote.Service):
     def getConferenceSessions(self, request):        
         """Return sessions created in a conference."""
         sessions = Session.query(ancestor=ndb.Key(urlsafe=request.websafeConferenceKey))
+        if self._summaryView(request):
+            s_keys, next_token = self._fetchPage(sessions, request, keys_only=True)
+            return SessionForms(summaries=self._sessionSummaries(s_keys),
+                                nextPageToken=next_token)
+        sessions, next_token = self._fetchPage(sessions, request)
         return SessionForms(
-            items=[self._copySessionToForm(ses) for ses in sessions]
+            items=self._copySessionsToForms(sessions),
+            nextPageToken=next_token
         )
 
 
+    def _wishlistQuery(self, p_key):
+        """Return the query over a user's WishlistEntry children, oldest first."""
+        return WishlistEntry.query(ancestor=p_key).order(WishlistEntry.created)
+
+    def _sessionsFromEntryKeys(self, entry_keys):
+        """Fetch the Sessions named by WishlistEntry keys in one get_multi."""
+        sessions = ndb.get_multi([ndb.Key(urlsafe=e_key.id()) for e_key in entry_keys])
+        return [ses for ses in sessions if ses]
+
     @endpoints.method(SES_ADD_TO_WISHLIST, BooleanMessage,
             path='session/wishlist/{websafeSessionKey}',
             http_method='POST', name='addSessionToWishlist')
@@ -444,17 +845,18 @@ class ConferenceApi(remote.Service):
         prof = self._getProfileFromUser()  
         wssk = request.websafeSessionKey
         wssk = wssk.strip()
-        sess = ndb.Key(urlsafe=wssk).get()
+        s_key = ndb.Key(urlsafe=wssk)
+        e_key = ndb.Key(WishlistEntry, wssk, parent=prof.key)
+        # membership is a keyed get; run it alongside the session lookup
+        sess, entry = ndb.get_multi([s_key, e_key])
         if not sess:
             raise endpoints.NotFoundException(
                 'No session found')
-        if wssk in prof.wishlist:
+        if entry:
             raise ConflictException(
-                "You have already registered for this conference")
-        #append the websafe key into users wishlist 
-        prof.wishlist.append(wssk)        
-        #save the profile to datastore
-        prof.put()
+                "You have already added this session to your wishlist")
+        #add the session to the users wishlist
+        WishlistEntry(key=e_key, session=s_key).put()
         return BooleanMessage(data=True)
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
@@ -468,20 +870,22 @@ class ConferenceApi(remote.Service):
             raise ConflictException(
                 "profile not found")
 
-        if prof.wishlist:
-            seskey = [ndb.Key(urlsafe=wlsk) for wlsk in prof.wishlist]
-            sessions = ndb.get_multi(seskey)
-            conferences =[]
-            for ses in sessions:
-                #get parent for each session
-                conferences.append(ses.key.parent().get())
-                
+        # a session's conference is its parent key, so there is no need to
+        # fetch the sessions; dedupe while keeping wishlist order
+        conf_keys = []
+        seen = set()
+        for e_key in self._wishlistQuery(prof.key).iter(keys_only=True):
+            c_key = ndb.Key(urlsafe=e_key.id()).parent()
+            if c_key not in seen:
+                seen.add(c_key)
+                conf_keys.append(c_key)
+        conferences, totals = self._conferencesWithSeatsAsync(conf_keys).get_result()
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in conferences]
+            items=self._copyConferencesToForms(conferences, totals)
         )
 
 
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+    @endpoints.method(CONF_LIST_REQUEST, SessionForms,
             path='session/wishlist',
             http_method='GET', name='getSessionsInWishlist')
     def getSessionsInWishlist(self, request):        
@@ -492,16 +896,21 @@ class ConferenceApi(remote.Service):
             raise ConflictException(
                 "profile not found")
 
-        if prof.wishlist:
-            seskey = [ndb.Key(urlsafe=wlsk) for wlsk in prof.wishlist]
-            sessions = ndb.get_multi(seskey)
-
-        else:
+        entry_keys, next_token = self._fetchPage(
+            self._wishlistQuery(prof.key), request, keys_only=True)
+        if not entry_keys and not request.pageToken:
             raise ConflictException(
                 "You dont have no sessions in your wish list")
 
+        if self._summaryView(request):
+            return SessionForms(
+                summaries=self._sessionSummaries(
+                    [ndb.Key(urlsafe=e_key.id()) for e_key in entry_keys]),
+                nextPageToken=next_token
+            )
         return SessionForms(
-            items=[self._copySessionToForm(ses) for ses in sessions]
+            items=self._copySessionsToForms(self._sessionsFromEntryKeys(entry_keys)),
+            nextPageToken=next_token
         )
     
     @endpoints.method(SES_DELETE_FROM_WISHLIST, SessionForms,
@@ -509,26 +918,59 @@ class ConferenceApi(remote.Service):
             http_method='DELETE', name='deleteSessionInWishlist')
     def deleteSessionInWishlist(self, request):
         "delete a session from wishlist"
+        return self._deleteSessionInWishlistAsync(request).get_result()
+
+    @ndb.tasklet
+    def _deleteSessionInWishlistAsync(self, request):
         prof = self._getProfileFromUser()
         if not prof:
             raise ConflictException(
                 "profile not found")
         wssk = request.websafeSessionKey
         wssk = wssk.strip()
-        sess = ndb.Key(urlsafe=wssk).get()
+        e_key = ndb.Key(WishlistEntry, wssk, parent=prof.key)
+        sess, entry = yield ndb.get_multi_async([ndb.Key(urlsafe=wssk), e_key])
         if not sess:
             raise endpoints.NotFoundException(
                 'No session found with key: %s' % wssk)
-        if wssk in prof.wishlist:
-            prof.wishlist.remove(wssk)
-        else:
+        if not entry:
             raise ConflictException(
                 "You dont have any sessions in your wish list")
-        seskey = [ndb.Key(urlsafe=wlsk) for wlsk in prof.wishlist]
-        #get all the sessions
-        sessions = ndb.get_multi(seskey)
+        yield e_key.delete_async()
+        # the page of what is left is fetched once the delete is done, so
+        # it is a full page; the ancestor query sees the delete at once
+        page_size, cursor = self._pageArgs(request)
+        entry_keys, next_cursor, more = yield self._wishlistQuery(prof.key).fetch_page_async(
+            page_size, start_cursor=cursor, keys_only=True)
+        sessions = yield ndb.get_multi_async(
+            [ndb.Key(urlsafe=key.id()) for key in entry_keys])
+        raise ndb.Return(SessionForms(
+            items=self._copySessionsToForms([ses for ses in sessions if ses]),
+            nextPageToken=next_cursor.urlsafe() if more and next_cursor else None
+        ))
+
+    @endpoints.method(SessionQueryForms, SessionForms,
+            path='querySessions',
+            http_method='POST', name='querySessions')
+    def querySessions(self, request):
+        """Query for sessions, optionally within one conference."""
+        ancestor = None
+        if request.websafeConferenceKey:
+            ancestor = ndb.Key(urlsafe=request.websafeConferenceKey)
+        page_size, cursor = self._pageArgs(request)
+        sessions, next_cursor, debug = sessionquery.run(
+            sessionquery.parseFilters(request.filters), ancestor, page_size, cursor)
+        # residual filters need the entities, so only the response shrinks
+        if self._summaryView(request):
+            return SessionForms(
+                summaries=converters.SESSION_SUMMARY.convertMulti(sessions),
+                nextPageToken=next_cursor.urlsafe() if next_cursor else None,
+                debug=debug
+            )
         return SessionForms(
-            items=[self._copySessionToForm(ses) for ses in sessions]
+            items=self._copySessionsToForms(sessions),
+            nextPageToken=next_cursor.urlsafe() if next_cursor else None,
+            debug=debug
         )
 
     @endpoints.method(
@@ -565,30 +1007,34 @@ class ConferenceApi(remote.Service):
     @staticmethod
     def _cacheFeaturedSpeaker(request):
         """Create Announcement for featured speaker & assign to memcache."""
-        #fitlter session based on websafe onference key,speaker name and mail
-        sessions = Session.query(ancestor=ndb.Key(urlsafe=request.get('websafeConferenceKey')))
-        sessions = sessions.filter(Session.speaker == request.get('speaker'))
-        sessions = sessions.filter(Session.speakerEmail == request.get('speakerEmail'))
-        sessions = sessions.fetch()
-        if len(sessions) >= 2:
-            announcement = '%s speaks at' % sessions[0].speaker
-            announcement += ', '.join(sess.name for sess in sessions)
-            announcement += 'in conferences '.join(request.get('confName'))
+        # the speaker's session count for this conference is kept by the
+        # speaker index, so this is a keyed get rather than a session query
+        announcement = speakers.updateFeatured(
+            request.get('websafeConferenceKey'), request.get('speaker'),
+            request.get('speakerEmail'), request.get('confName'))
+        if announcement:
             memcache.set(MEMCACHE_SPEAKERS_KEY, announcement)
-        else:
-            announcement = ''
         return announcement
 
-    @endpoints.method(message_types.VoidMessage, StringMessage,
+    @endpoints.method(SES_GET_FEATURED_REQUEST, StringMessage,
                       path='conference/getFeaturedSpeaker',
                       http_method='GET', name='getFeaturedSpeaker')
     def getFeaturedSpeaker(self, request):
-        """Get featured speakers."""
-        featuredSpeaker = memcache.get(MEMCACHE_SPEAKERS_KEY)
+        """Get featured speakers, optionally of one conference."""
+        if request.websafeConferenceKey:
+            featuredSpeaker = speakers.getFeatured(request.websafeConferenceKey)
+        else:
+            featuredSpeaker = memcache.get(MEMCACHE_SPEAKERS_KEY)
+            if featuredSpeaker is None:
+                featuredSpeaker = speakers.getLatestFeatured()
+                memcache.set(MEMCACHE_SPEAKERS_KEY, featuredSpeaker)
         if not featuredSpeaker:
             featuredSpeaker = "no featured speaker"
+        etag = cache.makeETag(featuredSpeaker)
+        if etag == self._ifNoneMatch(request):
+            return StringMessage(data='', etag=etag, notModified=True)
         # return json data
-        return StringMessage(data=json.dumps(featuredSpeaker))
+        return StringMessage(data=json.dumps(featuredSpeaker), etag=etag)
 
 #------------session ends
 
@@ -600,22 +1046,30 @@ class ConferenceApi(remote.Service):
         return self._updateConferenceObject(request)
 
 
-    @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
+    @endpoints.method(CONF_CONDITIONAL_GET_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='GET', name='getConference')
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
+        # an unchanged conference is answered from memcache alone
+        etag = self._ifNoneMatch(request)
+        if etag and etag == cache.conferenceETag(request.websafeConferenceKey):
+            return ConferenceForm(etag=etag, notModified=True)
+        return cache.getConferenceForm(request.websafeConferenceKey,
+                                       lambda: self._buildConferenceForm(request))
+
+    def _buildConferenceForm(self, request):
+        """Build the ConferenceForm for getConference from the datastore."""
         # get Conference object from request; bail if not found
         conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
         # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        return self._copyConferenceToForm(conf, seats.getSeats(conf))
 
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @endpoints.method(CONF_LIST_REQUEST, ConferenceForms,
             path='getConferencesCreated',
             http_method='POST', name='getConferencesCreated')
     def getConferencesCreated(self, request):
@@ -627,10 +1081,16 @@ class ConferenceApi(remote.Service):
         user_id =  getUserId(user)
         # create ancestor query for all key matches for this user
         confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        if self._summaryView(request):
+            c_keys, next_token = self._fetchPage(confs, request, keys_only=True)
+            return ConferenceForms(summaries=self._conferenceSummaries(c_keys),
+                                   nextPageToken=next_token)
+        confs, next_token = self._fetchPage(confs, request)
+        totals = self._getSeats(confs)
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs]
+            items=self._copyConferencesToForms(confs, totals),
+            nextPageToken=next_token
         )
 
 
@@ -645,6 +1105,8 @@ class ConferenceApi(remote.Service):
         else:
             q = q.order(ndb.GenericProperty(inequality_filter))
             q = q.order(Conference.name)
+        # tie-break on key so cursors stay valid for '!=' (multi-)queries
+        q = q.order(Conference.key)
 
         for filtr in filters:
             if filtr["field"] in ["month", "maxAttendees"]:
@@ -688,39 +1150,69 @@ class ConferenceApi(remote.Service):
             name='queryConferences')
     def queryConferences(self, request):
         """Query for conferences."""
-        conferences = self._getQuery(request)
+        if self._summaryView(request):
+            c_keys, next_token = self._fetchPage(self._getQuery(request), request,
+                                                 keys_only=True)
+            return ConferenceForms(summaries=self._conferenceSummaries(c_keys),
+                                   nextPageToken=next_token)
+        conferences, next_token = self._fetchPage(self._getQuery(request), request)
+        totals = self._getSeats(conferences)
 
-        # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, conf.organizerUserId)) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
+        # return individual ConferenceForm object per Conference
+        return ConferenceForms(
+                items=self._copyConferencesToForms(conferences, totals),
+                nextPageToken=next_token
+        )
 
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
 
-        # return individual ConferenceForm object per Conference
+    @endpoints.method(CONF_SEARCH_REQUEST, ConferenceForms,
+            path='searchConferences',
+            http_method='GET', name='searchConferences')
+    def searchConferences(self, request):
+        """Search conference names, descriptions & topics, best match first."""
+        wskeys, next_token = self._pageSlice(
+            textsearch.search('Conference', request.q), request)
+        conferences = [conf for conf in ndb.get_multi(
+            [ndb.Key(urlsafe=wskey) for wskey in wskeys]) if conf]
+        totals = self._getSeats(conferences)
         return ConferenceForms(
-                items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in \
-                conferences]
+            items=self._copyConferencesToForms(conferences, totals),
+            nextPageToken=next_token
+        )
+
+
+    @endpoints.method(SES_SEARCH_REQUEST, SessionForms,
+            path='searchSessions',
+            http_method='GET', name='searchSessions')
+    def searchSessions(self, request):
+        """Search session names & highlights, optionally within one conference."""
+        ancestor = None
+        if request.websafeConferenceKey:
+            ancestor = ndb.Key(urlsafe=request.websafeConferenceKey)
+        wskeys, next_token = self._pageSlice(
+            textsearch.search('Session', request.q, ancestor), request)
+        sessions = [ses for ses in ndb.get_multi(
+            [ndb.Key(urlsafe=wskey) for wskey in wskeys]) if ses]
+        return SessionForms(
+            items=self._copySessionsToForms(sessions),
+            nextPageToken=next_token
         )
 
 
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
 
-    def _copyProfileToForm(self, prof):
+    def _copyProfileToForm(self, prof, links=True):
         """Copy relevant fields from Profile to ProfileForm."""
         # copy relevant fields from Profile to ProfileForm
-        pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
-        pf.check_initialized()
+        pf = converters.PROFILE_FORM(prof)
+        # registrations and wishlist live in child entities keyed by websafe key
+        if links:
+            pf.conferenceKeysToAttend = [r_key.id() for r_key in
+                Registration.query(ancestor=prof.key).order(Registration.created).iter(keys_only=True)]
+            pf.wishlist = [e_key.id() for e_key in self._wishlistQuery(prof.key).iter(keys_only=True)]
+        else:
+            pf.conferenceKeysToAttend = []
+            pf.wishlist = []
         return pf
 
 
@@ -731,10 +1223,16 @@ class ConferenceApi(remote.Service):
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
 
-        # get Profile from datastore
+        # repeated lookups within one request are answered from the memo
         user_id = getUserId(user)
+        memo = self._profileMemo()
+        if user_id in memo:
+            cache.recordProfileLookup('request')
+            return memo[user_id]
+
+        # get Profile from memcache or datastore
         p_key = ndb.Key(Profile, user_id)
-        profile = p_key.get()
+        profile = cache.getProfile(p_key)
         # create new Profile if not there
         if not profile:
             profile = Profile(
@@ -743,11 +1241,117 @@ class ConferenceApi(remote.Service):
                 mainEmail= user.email(),
                 teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
             )
-            profile.put()
-
+            self._saveProfile(profile)
+        # move registrations/wishlist out of a profile that predates the
+        # link entities (the migration task does this in bulk)
+        elif profile.conferenceKeysToAttend or profile.wishlist:
+            profile = self._migrateProfileTxn(p_key)
+            cache.storeProfile(profile)
+
+        memo[user_id] = profile
         return profile      # return Profile
 
 
+    @staticmethod
+    @ndb.transactional()
+    def _migrateProfileTxn(p_key):
+        """Move a Profile's legacy key lists into Registration/WishlistEntry children."""
+        prof = p_key.get()
+        links = [Registration(key=ndb.Key(Registration, wsck, parent=p_key),
+                              conference=ndb.Key(urlsafe=wsck))
+                 for wsck in prof.conferenceKeysToAttend]
+        links += [WishlistEntry(key=ndb.Key(WishlistEntry, wssk, parent=p_key),
+                                session=ndb.Key(urlsafe=wssk))
+                  for wssk in prof.wishlist]
+        prof.conferenceKeysToAttend = []
+        prof.wishlist = []
+        ndb.put_multi(links + [prof])
+        return prof
+
+
+    @staticmethod
+    def _migrateProfileLinks(cursor=None):
+        """Migrate one batch of Profiles to link entities; used by the
+        migration task. Returns the cursor of the next batch, or None.
+        """
+        p_keys, next_cursor, more = Profile.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        for prof in ndb.get_multi(p_keys):
+            if prof and (prof.conferenceKeysToAttend or prof.wishlist):
+                cache.storeProfile(ConferenceApi._migrateProfileTxn(prof.key))
+        return next_cursor if more else None
+
+
+    @staticmethod
+    @ndb.transactional()
+    def _setOrganizerNameTxn(c_keys, displayName, only_missing=False):
+        """Set organizerDisplayName on Conferences of one organizer (one
+        entity group) that still lack it or have another one, re-reading
+        them so concurrent updates to other fields are kept. Returns the
+        number of Conferences written.
+        """
+        changed = [conf for conf in ndb.get_multi(c_keys)
+                   if conf and conf.organizerDisplayName != displayName and
+                   not (only_missing and conf.organizerDisplayName is not None)]
+        for conf in changed:
+            conf.organizerDisplayName = displayName
+        ndb.put_multi(changed)
+        return len(changed)
+
+
+    @staticmethod
+    def _updateOrganizerNames(user_id, cursor=None):
+        """Copy an organizer's display name onto one batch of their
+        Conferences; used by the fan-out task. Returns the cursor of the
+        next batch, or None.
+        """
+        prof = ndb.Key(Profile, user_id).get()
+        displayName = prof.displayName if prof else None
+        confs, next_cursor, more = Conference.query(
+            ancestor=ndb.Key(Profile, user_id)).fetch_page(
+                MIGRATION_BATCH_SIZE, start_cursor=cursor)
+        stale = [conf.key for conf in confs if conf.organizerDisplayName != displayName]
+        if stale and ConferenceApi._setOrganizerNameTxn(stale, displayName):
+            # cached forms of every one of these conferences are stale now
+            cache.invalidateOrganizer(user_id)
+        return next_cursor if more else None
+
+
+    @staticmethod
+    def _backfillOrganizerNames(cursor=None):
+        """Store organizerDisplayName on one batch of Conferences created
+        before it was denormalized. Returns the cursor of the next batch,
+        or None.
+        """
+        confs, next_cursor, more = Conference.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor)
+        missing = {}
+        for conf in confs:
+            if conf.organizerDisplayName is None:
+                missing.setdefault(conf.key.parent(), []).append(conf.key)
+        profiles = ndb.get_multi(missing.keys())
+        for prof in profiles:
+            # one transaction per organizer, whose conferences share a group
+            if prof and prof.displayName and ConferenceApi._setOrganizerNameTxn(
+                    missing[prof.key], prof.displayName, only_missing=True):
+                cache.invalidateOrganizer(prof.key.id())
+        return next_cursor if more else None
+
+
+    def _profileMemo(self):
+        """Return the per-request Profile memo (a service is built per request)."""
+        if not hasattr(self, '_profiles'):
+            self._profiles = {}
+        return self._profiles
+
+
+    def _saveProfile(self, prof):
+        """Put a Profile and refresh both tiers of the profile cache."""
+        prof.put()
+        cache.storeProfile(prof)
+        self._profileMemo()[prof.key.id()] = prof
+
+
     def _doProfile(self, save_request=None):
         """Get user Profile and return to user, possibly updating it first."""
         # get user Profile
@@ -755,6 +1359,7 @@ class ConferenceApi(remote.Service):
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
+            displayName = prof.displayName
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
                     val = getattr(save_request, field)
@@ -764,7 +1369,11 @@ class ConferenceApi(remote.Service):
                         #    setattr(prof, field, str(val).upper())
                         #else:
                         #    setattr(prof, field, val)
-            prof.put()
+            self._saveProfile(prof)
+            # the user's conferences carry their organizerDisplayName
+            if prof.displayName != displayName:
+                taskqueue.add(params={'organizerUserId': prof.key.id()},
+                              url='/tasks/update_organizer_names')
 
         # return ProfileForm
         return self._copyProfileToForm(prof)
@@ -786,10 +1395,13 @@ class ConferenceApi(remote.Service):
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
-    @ndb.transactional(xg=True)
     def _conferenceRegistration(self, request, reg=True):
-        """Register or unregister user for selected conference."""
-        retval = None
+        """Register or unregister user for selected conference.
+
+        For a conference with an admission queue, registering only queues
+        the request; the result is True once the user is admitted and
+        False while the ticket waits.
+        """
         prof = self._getProfileFromUser() # get user Profile
 
         # check if conf exists given websafeConfKey
@@ -803,59 +1415,147 @@ class ConferenceApi(remote.Service):
         # register
         if reg:
             # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
+            if ndb.Key(Registration, wsck, parent=prof.key).get():
                 raise ConflictException(
                     "You have already registered for this conference")
 
-            # check if seats avail
-            if conf.seatsAvailable <= 0:
+            if conf.admissionQueue:
+                # a queued request is not refused: its status says to
+                # follow the ticket with getAdmissionTicket
+                ticket = admission.enqueue(prof.key, wsck)
+                return BooleanMessage(data=ticket.status == admission.ADMITTED,
+                                      status=ticket.status)
+
+            # try the seat counter shards that still have seats, in random
+            # order, until one of them gives us a seat
+            for shard_key in seats.openShards(conf):
+                try:
+                    retval = self._registrationTxn(prof.key, wsck, shard_key)
+                    break
+                except seats.ShardEmptyError:
+                    continue
+            else:
                 raise ConflictException(
                     "There are no seats available.")
+            if retval:
+                announcements.track(conf, seats.updateCache(conf.key, -1))
+                cache.invalidateConference(wsck)
+                cache.invalidateAttending(prof.key.id())
+
+        # unregister
+        else:
+            if conf.admissionQueue:
+                admission.cancel(prof.key, wsck)
+            seats.ensureShards(conf)
+            retval = self._registrationTxn(prof.key, wsck)
+            if retval:
+                announcements.track(conf, seats.updateCache(conf.key, 1))
+                cache.invalidateConference(wsck)
+                cache.invalidateAttending(prof.key.id())
+
+        return BooleanMessage(data=retval)
+
+
+    @ndb.transactional(xg=True)
+    def _registrationTxn(self, p_key, wsck, shard_key=None):
+        """Move one seat between a counter shard and the user's Registration.
+
+        Registers when a shard_key is given, otherwise unregisters.
+        """
+        r_key = ndb.Key(Registration, wsck, parent=p_key)
+        registration = r_key.get()
+
+        # register
+        if shard_key:
+            # check if user already registered otherwise add
+            if registration:
+                raise ConflictException(
+                    "You have already registered for this conference")
 
             # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
-            conf.seatsAvailable -= 1
-            retval = True
+            seats.takeSeat(shard_key)
+            Registration(key=r_key, conference=ndb.Key(urlsafe=wsck)).put()
 
         # unregister
         else:
             # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
+            if not registration:
+                return False
 
-                # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
-                conf.seatsAvailable += 1
-                retval = True
-            else:
-                retval = False
+            # unregister user, add back one seat
+            r_key.delete()
+            seats.returnSeats(ndb.Key(urlsafe=wsck))
 
-        # write things back to the datastore & return
-        prof.put()
-        conf.put()
-        return BooleanMessage(data=retval)
+        return True
 
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @endpoints.method(CONF_ATTENDING_REQUEST, ConferenceForms,
             path='conferences/attending',
             http_method='GET', name='getConferencesToAttend')
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
-        prof = self._getProfileFromUser() # get user Profile
-        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
 
-        # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
+        # an unchanged page is answered from memcache alone
+        # summaries and full forms, and pages of different sizes, have
+        # different ETags
+        page = '%s:%d:%s' % (request.view or ListView.FULL, self._pageSize(request),
+                             request.pageToken or '')
+        if_none_match = self._ifNoneMatch(request)
+        if if_none_match and if_none_match == cache.cachedAttendingETag(user_id, page):
+            return ConferenceForms(etag=if_none_match, notModified=True)
+        gen = cache.attendingGeneration(user_id)
 
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        prof = self._getProfileFromUser() # get user Profile
+        r_keys, next_token = self._fetchPage(
+            Registration.query(ancestor=prof.key).order(Registration.created),
+            request, keys_only=True)
+        etag = cache.attendingETag(user_id, page, gen,
+                                   [r_key.id() for r_key in r_keys])
+        if etag and etag == if_none_match:
+            return ConferenceForms(etag=etag, notModified=True)
+        conf_keys = [ndb.Key(urlsafe=r_key.id()) for r_key in r_keys]
+        if self._summaryView(request):
+            return ConferenceForms(summaries=self._conferenceSummaries(conf_keys),
+                                   nextPageToken=next_token, etag=etag)
+        conferences, totals = self._conferencesWithSeatsAsync(conf_keys).get_result()
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, names[conf.organizerUserId])\
-         for conf in conferences]
+        return ConferenceForms(
+            items=self._copyConferencesToForms(conferences, totals),
+            nextPageToken=next_token,
+            etag=etag
+        )
+
+
+    @endpoints.method(CONF_ATTENDEES_REQUEST, ProfileForms,
+            path='conference/{websafeConferenceKey}/attendees',
+            http_method='GET', name='getConferenceAttendees')
+    def getConferenceAttendees(self, request):
+        """Get the users registered for a conference (organizer only)."""
+        prof = self._getProfileFromUser() # get user Profile
+        wsck = request.websafeConferenceKey
+        c_key = ndb.Key(urlsafe=wsck)
+        conf = c_key.get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+        if conf.organizerUserId != prof.key.id():
+            raise endpoints.ForbiddenException(
+                'Only the owner can list the attendees.')
+
+        # each Registration is a child of the attendee's Profile
+        r_keys, next_token = self._fetchPage(
+            Registration.query(Registration.conference == c_key).order(Registration.key),
+            request, keys_only=True)
+        profiles = ndb.get_multi([r_key.parent() for r_key in r_keys])
+        return ProfileForms(
+            items=[self._copyProfileToForm(profile, links=False)
+                   for profile in profiles if profile],
+            nextPageToken=next_token
         )
 
 
@@ -874,39 +1574,56 @@ class ConferenceApi(remote.Service):
         """Unregister user for selected conference."""
         return self._conferenceRegistration(request, reg=False)
 
+
+    @endpoints.method(CONF_GET_REQUEST, AdmissionTicketForm,
+            path='conference/{websafeConferenceKey}/admission',
+            http_method='POST', name='requestConferenceAdmission')
+    def requestConferenceAdmission(self, request):
+        """Queue a registration request for a conference's admission queue."""
+        prof = self._getProfileFromUser()
+        wsck = request.websafeConferenceKey
+        conf = ndb.Key(urlsafe=wsck).get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+        if not conf.admissionQueue:
+            raise endpoints.BadRequestException(
+                'This conference does not use an admission queue')
+        return admission.ticketToForm(admission.enqueue(prof.key, wsck))
+
+
+    @endpoints.method(CONF_GET_REQUEST, AdmissionTicketForm,
+            path='conference/{websafeConferenceKey}/admission',
+            http_method='GET', name='getAdmissionTicket')
+    def getAdmissionTicket(self, request):
+        """Return the status of the user's admission ticket for a conference."""
+        prof = self._getProfileFromUser()
+        ticket = admission.getTicket(prof.key, request.websafeConferenceKey)
+        if not ticket:
+            raise endpoints.NotFoundException(
+                'No admission ticket for conference: %s' % request.websafeConferenceKey)
+        return admission.ticketToForm(ticket)
+
 # - - - Announcements - - - - - - - - - - - - - - - - - - - -
 
     @staticmethod
     def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
+        """Check the nearly sold out set & refresh the announcement in
+        memcache; used by memcache cron job.
         """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
-
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = ANNOUNCEMENT_TPL % (
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-        else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
-
-        return announcement
+        return announcements.rebuild()
 
 
-    @endpoints.method(message_types.VoidMessage, StringMessage,
+    @endpoints.method(ANNOUNCEMENT_GET_REQUEST, StringMessage,
             path='conference/announcement/get',
             http_method='GET', name='getAnnouncement')
     def getAnnouncement(self, request):
-        """Return Announcement from memcache."""
-        return StringMessage(data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+        """Return Announcement of nearly sold out conferences."""
+        announcement = announcements.getAnnouncement()
+        etag = cache.makeETag(announcement)
+        if etag == self._ifNoneMatch(request):
+            return StringMessage(data='', etag=etag, notModified=True)
+        return StringMessage(data=announcement, etag=etag)
 
 
-api = endpoints.api_server([ConferenceApi]) # register API
+api = instrument.middleware(endpoints.api_server([ConferenceApi])) # register API
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+"""converters.py
+
+Precompiled entity-to-form converters.
+
+Copying an entity to its ProtoRPC form by looping over all_fields() with
+hasattr/getattr and name tests repeats the same decisions for every
+entity.  A converter makes those decisions once, when it is registered
+at import time, and keeps a flat list of (field name, getter) steps to
+run per entity.
+
+"""
+
+import operator
+
+import instrument
+
+from models import Conference
+from models import ConferenceForm
+from models import ConferenceSummaryForm
+from models import Profile
+from models import ProfileForm
+from models import Session
+from models import SessionForm
+from models import SessionSummaryForm
+from models import TeeShirtSize
+
+# registry of converters by (model class, message class)
+CONVERTERS = {}
+
+
+def _stringify(getter):
+    """Getter converting dates and times to strings, keeping None."""
+    def get(entity):
+        value = getter(entity)
+        return None if value is None else str(value)
+    return get
+
+
+def _enum(getter, enum_cls):
+    """Getter mapping a stored enum name onto enum_cls."""
+    def get(entity):
+        value = getter(entity)
+        return None if value is None else getattr(enum_cls, value)
+    return get
+
+
+def _websafeKey(entity):
+    return entity.key.urlsafe()
+
+
+class Converter(object):
+    """Copies one model class onto one message class."""
+
+    def __init__(self, model_cls, message_cls, strings=(), enums=None):
+        enums = enums or {}
+        self.message_cls = message_cls
+        self.steps = []
+        for field in message_cls.all_fields():
+            name = field.name
+            if name == 'websafeKey':
+                self.steps.append((name, _websafeKey))
+            elif name in model_cls._properties:
+                getter = operator.attrgetter(name)
+                if name in strings:
+                    getter = _stringify(getter)
+                elif name in enums:
+                    getter = _enum(getter, enums[name])
+                self.steps.append((name, getter))
+
+    def __call__(self, entity):
+        """Return a new form for one entity.
+
+        Not timed: one conversion is too cheap to be worth a timer, so
+        only batches (convertMulti) show up under 'convert'.
+        """
+        form = self.message_cls()
+        for name, get in self.steps:
+            value = get(entity)
+            if value is not None:
+                setattr(form, name, value)
+        return form
+
+    def convertMulti(self, entities, keep_missing=False):
+        """Return forms for a batch of entities, timed once for the batch.
+
+        Missing entities are skipped, or with keep_missing give None.
+        """
+        message_cls = self.message_cls
+        steps = self.steps
+        forms = []
+        with instrument.timing('convert'):
+            for entity in entities:
+                if entity is None:
+                    if keep_missing:
+                        forms.append(None)
+                    continue
+                form = message_cls()
+                for name, get in steps:
+                    value = get(entity)
+                    if value is not None:
+                        setattr(form, name, value)
+                forms.append(form)
+        return forms
+
+
+def register(model_cls, message_cls, **options):
+    """Build and register the converter for a (model, message) pair."""
+    converter = Converter(model_cls, message_cls, **options)
+    CONVERTERS[(model_cls, message_cls)] = converter
+    return converter
+
+
+def converterFor(model_cls, message_cls):
+    """Return the registered converter for a (model, message) pair."""
+    return CONVERTERS[(model_cls, message_cls)]
+
+
+CONFERENCE_FORM = register(Conference, ConferenceForm,
+                           strings=('startDate', 'endDate'))
+SESSION_FORM = register(Session, SessionForm,
+                        strings=('date', 'startTime'))
+CONFERENCE_SUMMARY = register(Conference, ConferenceSummaryForm,
+                              strings=('startDate', 'endDate'))
+SESSION_SUMMARY = register(Session, SessionSummaryForm,
+                           strings=('date', 'startTime'))
+PROFILE_FORM = register(Profile, ProfileForm,
+                        enums={'teeShirtSize': TeeShirtSize})
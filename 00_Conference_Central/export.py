@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+
+"""export.py
+
+Bulk export of Conferences, Sessions and Registrations as NDJSON or CSV.
+
+An ExportJob walks each kind with a query cursor, one batch per task:
+every task writes its batch as one chunk file to the job's sink, then
+advances the stored cursor and enqueues the next task in the same
+transaction.  Only one batch is ever held in memory, and a job that
+failed resumes from the last cursor it stored.  Chunks are named by
+kind and sequence number, so a retried task overwrites the chunk it
+wrote before rather than duplicating it.  A manifest listing every chunk
+is written last.
+
+By default chunks are stored as ExportChunk entities under the job and
+downloaded through /admin/export.  They can go to Cloud Storage instead
+when the GoogleAppEngineCloudStorageClient library is vendored in as
+`cloudstorage`, or, for testing, to a local directory.
+
+"""
+
+import csv
+import json
+import os
+import tempfile
+from cStringIO import StringIO
+from datetime import date, datetime, time
+
+try:
+    import cloudstorage
+except ImportError:
+    # only needed by the Cloud Storage sink
+    cloudstorage = None
+
+from google.appengine.api import app_identity
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import ExportChunk
+from models import ExportJob
+from models import Registration
+from models import Session
+from settings import EXPORT_BUCKET
+from settings import EXPORT_LOCAL_DIR
+import seats
+
+EXPORT_URL = '/tasks/export'
+EXPORT_BATCH_SIZE = 200
+# a task that failed this many times fails its job, which can be resumed
+EXPORT_MAX_RETRIES = 5
+
+RUNNING = 'RUNNING'
+DONE = 'DONE'
+FAILED = 'FAILED'
+
+FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+SINKS = ('datastore', 'gcs', 'local')
+
+
+# exported kinds: model, the columns taken from the key (and how), and
+# the properties that follow them
+KINDS = {
+    'Conference': (Conference, ('websafeKey',),
+                   lambda key: [key.urlsafe()],
+                   ('name', 'description', 'organizerUserId', 'organizerDisplayName',
+                    'topics', 'city', 'startDate', 'endDate', 'maxAttendees',
+                    'seatsAvailable', 'admissionQueue')),
+    'Session': (Session, ('websafeKey', 'websafeConferenceKey'),
+                lambda key: [key.urlsafe(), key.parent().urlsafe()],
+                ('name', 'highlights', 'speaker', 'speakerEmail', 'duration',
+                 'typeOfSession', 'date', 'startTime')),
+    # a Registration is keyed by the conference, under the attendee
+    'Registration': (Registration, ('userId', 'websafeConferenceKey'),
+                     lambda key: [key.parent().id(), key.id()],
+                     ('created',)),
+}
+KIND_ORDER = ('Conference', 'Session', 'Registration')
+
+
+# - - - Sinks - - - - - - - - - - - - - - - - - - - - - - - - -
+
+class DatastoreSink(object):
+    """Stores chunks as ExportChunk entities under the job; needs nothing
+    beyond the datastore."""
+
+    def __init__(self, job_key):
+        self.job_key = job_key
+
+    def write(self, name, data, content_type):
+        ExportChunk(key=ndb.Key(ExportChunk, name, parent=self.job_key),
+                    data=data, contentType=content_type).put()
+
+
+def readChunk(job_id, name):
+    """Return a chunk (or the manifest) of a datastore sink job, or None."""
+    return ndb.Key(ExportJob, job_id, ExportChunk, name).get()
+
+
+class LocalFileSink(object):
+    """Writes chunks under a local directory; for tests and the dev server."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def write(self, name, data, content_type):
+        path = os.path.join(self.root, name)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # write then rename, so a chunk is either complete or absent
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+
+
+class GcsSink(object):
+    """Writes chunks to a Cloud Storage bucket."""
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def write(self, name, data, content_type):
+        if cloudstorage is None:
+            raise RuntimeError('The Cloud Storage sink needs the cloudstorage library')
+        with cloudstorage.open('/%s/%s' % (self.bucket, name), 'w',
+                               content_type=content_type) as f:
+            f.write(data)
+
+
+def sinkFor(job):
+    if job.sink == 'datastore':
+        return DatastoreSink(job.key)
+    if job.sink == 'local':
+        return LocalFileSink(EXPORT_LOCAL_DIR)
+    return GcsSink(EXPORT_BUCKET or app_identity.get_default_gcs_bucket_name())
+
+
+# - - - Encoding - - - - - - - - - - - - - - - - - - - - - - - -
+
+def _value(value):
+    """Return a property value in a JSON-serializable form."""
+    if isinstance(value, ndb.Key):
+        return value.urlsafe()
+    if isinstance(value, (date, datetime, time)):
+        return value.isoformat()
+    return value
+
+
+def columns(kind):
+    """Return the column names of a kind's rows."""
+    model, key_names, key_values, fields = KINDS[kind]
+    return list(key_names) + list(fields)
+
+
+def rows(kind, entities):
+    """Yield one list of column values per entity."""
+    model, key_names, key_values, fields = KINDS[kind]
+    totals = {}
+    if kind == 'Conference':
+        # seats live in the sharded counter, not on the entity
+        totals = seats.getSeatsMulti([conf.key for conf in entities])
+    for entity in entities:
+        row = key_values(entity.key)
+        for field in fields:
+            value = getattr(entity, field)
+            if field == 'seatsAvailable' and totals.get(entity.key) is not None:
+                value = totals[entity.key]
+            row.append(_value(value))
+        yield row
+
+
+def encode(kind, entities, fmt):
+    """Encode a batch of entities as one self-contained chunk."""
+    names = columns(kind)
+    out = StringIO()
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(names)
+        for row in rows(kind, entities):
+            writer.writerow([
+                json.dumps(value) if isinstance(value, list) else
+                '' if value is None else
+                value.encode('utf-8') if isinstance(value, unicode) else value
+                for value in row])
+    else:
+        for row in rows(kind, entities):
+            out.write(json.dumps(dict(zip(names, row)), sort_keys=True))
+            out.write('\n')
+    return out.getvalue()
+
+
+def chunkName(job, kind, chunk):
+    return '%s/%s-%05d.%s' % (job.prefix, kind.lower(), chunk, job.format)
+
+
+# - - - Task chain - - - - - - - - - - - - - - - - - - - - - - -
+
+def _enqueueStep(job):
+    """Enqueue the task for the job's current step; transactional when
+    called inside the transaction that stored the step."""
+    taskqueue.add(url=EXPORT_URL, transactional=ndb.in_transaction(),
+                  params={'job': job.key.id(), 'step': job.step})
+
+
+@ndb.transactional()
+def _startTxn(job):
+    job.put()
+    _enqueueStep(job)
+    return job
+
+
+def start(fmt='ndjson', kinds=KIND_ORDER, sink='datastore'):
+    """Start an export job; returns the ExportJob."""
+    if fmt not in FORMATS:
+        raise ValueError('Unknown export format: %s' % fmt)
+    if sink not in SINKS:
+        raise ValueError('Unknown export sink: %s' % sink)
+    if sink == 'gcs' and cloudstorage is None:
+        raise ValueError('The gcs sink needs the cloudstorage library')
+    unknown = [kind for kind in kinds if kind not in KINDS]
+    if unknown:
+        raise ValueError('Cannot export: %s' % ', '.join(unknown))
+    job_id = ExportJob.allocate_ids(size=1)[0]
+    job = ExportJob(key=ndb.Key(ExportJob, job_id), format=fmt, sink=sink,
+                    kinds=list(kinds), written=dict((kind, [0, 0]) for kind in kinds),
+                    prefix='exports/%s-%d' % (
+                        datetime.utcnow().strftime('%Y%m%dT%H%M%S'), job_id))
+    return _startTxn(job)
+
+
+@ndb.transactional()
+def _advanceTxn(job_id, step, next_cursor, rows_written, finished_kind):
+    """Record a written chunk and move the job on to its next step."""
+    job = ndb.Key(ExportJob, job_id).get()
+    if not job or job.status != RUNNING or job.step != step:
+        return None
+    kind = job.kinds[job.kindIndex]
+    if rows_written:
+        chunks, total = job.written.get(kind, [0, 0])
+        job.written[kind] = [chunks + 1, total + rows_written]
+    if finished_kind:
+        job.kindIndex += 1
+        job.cursor = None
+    else:
+        job.cursor = next_cursor.urlsafe()
+    job.step += 1
+    if job.kindIndex >= len(job.kinds):
+        job.status = DONE
+    else:
+        _enqueueStep(job)
+    job.put()
+    return job
+
+
+def manifest(job, written):
+    """Return the manifest of a finished job, listing every chunk."""
+    kinds = {}
+    for kind in job.kinds:
+        chunks, total = written.get(kind, [0, 0])
+        kinds[kind] = {'rows': total, 'columns': columns(kind),
+                       'chunks': [chunkName(job, kind, i) for i in range(chunks)]}
+    return {'job': job.key.id(), 'format': job.format, 'kinds': kinds,
+            'created': job.created.isoformat()}
+
+
+def runStep(job_id, step):
+    """Export one batch of a job; stale or duplicate tasks do nothing."""
+    job = ndb.Key(ExportJob, job_id).get()
+    if not job or job.status != RUNNING or job.step != step:
+        return
+    kind = job.kinds[job.kindIndex]
+    sink = sinkFor(job)
+    entities, next_cursor, more = KINDS[kind][0].query().fetch_page(
+        EXPORT_BATCH_SIZE, start_cursor=Cursor(urlsafe=job.cursor) if job.cursor else None)
+    written = dict(job.written)
+    if entities:
+        chunks, total = written.get(kind, [0, 0])
+        sink.write(chunkName(job, kind, chunks), encode(kind, entities, job.format),
+                   FORMATS[job.format])
+        written[kind] = [chunks + 1, total + len(entities)]
+    finished_kind = not (more and next_cursor)
+    if finished_kind and job.kindIndex == len(job.kinds) - 1:
+        # the manifest goes out before the job is marked done, so a done
+        # job always has one
+        sink.write('%s/manifest.json' % job.prefix,
+                   json.dumps(manifest(job, written), indent=2), 'application/json')
+    _advanceTxn(job_id, step, next_cursor, len(entities), finished_kind)
+
+
+@ndb.transactional()
+def fail(job_id, error):
+    """Mark a job failed; it keeps its cursor for resume()."""
+    job = ndb.Key(ExportJob, job_id).get()
+    if job and job.status == RUNNING:
+        job.status = FAILED
+        job.error = error[:500]
+        job.put()
+
+
+@ndb.transactional()
+def resume(job_id):
+    """Restart a failed job from its last stored cursor; returns the job."""
+    job = ndb.Key(ExportJob, job_id).get()
+    if job and job.status == FAILED:
+        job.status = RUNNING
+        job.error = None
+        # tasks of the failed run, should any still be retrying, are stale
+        job.step += 1
+        job.put()
+        _enqueueStep(job)
+    return job
+
+
+def status(job):
+    """Return a job's progress as a dict."""
+    return {'job': job.key.id(), 'status': job.status, 'format': job.format,
+            'sink': job.sink, 'prefix': job.prefix, 'error': job.error,
+            'kind': job.kinds[job.kindIndex] if job.kindIndex < len(job.kinds) else None,
+            'written': job.written, 'updated': job.updated.isoformat()}
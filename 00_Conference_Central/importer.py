@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+"""importer.py
+
+Bulk import of Conferences from an NDJSON or CSV file, for seeding a
+season of events without calling createConference once per row.
+
+Rows are read from the file one at a time and validated with the same
+defaults and date parsing as createConference.  Conference ids are
+allocated in ranges per organizer.  Each batch is written with one
+put_multi_async, and up to IMPORT_MAX_IN_FLIGHT batches are in flight at
+once.  Seat counter shards are not written: like conferences that
+predate the counter, an imported conference gets them from its
+seatsAvailable on its first registration.  Conferences imported with
+few seats join the nearly sold out announcement.  Confirmation emails
+are only sent when asked for.
+
+"""
+
+import csv
+import json
+import logging
+import time
+
+import endpoints
+from protorpc import messages
+from google.appengine.ext import ndb
+
+from conference import ConferenceApi
+from models import Conference
+from models import ConferenceForm
+from models import Profile
+import announcements
+import notifications
+import textsearch
+
+IMPORT_BATCH_SIZE = 100
+IMPORT_MAX_IN_FLIGHT = 4
+ID_RANGE_SIZE = 1000
+MAX_REPORTED_ERRORS = 100
+FORMATS = ('ndjson', 'csv')
+# the ConferenceForm fields a row may set
+IMPORT_FIELDS = ('name', 'description', 'topics', 'city', 'startDate', 'endDate',
+                 'maxAttendees', 'admissionQueue')
+
+
+class ImportReport(object):
+    """Progress of one import."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.rows = 0
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+
+    def error(self, row, message):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'row': row, 'error': message})
+
+    def asDict(self):
+        elapsed = time.time() - self.started
+        return {'rows': self.rows, 'imported': self.imported, 'failed': self.failed,
+                'errors': self.errors, 'seconds': round(elapsed, 3),
+                'rowsPerSecond': round(self.rows / elapsed, 1) if elapsed else None}
+
+
+class _IdRanges(object):
+    """Hands out Conference ids per organizer from ranges allocated in bulk."""
+
+    def __init__(self):
+        self.ranges = {}
+
+    def nextKey(self, p_key):
+        first, last = self.ranges.get(p_key, (1, 0))
+        if first > last:
+            first, last = Conference.allocate_ids(size=ID_RANGE_SIZE, parent=p_key)
+        self.ranges[p_key] = (first + 1, last)
+        return ndb.Key(Conference, first, parent=p_key)
+
+
+# - - - Parsing - - - - - - - - - - - - - - - - - - - - - - - -
+
+def parseRows(stream, fmt):
+    """Yield (row number, raw row) for each row of the stream, reading it
+    a line at a time.  NDJSON rows are yielded undecoded."""
+    if fmt == 'csv':
+        for number, row in enumerate(csv.DictReader(stream), 1):
+            yield number, row
+    else:
+        for number, line in enumerate(stream, 1):
+            if line.strip():
+                yield number, line
+
+
+def _listValue(value):
+    if isinstance(value, list):
+        return value
+    value = value.strip()
+    if value.startswith('['):
+        return json.loads(value)
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def rowToForm(raw, organizer=None):
+    """Return (ConferenceForm, organizer user id) for one raw row."""
+    row = json.loads(raw) if isinstance(raw, basestring) else raw
+    if not isinstance(row, dict):
+        raise ValueError('a row must be an object')
+    form = ConferenceForm()
+    for name in IMPORT_FIELDS:
+        value = row.get(name)
+        if value in (None, ''):
+            continue
+        field = ConferenceForm.field_by_name(name)
+        if field.repeated:
+            value = _listValue(value)
+        elif isinstance(field, messages.IntegerField):
+            value = int(value)
+        elif isinstance(field, messages.BooleanField):
+            if not isinstance(value, bool):
+                value = str(value).strip().lower() in ('1', 'true', 'yes')
+        if isinstance(value, str):
+            value = value.decode('utf-8')
+        elif isinstance(value, list):
+            value = [item.decode('utf-8') if isinstance(item, str) else item
+                     for item in value]
+        setattr(form, name, value)
+    return form, row.get('organizerUserId') or organizer
+
+
+# - - - Writing - - - - - - - - - - - - - - - - - - - - - - - -
+
+class _Batch(object):
+    """A batch of validated rows and, once written, its Conferences and
+    their put futures."""
+
+    def __init__(self):
+        self.rows = []
+        self.conferences = []
+        self.futures = []
+
+
+def _writeBatch(batch, ids, profiles):
+    """Give every row of the batch a key and start writing them."""
+    missing = list(set(user_id for _, _, _, user_id in batch.rows
+                       if user_id not in profiles))
+    for user_id, prof in zip(missing, ndb.get_multi(
+            [ndb.Key(Profile, user_id) for user_id in missing])):
+        profiles[user_id] = prof
+    conferences = []
+    for number, form, data, user_id in batch.rows:
+        prof = profiles[user_id]
+        data['key'] = ids.nextKey(ndb.Key(Profile, user_id))
+        data['organizerUserId'] = form.organizerUserId = user_id
+        data['organizerDisplayName'] = form.organizerDisplayName = \
+            prof.displayName if prof else None
+        conferences.append(Conference(**data))
+    batch.conferences = conferences
+    batch.futures = ndb.put_multi_async(conferences)
+
+
+def _finishBatch(batch, report, profiles, notify):
+    """Wait for a batch's writes and record how each row fared."""
+    written = []
+    for (number, form, data, user_id), conf, future in zip(
+            batch.rows, batch.conferences, batch.futures):
+        future.wait()
+        if future.get_exception():
+            report.error(number, str(future.get_exception()))
+            continue
+        report.imported += 1
+        written.append(data['key'])
+        if announcements.isNearlySoldOut(conf.seatsAvailable):
+            announcements.track(conf, conf.seatsAvailable)
+        prof = profiles[user_id]
+        if notify and prof and prof.mainEmail:
+            notifications.enqueue(prof.mainEmail,
+                'You created a new Conference!',
+                'Hi, you have created a following '
+                'conference:\r\n\r\n%s' % repr(form)
+            )
+    textsearch.enqueue(written)
+    logging.info('conference import: %d rows read, %d imported, %d failed',
+                 report.rows, report.imported, report.failed)
+
+
+def importConferences(stream, fmt='ndjson', organizer=None, notify=False):
+    """Import Conferences from a stream; returns an ImportReport.
+
+    Rows without an organizerUserId belong to organizer.  With notify,
+    organizers get the confirmation email createConference sends.
+    """
+    if fmt not in FORMATS:
+        raise ValueError('Unknown import format: %s' % fmt)
+    api = ConferenceApi()
+    report = ImportReport()
+    ids = _IdRanges()
+    profiles = {}
+    in_flight = []
+    batch = _Batch()
+    for number, raw in parseRows(stream, fmt):
+        report.rows += 1
+        try:
+            form, user_id = rowToForm(raw, organizer)
+            if not user_id:
+                raise ValueError('no organizerUserId for the row')
+            batch.rows.append((number, form, api._conferenceDataFromForm(form), user_id))
+        except (ValueError, TypeError, messages.ValidationError,
+                endpoints.BadRequestException) as e:
+            report.error(number, str(e))
+            continue
+        if len(batch.rows) >= IMPORT_BATCH_SIZE:
+            _writeBatch(batch, ids, profiles)
+            in_flight.append(batch)
+            batch = _Batch()
+            # keep a bounded number of batches in flight
+            if len(in_flight) >= IMPORT_MAX_IN_FLIGHT:
+                _finishBatch(in_flight.pop(0), report, profiles, notify)
+    if batch.rows:
+        _writeBatch(batch, ids, profiles)
+        in_flight.append(batch)
+    for batch in in_flight:
+        _finishBatch(batch, report, profiles, notify)
+    return report
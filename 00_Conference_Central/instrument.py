@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+"""instrument.py
+
+Per-request instrumentation.  middleware() wraps a WSGI app (the
+endpoints API server or the task handler app) and records, for every
+request, the time spent and calls made per RPC category (datastore_v3,
+memcache, urlfetch, taskqueue, mail, ...) plus any code timed with
+timing().  API proxy hooks see every RPC, so nothing in the handlers has
+to change.
+
+Requests that make more than N_PLUS_ONE_THRESHOLD single-key gets, or
+queries, of one kind are flagged as N+1 patterns.  Stats are aggregated
+per endpoint in memcache for the admin stats handler, and in debug mode
+each response carries its own breakdown in an X-Instrument header.
+
+Other memcache counters can be bumped with count(); a request's counts
+are added up as it runs and written with its stats, in the one RPC
+made at the end of the request.
+
+"""
+
+import contextlib
+import logging
+import os
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+from settings import INSTRUMENT_DEBUG_HEADERS
+
+N_PLUS_ONE_THRESHOLD = 5
+MEMCACHE_STATS_KEY = 'INSTR:%s:%s'
+MEMCACHE_ENDPOINTS_KEY = 'INSTR_ENDPOINTS'
+MEMCACHE_N_PLUS_ONE_KEY = 'INSTR_N_PLUS_ONE:%s'
+STATS_CACHE_TIME = 24 * 60 * 60
+# aggregated per endpoint, plus <category>_us and <category>_calls
+TOTALS = ('requests', 'total_us', 'n_plus_one')
+# the categories reported by getStats(): RPC services plus timing() blocks
+CATEGORIES = ('datastore_v3', 'memcache', 'urlfetch', 'taskqueue', 'mail',
+              'app_identity_service', 'convert')
+# the datastore calls that fetch entities
+_READ_CALLS = ('Get', 'RunQuery')
+
+_local = threading.local()
+_seen_endpoints = set()
+
+
+class Recorder(object):
+    """Timings and call counts of one request."""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started = time.time()
+        self.categories = {}
+        self.reads = {}
+        self.pending = {}
+        self.counters = {}
+
+    def add(self, category, seconds):
+        us, calls = self.categories.get(category, (0, 0))
+        self.categories[category] = (us + int(seconds * 1e6), calls + 1)
+
+    def nPlusOne(self):
+        """Return descriptions of the N+1 patterns seen in this request."""
+        return ['%d x %s %s' % (count, call, kind)
+                for (call, kind), count in sorted(self.reads.items())
+                if count > N_PLUS_ONE_THRESHOLD]
+
+    def header(self):
+        parts = ['total=%.1fms' % ((time.time() - self.started) * 1e3)]
+        parts.extend('%s=%.1fms/%d' % (category, us / 1e3, calls)
+                     for category, (us, calls) in sorted(self.categories.items()))
+        parts.extend('n+1=%s' % pattern for pattern in self.nPlusOne())
+        return '; '.join(parts)
+
+
+def current():
+    """Return the Recorder of the request on this thread, or None."""
+    return getattr(_local, 'recorder', None)
+
+
+@contextlib.contextmanager
+def timing(category):
+    """Record the time spent in a block of code under category."""
+    recorder = current()
+    if recorder is None:
+        yield
+        return
+    started = time.time()
+    try:
+        yield
+    finally:
+        recorder.add(category, time.time() - started)
+
+
+def count(key, delta=1):
+    """Add delta to the memcache counter key once the request ends.
+
+    Outside an instrumented request the counter is offset right away.
+    """
+    recorder = current()
+    if recorder is None:
+        memcache.Client().offset_multi_async({key: delta}, initial_value=0)
+    else:
+        recorder.counters[key] = recorder.counters.get(key, 0) + delta
+
+
+# - - - API proxy hooks - - - - - - - - - - - - - - - - - - - -
+
+def _kind(key):
+    elements = key.path().element_list()
+    return elements[-1].type() if elements else '?'
+
+
+def _preCall(service, call, request, response, rpc):
+    recorder = current()
+    if recorder is not None:
+        recorder.pending[id(rpc)] = time.time()
+
+
+def _postCall(service, call, request, response, rpc):
+    recorder = current()
+    if recorder is None:
+        return
+    started = recorder.pending.pop(id(rpc), None)
+    if started is not None:
+        recorder.add(service, time.time() - started)
+    if service != 'datastore_v3' or call not in _READ_CALLS:
+        return
+    # a loop of single gets (or queries) per kind is the N+1 shape; ndb
+    # batches gets issued together, so those arrive as one multi-key Get
+    if call == 'Get':
+        if request.key_size() != 1:
+            return
+        kind = _kind(request.key(0))
+    else:
+        kind = request.kind()
+    recorder.reads[(call, kind)] = recorder.reads.get((call, kind), 0) + 1
+
+
+def installHooks():
+    """Register the API proxy hooks once per instance."""
+    proxy = apiproxy_stub_map.apiproxy
+    if getattr(proxy, '_instrumented', False):
+        return
+    proxy.GetPreCallHooks().Append('instrument', _preCall)
+    proxy.GetPostCallHooks().Append('instrument', _postCall)
+    proxy._instrumented = True
+
+
+# - - - Aggregation - - - - - - - - - - - - - - - - - - - - - -
+
+def _rememberEndpoint(endpoint):
+    """Add endpoint to the memcache list of instrumented endpoints."""
+    if endpoint in _seen_endpoints:
+        return
+    client = memcache.Client()
+    for _ in range(3):
+        endpoints = client.gets(MEMCACHE_ENDPOINTS_KEY)
+        if endpoints is None:
+            if client.add(MEMCACHE_ENDPOINTS_KEY, [endpoint], time=STATS_CACHE_TIME):
+                break
+            continue
+        if endpoint in endpoints or client.cas(
+                MEMCACHE_ENDPOINTS_KEY, endpoints + [endpoint], time=STATS_CACHE_TIME):
+            break
+    _seen_endpoints.add(endpoint)
+
+
+def record(recorder):
+    """Fold one request into its endpoint's aggregated stats."""
+    deltas = {'requests': 1,
+              'total_us': int((time.time() - recorder.started) * 1e6)}
+    for category, (us, calls) in recorder.categories.items():
+        deltas['%s_us' % category] = us
+        deltas['%s_calls' % category] = calls
+    patterns = recorder.nPlusOne()
+    if patterns:
+        deltas['n_plus_one'] = 1
+        logging.warning('N+1 pattern in %s: %s', recorder.endpoint, ', '.join(patterns))
+        memcache.set(MEMCACHE_N_PLUS_ONE_KEY % recorder.endpoint, patterns,
+                     time=STATS_CACHE_TIME)
+    _rememberEndpoint(recorder.endpoint)
+    offsets = dict((MEMCACHE_STATS_KEY % (recorder.endpoint, name), delta)
+                   for name, delta in deltas.items())
+    offsets.update(recorder.counters)
+    memcache.Client().offset_multi_async(offsets, initial_value=0)
+
+
+def getStats():
+    """Return {endpoint: stats} aggregated since the counters were evicted.
+
+    Times are returned as mean milliseconds per request.
+    """
+    endpoints = memcache.get(MEMCACHE_ENDPOINTS_KEY) or []
+    stats = {}
+    for endpoint in endpoints:
+        prefix = MEMCACHE_STATS_KEY % (endpoint, '')
+        counters = memcache.get_multi(
+            [MEMCACHE_STATS_KEY % (endpoint, name) for name in TOTALS])
+        requests = counters.get(prefix + 'requests', 0)
+        if not requests:
+            continue
+        stats[endpoint] = {
+            'requests': requests,
+            'mean_ms': round(counters.get(prefix + 'total_us', 0) / 1e3 / requests, 3),
+            'n_plus_one_requests': counters.get(prefix + 'n_plus_one', 0),
+            'last_n_plus_one': memcache.get(MEMCACHE_N_PLUS_ONE_KEY % endpoint),
+            'categories': _categoryStats(prefix, requests),
+        }
+    return stats
+
+
+def _categoryStats(prefix, requests):
+    """Return {category: {mean_ms, calls_per_request}} for one endpoint."""
+    names = []
+    for category in CATEGORIES:
+        names.extend([prefix + '%s_us' % category, prefix + '%s_calls' % category])
+    counters = memcache.get_multi(names)
+    stats = {}
+    for category in CATEGORIES:
+        calls = counters.get(prefix + '%s_calls' % category)
+        if calls:
+            stats[category] = {
+                'mean_ms': round(counters.get(prefix + '%s_us' % category, 0)
+                                 / 1e3 / requests, 3),
+                'calls_per_request': round(float(calls) / requests, 2),
+            }
+    return stats
+
+
+# - - - WSGI middleware - - - - - - - - - - - - - - - - - - - -
+
+def _endpointName(environ):
+    """Name a request after its API method or handler path."""
+    path = environ.get('PATH_INFO', '')
+    if path.startswith('/_ah/spi/'):
+        return path[len('/_ah/spi/'):]
+    return path
+
+
+def _debugHeaders():
+    return INSTRUMENT_DEBUG_HEADERS or \
+        os.environ.get('SERVER_SOFTWARE', '').startswith('Development')
+
+
+def middleware(app):
+    """Wrap a WSGI app so every request it serves is instrumented."""
+    installHooks()
+
+    def instrumented(environ, start_response):
+        recorder = _local.recorder = Recorder(_endpointName(environ))
+
+        def startResponse(status, headers, exc_info=None):
+            if _debugHeaders():
+                headers = list(headers) + [('X-Instrument', recorder.header())]
+            return start_response(status, headers, exc_info)
+
+        try:
+            return app(environ, startResponse)
+        finally:
+            _local.recorder = None
+            try:
+                record(recorder)
+            except Exception:
+                logging.exception('could not record instrumentation')
+
+    return instrumented
@@ -12,10 +12,28 @@ created by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import json
+import logging
 import webapp2
 from google.appengine.api import app_identity
 from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 from conference import ConferenceApi
+from models import ExportJob
+from settings import EXPORT_FORMAT
+from settings import EXPORT_SINK
+import admission
+import announcements
+import cache
+import export
+import importer
+import instrument
+import notifications
+import seats
+import speakers
+import textsearch
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
@@ -67,9 +85,233 @@ class SetFeaturedSpeakerHandler(webapp2.RequestHandler):
         self.response.set_status(204)
 
 
-app = webapp2.WSGIApplication([
+class AdjustSeatsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Apply a maxAttendees change to the conference seat counter."""
+        wsck = self.request.get('websafeConferenceKey')
+        c_key = ndb.Key(urlsafe=wsck)
+        seats.adjustSeats(c_key, int(self.request.get('delta')))
+        cache.invalidateConference(wsck)
+        conf = c_key.get()
+        if conf:
+            announcements.track(conf, None)
+        self.response.set_status(204)
+
+
+class ProfileCacheStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Report how profile lookups were answered, per cache tier."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(cache.getProfileCacheStats()))
+
+
+class MigrateProfileLinksHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start moving Profile key lists into link entities."""
+        taskqueue.add(url='/tasks/migrate_profile_links')
+        self.response.write('Profile link migration started.')
+
+    def post(self):
+        """Migrate one batch of Profiles, then chain the next batch."""
+        cursor = self.request.get('cursor')
+        cursor = ConferenceApi._migrateProfileLinks(
+            Cursor(urlsafe=cursor) if cursor else None)
+        if cursor:
+            taskqueue.add(params={'cursor': cursor.urlsafe()},
+                          url='/tasks/migrate_profile_links')
+        self.response.set_status(204)
+
+
+class UpdateOrganizerNamesHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start storing organizer display names on existing Conferences."""
+        taskqueue.add(url='/tasks/update_organizer_names')
+        self.response.write('Organizer name backfill started.')
+
+    def post(self):
+        """Update one batch of one organizer's Conferences (or, without an
+        organizer, of all Conferences), then chain the next batch."""
+        user_id = self.request.get('organizerUserId')
+        cursor = self.request.get('cursor')
+        cursor = Cursor(urlsafe=cursor) if cursor else None
+        if user_id:
+            cursor = ConferenceApi._updateOrganizerNames(user_id, cursor)
+        else:
+            cursor = ConferenceApi._backfillOrganizerNames(cursor)
+        if cursor:
+            taskqueue.add(params={'organizerUserId': user_id,
+                                  'cursor': cursor.urlsafe()},
+                          url='/tasks/update_organizer_names')
+        self.response.set_status(204)
+
+
+class RebuildSpeakersHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start indexing existing Sessions under their Speakers."""
+        taskqueue.add(url='/tasks/rebuild_speakers')
+        self.response.write('Speaker index rebuild started.')
+
+    def post(self):
+        """Index one batch of Sessions, then chain the next batch."""
+        cursor = self.request.get('cursor')
+        cursor = speakers.backfill(Cursor(urlsafe=cursor) if cursor else None)
+        if cursor:
+            taskqueue.add(params={'cursor': cursor.urlsafe()},
+                          url='/tasks/rebuild_speakers')
+        self.response.set_status(204)
+
+
+class InstrumentStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Report per-endpoint RPC timings, call counts and N+1 flags."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(instrument.getStats(), indent=2, sort_keys=True))
+
+
+class IndexDocumentsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Update the search index for the given Conferences or Sessions."""
+        textsearch.indexEntities([ndb.Key(urlsafe=wskey)
+                                  for wskey in self.request.get_all('websafeKey')])
+        self.response.set_status(204)
+
+
+class RebuildSearchHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start indexing existing Conferences and Sessions for search."""
+        for kind in textsearch.MODELS:
+            taskqueue.add(params={'kind': kind}, url='/tasks/rebuild_search')
+        self.response.write('Search index rebuild started.')
+
+    def post(self):
+        """Index one batch of one kind, then chain the next batch."""
+        kind = self.request.get('kind')
+        cursor = self.request.get('cursor')
+        cursor = textsearch.backfill(kind, Cursor(urlsafe=cursor) if cursor else None)
+        if cursor:
+            taskqueue.add(params={'kind': kind, 'cursor': cursor.urlsafe()},
+                          url='/tasks/rebuild_search')
+        self.response.set_status(204)
+
+
+class DrainAdmissionsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Kick a conference's admission drain chain, or run its next step."""
+        wsck = self.request.get('websafeConferenceKey')
+        step = self.request.get('step')
+        if step:
+            admission.drain(wsck, int(step))
+        else:
+            admission.kick(wsck)
+        self.response.set_status(204)
+
+
+class ExportHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start an export job, report (and with resume=1, resume) one, or
+        download one of its chunks (chunk=<name>) from the datastore sink."""
+        job_id = self.request.get('job')
+        chunk_name = self.request.get('chunk')
+        if job_id and chunk_name:
+            chunk = export.readChunk(int(job_id), chunk_name)
+            if not chunk:
+                self.abort(404)
+            self.response.headers['Content-Type'] = str(chunk.contentType)
+            self.response.write(chunk.data)
+            return
+        self.response.headers['Content-Type'] = 'application/json'
+        if job_id:
+            if self.request.get('resume'):
+                job = export.resume(int(job_id))
+            else:
+                job = ndb.Key(ExportJob, int(job_id)).get()
+            if not job:
+                self.abort(404)
+        else:
+            kinds = self.request.get('kinds')
+            try:
+                job = export.start(
+                    self.request.get('format') or EXPORT_FORMAT,
+                    kinds.split(',') if kinds else export.KIND_ORDER,
+                    self.request.get('sink') or EXPORT_SINK)
+            except ValueError as e:
+                self.abort(400, str(e))
+        self.response.write(json.dumps(export.status(job), indent=2, sort_keys=True))
+
+    def post(self):
+        """Export one batch of a job, then chain the next batch."""
+        job_id = int(self.request.get('job'))
+        try:
+            export.runStep(job_id, int(self.request.get('step')))
+        except Exception as e:
+            retries = int(self.request.headers.get('X-AppEngine-TaskRetryCount', 0))
+            if retries < export.EXPORT_MAX_RETRIES:
+                raise
+            # stop retrying; the job can be resumed from its last cursor
+            logging.exception('export job %d failed', job_id)
+            export.fail(job_id, str(e))
+        self.response.set_status(204)
+
+
+class ImportConferencesHandler(webapp2.RequestHandler):
+    def post(self):
+        """Import Conferences from an uploaded NDJSON or CSV file (the
+        'file' field) or the request body, and report how it went."""
+        upload = self.request.POST.get('file')
+        fmt = self.request.get('format')
+        if hasattr(upload, 'file'):
+            stream = upload.file
+            if not fmt and upload.filename:
+                fmt = upload.filename.rsplit('.', 1)[-1].lower()
+        else:
+            stream = self.request.body_file
+        try:
+            report = importer.importConferences(
+                stream, fmt or 'ndjson',
+                organizer=self.request.get('organizerUserId') or None,
+                notify=self.request.get('notify') in ('1', 'true'))
+        except ValueError as e:
+            self.abort(400, str(e))
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(report.asDict(), indent=2, sort_keys=True))
+
+
+class FlushNotificationsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Schedule digests for any recipients left with pending notifications."""
+        notifications.sweep()
+
+    def post(self):
+        """Send one recipient's buffered notifications as a digest."""
+        notifications.flush(self.request.get('recipient'),
+                            self.request.get('digest') or
+                            self.request.headers.get('X-AppEngine-TaskName'),
+                            int(self.request.get('part') or 0))
+        self.response.set_status(204)
+
+
+app = instrument.middleware(webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/crons/flush_notifications', FlushNotificationsHandler),
+    ('/tasks/flush_notifications', FlushNotificationsHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
     ('/tasks/send_session_confirmation_email', SendSessionConfirmationEmailHandler),    
     ('/tasks/set_featured_speaker', SetFeaturedSpeakerHandler),
-], debug=True)
+    ('/tasks/adjust_seats', AdjustSeatsHandler),
+    ('/tasks/drain_admissions', DrainAdmissionsHandler),
+    ('/admin/profile_cache_stats', ProfileCacheStatsHandler),
+    ('/admin/migrate_profile_links', MigrateProfileLinksHandler),
+    ('/tasks/migrate_profile_links', MigrateProfileLinksHandler),
+    ('/admin/update_organizer_names', UpdateOrganizerNamesHandler),
+    ('/tasks/update_organizer_names', UpdateOrganizerNamesHandler),
+    ('/admin/rebuild_speakers', RebuildSpeakersHandler),
+    ('/tasks/rebuild_speakers', RebuildSpeakersHandler),
+    ('/tasks/index_documents', IndexDocumentsHandler),
+    ('/admin/rebuild_search', RebuildSearchHandler),
+    ('/tasks/rebuild_search', RebuildSearchHandler),
+    ('/crons/export', ExportHandler),
+    ('/admin/export', ExportHandler),
+    ('/admin/import_conferences', ImportConferencesHandler),
+    ('/tasks/export', ExportHandler),
+    ('/admin/instrument_stats', InstrumentStatsHandler),
+], debug=True))
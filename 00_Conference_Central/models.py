@@ -21,14 +21,72 @@ class ConflictException(endpoints.ServiceException):
     """ConflictException -- exception mapped to HTTP 409 response"""
     http_status = httplib.CONFLICT
 
+class ServiceUnavailableException(endpoints.ServiceException):
+    """ServiceUnavailableException -- exception mapped to HTTP 503 response"""
+    http_status = httplib.SERVICE_UNAVAILABLE
+
 class Profile(ndb.Model):
     """Profile -- User profile object"""
+    # cached with versioned invalidation by cache.getProfile/storeProfile
+    _use_memcache = False
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
+    # legacy; moved into Registration/WishlistEntry children on first access
     conferenceKeysToAttend = ndb.StringProperty(repeated=True)
     wishlist   = ndb.StringProperty(repeated=True)
 
+class Registration(ndb.Model):
+    """Registration -- user registered for a Conference; child of the
+    Profile, keyed by the conference's websafe key"""
+    conference = ndb.KeyProperty()
+    created    = ndb.DateTimeProperty(auto_now_add=True)
+
+class WishlistEntry(ndb.Model):
+    """WishlistEntry -- Session on a user's wishlist; child of the
+    Profile, keyed by the session's websafe key"""
+    session    = ndb.KeyProperty()
+    created    = ndb.DateTimeProperty(auto_now_add=True)
+
+class AdmissionTicket(ndb.Model):
+    """AdmissionTicket -- queued registration request; child of the
+    Profile, keyed by the conference's websafe key"""
+    conference = ndb.KeyProperty()
+    status     = ndb.StringProperty(default='PENDING')
+    reason     = ndb.StringProperty(indexed=False)
+    created    = ndb.DateTimeProperty(auto_now_add=True)
+    decided    = ndb.DateTimeProperty(indexed=False)
+
+class AdmissionDrain(ndb.Model):
+    """AdmissionDrain -- state of the one drain task chain of a conference's
+    admission queue, keyed by the conference's websafe key"""
+    step       = ndb.IntegerProperty(default=0, indexed=False)
+    active     = ndb.BooleanProperty(default=False, indexed=False)
+    # set when tickets arrived while the chain ran; it looks again before stopping
+    rerun      = ndb.BooleanProperty(default=False, indexed=False)
+    idle       = ndb.IntegerProperty(default=0, indexed=False)
+
+class AdmissionTicketForm(messages.Message):
+    """AdmissionTicketForm -- AdmissionTicket outbound form message"""
+    websafeConferenceKey = messages.StringField(1)
+    status               = messages.StringField(2)
+    reason               = messages.StringField(3)
+    created              = messages.StringField(4)
+
+class Notification(ndb.Model):
+    """Notification -- buffered email, a root entity per notification"""
+    recipient = ndb.StringProperty(required=True)
+    subject = ndb.StringProperty(indexed=False)
+    body = ndb.TextProperty()
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+class NotificationDigest(ndb.Model):
+    """NotificationDigest -- one digest email, keyed by its flush task's
+    digest id; records the notifications it covers and whether it was sent"""
+    notes = ndb.KeyProperty(repeated=True, indexed=False)
+    more = ndb.BooleanProperty(default=False, indexed=False)
+    sent = ndb.BooleanProperty(default=False, indexed=False)
+
 class ProfileMiniForm(messages.Message):
     """ProfileMiniForm -- update Profile form message"""
     displayName = messages.StringField(1)
@@ -42,9 +100,17 @@ class ProfileForm(messages.Message):
     conferenceKeysToAttend = messages.StringField(4, repeated=True)
     wishlist         = messages.StringField(5, repeated=True)
 
+class ProfileForms(messages.Message):
+    """ProfileForms -- multiple Profile outbound form message"""
+    items = messages.MessageField(ProfileForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
 class BooleanMessage(messages.Message):
     """BooleanMessage-- outbound Boolean value message"""
     data = messages.BooleanField(1)
+    # set when data is not the final answer, e.g. PENDING for a queued
+    # registration whose ticket getAdmissionTicket reports on
+    status = messages.StringField(2)
 
 class Conference(ndb.Model):
     """Conference -- Conference object"""
@@ -58,6 +124,14 @@ class Conference(ndb.Model):
     endDate         = ndb.DateProperty()
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
+    # copied from the organizer's Profile so reads need not fetch it
+    organizerDisplayName = ndb.StringProperty(indexed=False)
+    # registrations wait in the admission queue instead of running inline
+    admissionQueue  = ndb.BooleanProperty(default=False)
+
+class SeatShard(ndb.Model):
+    """SeatShard -- one shard of a Conference's available seat counter"""
+    seatsAvailable  = ndb.IntegerProperty(default=0, indexed=False)
 
 #------------session starts
 class Session(ndb.Model):
@@ -71,6 +145,90 @@ class Session(ndb.Model):
     startTime       = ndb.TimeProperty()
     speakerEmail    = ndb.StringProperty(required=True)
 
+class SpeakerSessionCount(ndb.Model):
+    """SpeakerSessionCount -- a Speaker's number of sessions in one Conference"""
+    conference      = ndb.KeyProperty()
+    count           = ndb.IntegerProperty(default=0)
+
+class SpeakerNameSessions(ndb.Model):
+    """SpeakerNameSessions -- sorted keys of a Speaker's sessions given
+    under one speaker name"""
+    name            = ndb.StringProperty()
+    sessionKeys     = ndb.KeyProperty(repeated=True)
+
+class Speaker(ndb.Model):
+    """Speaker -- session speaker keyed by normalized email"""
+    names           = ndb.StringProperty(repeated=True)
+    # sorted, so sessions of one conference are adjacent
+    sessionKeys     = ndb.KeyProperty(repeated=True, indexed=False)
+    conferenceCounts = ndb.LocalStructuredProperty(SpeakerSessionCount, repeated=True)
+    nameSessions    = ndb.LocalStructuredProperty(SpeakerNameSessions, repeated=True)
+
+class SessionBatchResult(messages.Message):
+    """SessionBatchResult -- outcome of one row of a session batch"""
+    index           = messages.IntegerField(1, variant=messages.Variant.INT32)
+    websafeKey      = messages.StringField(2)
+    error           = messages.StringField(3)
+
+class SessionBatchResults(messages.Message):
+    """SessionBatchResults -- per-row outcomes of a session batch"""
+    items = messages.MessageField(SessionBatchResult, 1, repeated=True)
+
+class FeaturedSpeaker(ndb.Model):
+    """FeaturedSpeaker -- a Conference's featured speaker, keyed by the
+    conference's websafe key"""
+    speakerEmail    = ndb.StringProperty(indexed=False)
+    sessionCount    = ndb.IntegerProperty(indexed=False)
+    announcement    = ndb.StringProperty(indexed=False)
+    updated         = ndb.DateTimeProperty(auto_now=True)
+
+class NearlySoldOut(ndb.Model):
+    """NearlySoldOut -- singleton set of conferences with few seats left,
+    mapping websafe conference key to conference name"""
+    conferences     = ndb.JsonProperty(default={})
+    updated         = ndb.DateTimeProperty(auto_now=True)
+
+class PostingShard(ndb.Model):
+    """PostingShard -- one shard of a search term's posting list, keyed
+    '<kind>:<term>:<shard>', mapping websafe document key to term weight"""
+    postings        = ndb.JsonProperty(compressed=True, default={})
+
+class SearchDocument(ndb.Model):
+    """SearchDocument -- the indexed terms of one entity, child of it, with
+    the terms whose posting shards are not yet known to match"""
+    terms           = ndb.JsonProperty(compressed=True, default={})
+    pending         = ndb.JsonProperty(default=[])
+    version         = ndb.IntegerProperty(default=0, indexed=False)
+    removed         = ndb.BooleanProperty(default=False, indexed=False)
+
+class SearchCorpus(ndb.Model):
+    """SearchCorpus -- number of indexed documents of a kind, keyed by kind"""
+    docCount        = ndb.IntegerProperty(default=0, indexed=False)
+
+class ExportJob(ndb.Model):
+    """ExportJob -- one bulk export run; its task chain resumes from the
+    kind and cursor stored here"""
+    status          = ndb.StringProperty(default='RUNNING')
+    format          = ndb.StringProperty(indexed=False)
+    sink            = ndb.StringProperty(indexed=False)
+    prefix          = ndb.StringProperty(indexed=False)
+    kinds           = ndb.StringProperty(repeated=True, indexed=False)
+    kindIndex       = ndb.IntegerProperty(default=0, indexed=False)
+    cursor          = ndb.StringProperty(indexed=False)
+    # every task runs one step; a task for any other step is stale
+    step            = ndb.IntegerProperty(default=0, indexed=False)
+    # {kind: [chunks written, rows written]}
+    written         = ndb.JsonProperty(default={})
+    error           = ndb.StringProperty(indexed=False)
+    created         = ndb.DateTimeProperty(auto_now_add=True)
+    updated         = ndb.DateTimeProperty(auto_now=True)
+
+class ExportChunk(ndb.Model):
+    """ExportChunk -- one chunk file of an export in the datastore sink;
+    child of the ExportJob, keyed by the chunk name"""
+    data            = ndb.BlobProperty(compressed=True)
+    contentType     = ndb.StringProperty(indexed=False)
+
 class SessionForm(messages.Message):
     """ConferenceForm -- Conference outbound form message"""
     name            = messages.StringField(1)
@@ -85,9 +243,21 @@ class SessionForm(messages.Message):
     speakerEmail    = messages.StringField(9)
     
 
+class SessionSummaryForm(messages.Message):
+    """SessionSummaryForm -- Session outbound list-view message"""
+    name            = messages.StringField(1)
+    date            = messages.StringField(2)
+    startTime       = messages.StringField(3)
+    typeOfSession   = messages.StringField(4)
+    speaker         = messages.StringField(5)
+    websafeKey      = messages.StringField(6)
+
 class SessionForms(messages.Message):
     """SessionForms - multiple Session outbound form message"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    debug = messages.StringField(3)
+    summaries = messages.MessageField(SessionSummaryForm, 4, repeated=True)
 
     
 #------------session ends
@@ -106,10 +276,31 @@ class ConferenceForm(messages.Message):
     endDate         = messages.StringField(10) #DateTimeField()
     websafeKey      = messages.StringField(11)
     organizerDisplayName = messages.StringField(12)
-    
+    etag            = messages.StringField(13)
+    notModified     = messages.BooleanField(14)
+    admissionQueue  = messages.BooleanField(15)
+
+class ConferenceSummaryForm(messages.Message):
+    """ConferenceSummaryForm -- Conference outbound list-view message"""
+    name            = messages.StringField(1)
+    city            = messages.StringField(2)
+    startDate       = messages.StringField(3)
+    endDate         = messages.StringField(4)
+    seatsAvailable  = messages.IntegerField(5, variant=messages.Variant.INT32)
+    websafeKey      = messages.StringField(6)
+
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    etag = messages.StringField(3)
+    notModified = messages.BooleanField(4)
+    summaries = messages.MessageField(ConferenceSummaryForm, 5, repeated=True)
+
+class ListView(messages.Enum):
+    """ListView -- FULL forms or SUMMARY forms from list endpoints"""
+    FULL = 1
+    SUMMARY = 2
 
 class TeeShirtSize(messages.Enum):
     """TeeShirtSize -- t-shirt size enumeration value"""
@@ -138,10 +329,29 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2, variant=messages.Variant.INT32)
+    pageToken = messages.StringField(3)
+    view = messages.EnumField(ListView, 4)
+
+class SessionQueryForm(messages.Message):
+    """SessionQueryForm -- Session query inbound form message"""
+    field = messages.StringField(1)
+    operator = messages.StringField(2)
+    value = messages.StringField(3)
+
+class SessionQueryForms(messages.Message):
+    """SessionQueryForms -- multiple SessionQueryForm inbound form message"""
+    filters = messages.MessageField(SessionQueryForm, 1, repeated=True)
+    websafeConferenceKey = messages.StringField(2)
+    pageSize = messages.IntegerField(3, variant=messages.Variant.INT32)
+    pageToken = messages.StringField(4)
+    view = messages.EnumField(ListView, 5)
 
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
     data = messages.StringField(1, required=True)
+    etag = messages.StringField(2)
+    notModified = messages.BooleanField(3)
 
 class SpeakerName(messages.Message):
     """StringMessage-- outbound (single) string message"""
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+"""notifications.py
+
+Coalescing notification dispatcher for confirmation emails.
+
+Events are buffered as Notification entities and sent as one digest per
+recipient when the recipient's flush window closes.  Each notification
+is a root entity carrying its recipient, so a burst of events for one
+recipient is not throttled by a shared entity group.  Each window has one
+named flush task, so however many events arrive within the window they
+enqueue a single task and send a single email.
+
+A flush first records the notifications it covers in a
+NotificationDigest named after its task, and marks that digest sent in a
+transaction before handing it to the mail API.  A retried task finds the
+digest and only finishes deleting its notifications, so a digest is not
+sent twice.
+
+"""
+
+import hashlib
+import time
+
+from google.appengine.api import app_identity
+from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Notification
+from models import NotificationDigest
+from settings import NOTIFICATION_FLUSH_WINDOW
+
+FLUSH_URL = '/tasks/flush_notifications'
+# notifications sent in one digest; the rest go in a follow-up flush
+MAX_DIGEST_ITEMS = 100
+# recipients flushed per run of the safety-net cron
+MAX_RECIPIENTS_PER_SWEEP = 200
+DIGEST_SUBJECT_TPL = '%d updates from Conference Central'
+
+
+def _scheduleFlush(recipient, now=None):
+    """Enqueue the flush task of the recipient's current window, once."""
+    now = now or time.time()
+    window = int(now // NOTIFICATION_FLUSH_WINDOW)
+    name = 'digest-%s-%d' % (hashlib.md5(recipient.encode('utf-8')).hexdigest(), window)
+    _addFlushTask(name, recipient, name, 0,
+                  countdown=(window + 1) * NOTIFICATION_FLUSH_WINDOW - now)
+
+
+def _addFlushTask(name, recipient, digest, part, countdown=0):
+    try:
+        taskqueue.add(name=name, url=FLUSH_URL, countdown=countdown,
+                      params={'recipient': recipient, 'digest': digest, 'part': part})
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        # another event, or an earlier try of this task, already scheduled it
+        pass
+
+
+def enqueue(recipient, subject, body):
+    """Buffer one notification for recipient."""
+    Notification(recipient=recipient, subject=subject, body=body).put()
+    _scheduleFlush(recipient)
+
+
+@ndb.transactional()
+def _createDigestTxn(d_key, note_keys, more):
+    """Return the digest of d_key, recording note_keys in it if it is new."""
+    digest = d_key.get()
+    if not digest:
+        digest = NotificationDigest(key=d_key, notes=note_keys, more=more)
+        digest.put()
+    return digest
+
+
+@ndb.transactional()
+def _markSentTxn(d_key, sent):
+    """Set a digest's sent flag; returns False if it already had that value."""
+    digest = d_key.get()
+    if digest.sent == sent:
+        return False
+    digest.sent = sent
+    digest.put()
+    return True
+
+
+def flush(recipient, digest=None, part=0):
+    """Send the recipient's buffered notifications as one digest email.
+
+    digest and part name the digest, and stay the same when the task is
+    retried.  Returns the number of notifications sent.
+    """
+    d_key = ndb.Key(NotificationDigest, '%s-%d' % (digest or recipient, part))
+    d = d_key.get()
+    if not d:
+        # eventually consistent: a note that is not visible yet goes out
+        # with the next window's digest, or the sweep's
+        note_keys = Notification.query(Notification.recipient == recipient).order(
+            Notification.created).fetch(MAX_DIGEST_ITEMS + 1, keys_only=True)
+        if not note_keys:
+            return 0
+        d = _createDigestTxn(d_key, note_keys[:MAX_DIGEST_ITEMS],
+                             len(note_keys) > MAX_DIGEST_ITEMS)
+
+    # notes already gone were sent with another digest
+    notes = [n for n in ndb.get_multi(d.notes) if n]
+    sent = 0
+    if notes and _markSentTxn(d_key, True):
+        if len(notes) == 1:
+            subject = notes[0].subject
+        else:
+            subject = DIGEST_SUBJECT_TPL % len(notes)
+        try:
+            mail.send_mail(
+                'noreply@%s.appspotmail.com' % (
+                    app_identity.get_application_id()),     # from
+                recipient,                                  # to
+                subject,                                    # subj
+                '\r\n\r\n'.join('%s\r\n%s' % (n.subject, n.body) for n in notes)
+            )
+        except Exception:
+            # not sent after all; the retry may send it
+            _markSentTxn(d_key, False)
+            raise
+        sent = len(notes)
+    ndb.delete_multi(d.notes)
+    if d.more and digest:
+        _addFlushTask('%s-%d' % (digest, part + 1), recipient, digest, part + 1)
+    elif d.more:
+        taskqueue.add(url=FLUSH_URL, params={'recipient': recipient})
+    d_key.delete()
+    return sent
+
+
+def sweep():
+    """Schedule a flush for every recipient with pending notifications.
+
+    Used by the cron job to catch notifications whose flush task could
+    not be enqueued.
+    """
+    recipients = [note.recipient for note in Notification.query(
+        projection=[Notification.recipient], distinct=True).fetch(
+            MAX_RECIPIENTS_PER_SWEEP)]
+    for recipient in recipients:
+        _scheduleFlush(recipient)
+    return len(recipients)
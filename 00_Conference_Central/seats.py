@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+"""seats.py
+
+Sharded seat counter for conference registration.
+
+A conference's available seats are spread over NUM_SHARDS root SeatShard
+entities, so concurrent registrations write to different entity groups
+instead of all contending on the Conference entity.  No shard ever goes
+below zero, so the conference can never be oversold.
+
+"""
+
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import SeatShard
+
+NUM_SHARDS = 20
+MEMCACHE_SEATS_KEY = 'SEATS:%s'
+# aggregated totals may lag a concurrent writer by at most this many seconds
+SEATS_CACHE_TIME = 60
+
+
+class ShardEmptyError(Exception):
+    """Raised inside a registration transaction when the chosen shard is empty."""
+
+
+def shardKeys(c_key):
+    """Return the SeatShard keys of a conference."""
+    wsck = c_key.urlsafe()
+    return [ndb.Key(SeatShard, '%s:%d' % (wsck, i)) for i in range(NUM_SHARDS)]
+
+
+@ndb.transactional(xg=True)
+def initSeats(c_key, seats):
+    """Spread seats evenly over the conference shards; no-op if they exist."""
+    keys = shardKeys(c_key)
+    if any(ndb.get_multi(keys)):
+        return
+    per_shard, extra = divmod(max(seats or 0, 0), NUM_SHARDS)
+    ndb.put_multi([SeatShard(key=key, seatsAvailable=per_shard + (i < extra))
+                   for i, key in enumerate(keys)])
+
+
+@ndb.tasklet
+def getSeatsMultiAsync(c_keys):
+    """Return {conference key: available seats} for the given conferences.
+
+    Totals are read from memcache, falling back to one get_multi over the
+    shards of every missing conference.  Conferences whose shards have not
+    been created yet map to None.  A tasklet, so the lookups can overlap
+    with other RPCs of the request.
+    """
+    ctx = ndb.get_context()
+    c_keys = list(set(c_keys))
+    cached = yield [ctx.memcache_get(MEMCACHE_SEATS_KEY % c_key.urlsafe())
+                    for c_key in c_keys]
+    totals = dict((c_key, total) for c_key, total in zip(c_keys, cached)
+                  if total is not None)
+
+    missing = [c_key for c_key in c_keys if c_key not in totals]
+    if missing:
+        shards = yield ndb.get_multi_async(
+            [key for c_key in missing for key in shardKeys(c_key)])
+        adds = []
+        for i, c_key in enumerate(missing):
+            conf_shards = shards[i * NUM_SHARDS:(i + 1) * NUM_SHARDS]
+            if not any(conf_shards):
+                totals[c_key] = None
+                continue
+            totals[c_key] = sum(shard.seatsAvailable for shard in conf_shards if shard)
+            adds.append(ctx.memcache_add(MEMCACHE_SEATS_KEY % c_key.urlsafe(),
+                                         totals[c_key], time=SEATS_CACHE_TIME))
+        yield adds
+    raise ndb.Return(totals)
+
+
+def getSeatsMulti(c_keys):
+    """Return {conference key: available seats}; see getSeatsMultiAsync."""
+    return getSeatsMultiAsync(c_keys).get_result()
+
+
+def getSeats(conf):
+    """Return the available seats of a Conference."""
+    seats = getSeatsMulti([conf.key])[conf.key]
+    if seats is None:
+        seats = conf.seatsAvailable
+    return seats
+
+
+def ensureShards(conf):
+    """Create shards for a conference that predates the sharded counter."""
+    if not any(ndb.get_multi(shardKeys(conf.key))):
+        initSeats(conf.key, conf.seatsAvailable)
+
+
+def openShards(conf):
+    """Return the keys of shards that still have seats, in random order."""
+    shards = ndb.get_multi(shardKeys(conf.key))
+    if not any(shards):
+        initSeats(conf.key, conf.seatsAvailable)
+        shards = ndb.get_multi(shardKeys(conf.key))
+    keys = [shard.key for shard in shards if shard and shard.seatsAvailable > 0]
+    random.shuffle(keys)
+    return keys
+
+
+def takeSeat(shard_key):
+    """Take one seat from a shard; must run inside a transaction."""
+    shard = shard_key.get()
+    if not shard or shard.seatsAvailable <= 0:
+        raise ShardEmptyError(shard_key.id())
+    shard.seatsAvailable -= 1
+    shard.put()
+
+
+def returnSeats(c_key, count=1):
+    """Give seats back to a random shard; must run inside a transaction."""
+    shard_key = random.choice(shardKeys(c_key))
+    shard = shard_key.get() or SeatShard(key=shard_key)
+    shard.seatsAvailable += count
+    shard.put()
+
+
+def updateCache(c_key, delta):
+    """Apply a committed seat change to the cached total, if there is one."""
+    key = MEMCACHE_SEATS_KEY % c_key.urlsafe()
+    if delta < 0:
+        return memcache.decr(key, -delta)
+    return memcache.incr(key, delta)
+
+
+def adjustSeats(c_key, delta):
+    """Add (or, for a negative delta, remove) seats, e.g. after maxAttendees changes.
+
+    Seats are removed from whichever shards still have them; the total is
+    never taken below zero.
+    """
+    if delta > 0:
+        _spreadSeatsTxn(c_key, delta)
+    else:
+        remaining = -delta
+        for shard_key in shardKeys(c_key):
+            if remaining <= 0:
+                break
+            remaining -= ndb.transaction(lambda: _drainShard(shard_key, remaining))
+    memcache.delete(MEMCACHE_SEATS_KEY % c_key.urlsafe())
+
+
+@ndb.transactional(xg=True)
+def _spreadSeatsTxn(c_key, seats):
+    """Add seats evenly over all the conference shards, as initSeats
+    spreads them, so no shard is left to take every registration.
+
+    NUM_SHARDS root entities stay within the cross-group transaction limit.
+    """
+    keys = shardKeys(c_key)
+    shards = [shard or SeatShard(key=key) for key, shard in zip(keys, ndb.get_multi(keys))]
+    per_shard, extra = divmod(seats, NUM_SHARDS)
+    # the odd seats go to random shards, so small increases do not all
+    # land on the first ones
+    lucky = set(random.sample(range(NUM_SHARDS), extra))
+    for i, shard in enumerate(shards):
+        shard.seatsAvailable += per_shard + (i in lucky)
+    ndb.put_multi(shards)
+
+
+def _drainShard(shard_key, count):
+    """Take up to count seats from one shard, returning how many were taken."""
+    shard = shard_key.get()
+    if not shard:
+        return 0
+    taken = min(count, shard.seatsAvailable)
+    shard.seatsAvailable -= taken
+    shard.put()
+    return taken
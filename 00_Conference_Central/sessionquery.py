@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+"""sessionquery.py
+
+Session query engine used by querySessions.
+
+The datastore allows one inequality filter per query, and an ancestor
+query with an inequality also needs a composite index.  The planner
+pushes the single most selective filter the indexes can serve to the
+datastore.  It applies every other filter in memory while streaming the
+results over a cursor.
+
+"""
+
+from datetime import datetime
+import operator
+
+import endpoints
+
+from models import Session
+
+OPERATORS = {
+            'EQ':   '=',
+            'GT':   '>',
+            'GTEQ': '>=',
+            'LT':   '<',
+            'LTEQ': '<=',
+            'NE':   '!='
+            }
+
+FIELDS =    {
+            'NAME': 'name',
+            'SPEAKER': 'speaker',
+            'SPEAKER_EMAIL': 'speakerEmail',
+            'TYPE': 'typeOfSession',
+            'DURATION': 'duration',
+            'DATE': 'date',
+            'START_TIME': 'startTime',
+            }
+
+# rough selectivity of each field, most selective first
+SELECTIVITY = ['speakerEmail', 'name', 'speaker', 'date', 'startTime',
+               'typeOfSession', 'duration']
+
+# inequality filters that have an ancestor composite index in index.yaml
+ANCESTOR_INEQUALITY_INDEXES = ('startTime',)
+
+# upper bound on entities read while filling one page
+MAX_SCAN = 1000
+
+_FILTERS = {
+    '=':  operator.eq,
+    '>':  operator.gt,
+    '>=': operator.ge,
+    '<':  operator.lt,
+    '<=': operator.le,
+}
+
+_COMPARE = {
+    '=':  lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '>':  lambda a, b: a is not None and a > b,
+    '>=': lambda a, b: a is not None and a >= b,
+    '<':  lambda a, b: a is not None and a < b,
+    '<=': lambda a, b: a is not None and a <= b,
+}
+
+
+def parseFilters(filters):
+    """Parse, check validity and format user supplied filters."""
+    formatted_filters = []
+    for f in filters:
+        try:
+            field = FIELDS[f.field]
+            operator = OPERATORS[f.operator]
+        except KeyError:
+            raise endpoints.BadRequestException("Filter contains invalid field or operator.")
+        try:
+            if field == 'date':
+                value = datetime.strptime(f.value[:10], "%Y-%m-%d").date()
+            elif field == 'startTime':
+                value = datetime.strptime(f.value, "%H:%M").time()
+            else:
+                value = f.value
+        except (TypeError, ValueError):
+            raise endpoints.BadRequestException(
+                "Filter value '%s' is invalid for %s." % (f.value, f.field))
+        formatted_filters.append({'field': field, 'operator': operator, 'value': value})
+    return formatted_filters
+
+
+def _indexable(filtr, ancestor):
+    """Can the datastore serve this filter with the existing indexes?"""
+    if filtr['operator'] == '=':
+        # equality with or without an ancestor uses the built-in indexes
+        return True
+    if filtr['operator'] == '!=':
+        # runs as two queries, which cannot share a cursor
+        return False
+    return ancestor is None or filtr['field'] in ANCESTOR_INEQUALITY_INDEXES
+
+
+def plan(filters, ancestor=None):
+    """Split filters into (pushed, residual); pushed is the one filter to
+    give the datastore, or None.
+    """
+    candidates = [f for f in filters if _indexable(f, ancestor)]
+    # equality beats inequality, then the most selective field wins
+    candidates.sort(key=lambda f: (f['operator'] != '=', SELECTIVITY.index(f['field'])))
+    pushed = candidates[0] if candidates else None
+    residual = [f for f in filters if f is not pushed]
+    return pushed, residual
+
+
+def buildQuery(pushed, ancestor=None):
+    """Return the datastore query for the pushed filter."""
+    q = Session.query(ancestor=ancestor)
+    if pushed:
+        prop = getattr(Session, pushed['field'])
+        q = q.filter(_FILTERS[pushed['operator']](prop, pushed['value']))
+        if pushed['operator'] != '=':
+            # an inequality must be the first sort order
+            q = q.order(prop)
+    # tie-break on key so the cursor is stable
+    return q.order(Session.key)
+
+
+def matches(ses, residual):
+    """Does a session satisfy every residual filter?"""
+    for filtr in residual:
+        if not _COMPARE[filtr['operator']](getattr(ses, filtr['field']), filtr['value']):
+            return False
+    return True
+
+
+def describe(pushed, residual, scanned):
+    """Return a one-line description of the plan for the debug field."""
+    def fmt(filtr):
+        return '%s %s %s' % (filtr['field'], filtr['operator'], filtr['value'])
+    return 'index: %s; residual: %s; scanned: %d' % (
+        fmt(pushed) if pushed else 'none',
+        ', '.join(fmt(f) for f in residual) or 'none',
+        scanned)
+
+
+def run(filters, ancestor, page_size, cursor=None):
+    """Run a session query, returning (sessions, next_cursor, debug).
+
+    Reads at most MAX_SCAN entities; a page can come back short when the
+    residual filters reject most of them, with next_cursor set to resume.
+    """
+    pushed, residual = plan(filters, ancestor)
+    it = buildQuery(pushed, ancestor).iter(start_cursor=cursor, produce_cursors=True,
+                                           batch_size=page_size)
+    sessions = []
+    scanned = 0
+    next_cursor = None
+    for ses in it:
+        scanned += 1
+        if matches(ses, residual):
+            sessions.append(ses)
+        if len(sessions) >= page_size or scanned >= MAX_SCAN:
+            if it.probably_has_next():
+                next_cursor = it.cursor_after()
+            break
+    return sessions, next_cursor, describe(pushed, residual, scanned)
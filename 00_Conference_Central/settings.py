@@ -14,3 +14,26 @@ created/forked from conference.py by wesc on 2014 may 24
 # Console or Cloud Console.
 WEB_CLIENT_ID = '595535454840-7b1u559787o625a9t5he8k6dlg53hvmf.apps.googleusercontent.com'
 
+
+# Confirmation emails are buffered per recipient and sent as one digest
+# at the end of each window of this many seconds.
+NOTIFICATION_FLUSH_WINDOW = 300
+
+# Attach each request's RPC timing breakdown as an X-Instrument response
+# header (always on under the development server).
+INSTRUMENT_DEBUG_HEADERS = False
+
+# Answer OAuth tokeninfo lookups locally instead of calling Google, for
+# offline testing: tokens of the form 'stub:<user_id>[:<expires_in>]'
+# are valid, every other token is rejected.
+TOKENINFO_STUB = False
+
+# Bulk exports: 'datastore' stores chunks as ExportChunk entities,
+# downloaded through /admin/export; 'gcs' writes them to EXPORT_BUCKET
+# (the app's default bucket when None) and needs the cloudstorage client
+# library vendored in; 'local' writes them under EXPORT_LOCAL_DIR, which
+# only works on the development server.
+EXPORT_SINK = 'datastore'
+EXPORT_FORMAT = 'ndjson'
+EXPORT_BUCKET = None
+EXPORT_LOCAL_DIR = '/tmp/conference-exports'
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+"""speakers.py
+
+Speaker index: one Speaker entity per normalized speaker email, holding
+the sorted keys of that speaker's sessions, the same keys split by the
+speaker name each session was given under, and their session count per
+conference.  It is maintained as sessions are created, so speaker
+lookups are a keyed get plus one get_multi of a page of keys instead of
+a global query.
+
+"""
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import FeaturedSpeaker
+from models import Session
+from models import Speaker
+from models import SpeakerNameSessions
+from models import SpeakerSessionCount
+
+BACKFILL_BATCH_SIZE = 100
+MEMCACHE_FEATURED_KEY = 'FEATURED_SPEAKER:%s'
+# sessions a speaker needs in one conference to be featured there
+FEATURED_MIN_SESSIONS = 2
+FEATURED_TPL = '%s speaks at %s in conference %s'
+
+
+def normalizeEmail(email):
+    """Return the canonical form of a speaker email."""
+    return (email or '').strip().lower()
+
+
+def speakerKey(email):
+    """Return the Speaker key for an email address."""
+    return ndb.Key(Speaker, normalizeEmail(email))
+
+
+def indexSessions(sp_key, sessions):
+    """Add sessions of one speaker to the index and return the Speaker.
+
+    Call inside a transaction; sessions already indexed are skipped, but
+    still filed under their name if they are not yet.
+    """
+    return indexSessionsAsync(sp_key, sessions).get_result()
+
+
+@ndb.tasklet
+def indexSessionsAsync(sp_key, sessions):
+    """Async version of indexSessions."""
+    speaker = (yield sp_key.get_async()) or Speaker(key=sp_key)
+    known = set(speaker.sessionKeys)
+    counts = dict((c.conference, c) for c in speaker.conferenceCounts)
+    by_name = dict((n.name, n) for n in speaker.nameSessions)
+    for ses in sessions:
+        if ses.speaker:
+            if ses.speaker not in by_name:
+                by_name[ses.speaker] = SpeakerNameSessions(name=ses.speaker)
+            if ses.key not in by_name[ses.speaker].sessionKeys:
+                by_name[ses.speaker].sessionKeys.append(ses.key)
+        if ses.key in known:
+            continue
+        known.add(ses.key)
+        speaker.sessionKeys.append(ses.key)
+        if ses.speaker and ses.speaker not in speaker.names:
+            speaker.names.append(ses.speaker)
+        c_key = ses.key.parent()
+        if c_key not in counts:
+            counts[c_key] = SpeakerSessionCount(conference=c_key, count=0)
+        counts[c_key].count += 1
+    speaker.sessionKeys.sort(key=lambda key: key.pairs())
+    speaker.conferenceCounts = sorted(counts.values(),
+                                      key=lambda c: c.conference.pairs())
+    for n in by_name.values():
+        n.sessionKeys.sort(key=lambda key: key.pairs())
+    speaker.nameSessions = sorted(by_name.values(), key=lambda n: n.name)
+    yield speaker.put_async()
+    raise ndb.Return(speaker)
+
+
+def sessionCount(speaker, c_key):
+    """Return how many sessions a speaker has in one conference."""
+    for c in speaker.conferenceCounts:
+        if c.conference == c_key:
+            return c.count
+    return 0
+
+
+def nameSessionKeys(speaker, name):
+    """Return the sorted keys of a Speaker's sessions given under name."""
+    for n in speaker.nameSessions:
+        if n.name == name:
+            return n.sessionKeys
+    return []
+
+
+def sessionKeysByName(name, speaker=None):
+    """Return the sorted keys of the sessions given under exactly this
+    speaker name, by one speaker or by every speaker known by it.
+
+    Only keys are read, so the result can be paged before any session is
+    fetched.
+    """
+    if speaker is not None:
+        return nameSessionKeys(speaker, name)
+    keys = set()
+    for sp in Speaker.query(Speaker.names == name):
+        keys.update(nameSessionKeys(sp, name))
+    return sorted(keys, key=lambda key: key.pairs())
+
+
+def updateFeatured(wsck, name, email, confName):
+    """Reconsider a speaker for a conference's featured speaker.
+
+    Uses the speaker's per-conference session count from the index, so no
+    session query is needed.  Returns the new announcement, or '' if the
+    speaker did not become featured.
+    """
+    c_key = ndb.Key(urlsafe=wsck)
+    speaker = speakerKey(email).get()
+    if not speaker:
+        return ''
+    count = sessionCount(speaker, c_key)
+    if count < FEATURED_MIN_SESSIONS:
+        return ''
+
+    s_keys = [key for key in speaker.sessionKeys if key.parent() == c_key]
+    announcement = FEATURED_TPL % (
+        name, ', '.join(ses.name for ses in ndb.get_multi(s_keys) if ses), confName)
+    featured = _setFeaturedTxn(wsck, speaker.key.id(), count, announcement)
+    memcache.set(MEMCACHE_FEATURED_KEY % wsck, featured.announcement)
+    if featured.speakerEmail != speaker.key.id():
+        return ''
+    return announcement
+
+
+@ndb.transactional()
+def _setFeaturedTxn(wsck, email, count, announcement):
+    """Make email the featured speaker unless another one has more sessions."""
+    key = ndb.Key(FeaturedSpeaker, wsck)
+    featured = key.get()
+    if featured and featured.speakerEmail != email and featured.sessionCount > count:
+        return featured
+    featured = FeaturedSpeaker(key=key, speakerEmail=email, sessionCount=count,
+                               announcement=announcement)
+    featured.put()
+    return featured
+
+
+def getFeatured(wsck):
+    """Return a conference's featured speaker announcement, or ''.
+
+    Rebuilt from the FeaturedSpeaker entity when memcache has evicted it.
+    """
+    announcement = memcache.get(MEMCACHE_FEATURED_KEY % wsck)
+    if announcement is None:
+        featured = ndb.Key(FeaturedSpeaker, wsck).get()
+        announcement = featured.announcement if featured else ''
+        memcache.set(MEMCACHE_FEATURED_KEY % wsck, announcement)
+    return announcement
+
+
+def getLatestFeatured():
+    """Return the most recently featured speaker announcement, or ''."""
+    featured = FeaturedSpeaker.query().order(-FeaturedSpeaker.updated).get()
+    return featured.announcement if featured else ''
+
+
+def backfill(cursor=None):
+    """Index one batch of existing Sessions; returns the next cursor or None."""
+    sessions, next_cursor, more = Session.query().fetch_page(
+        BACKFILL_BATCH_SIZE, start_cursor=cursor)
+    by_speaker = {}
+    for ses in sessions:
+        by_speaker.setdefault(speakerKey(ses.speakerEmail), []).append(ses)
+    for sp_key, speaker_sessions in by_speaker.items():
+        ndb.transaction(lambda: indexSessions(sp_key, speaker_sessions))
+    return next_cursor if more else None
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+"""textsearch.py
+
+Full-text search over Conferences and Sessions with a local inverted
+index.  Every indexed entity has a SearchDocument child holding its
+weighted terms; every term has NUM_POSTING_SHARDS PostingShard entities
+mapping document keys to term weights.  Documents are spread over the
+shards by a hash of their key, so concurrent indexing of different
+documents rarely touches the same entity and no posting list outgrows
+the entity size limit.
+
+Indexing runs in a task after an entity is written.  A document is
+rewritten transactionally and the posting shards then copy its weights,
+so concurrent indexing of one entity leaves the shards with its newest
+terms.  Queries read the shards of their terms and rank the matches by
+TF-IDF.
+
+"""
+
+import hashlib
+import heapq
+import math
+import re
+import zlib
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import PostingShard
+from models import SearchCorpus
+from models import SearchDocument
+from models import Session
+
+NUM_POSTING_SHARDS = 16
+BACKFILL_BATCH_SIZE = 100
+INDEX_TASK_SIZE = 100
+# documents read by one posting shard transaction, within the limit of 25
+# entity groups per cross-group transaction
+XG_DOCUMENTS = 24
+MAX_QUERY_TERMS = 8
+# only this many of the best matches are ranked and paged through
+MAX_RESULTS = 1000
+MEMCACHE_SEARCH_KEY = 'SEARCH:%s'
+# ranked results are reused for paging for at most this many seconds
+SEARCH_CACHE_TIME = 60
+
+# indexed fields per kind, with the weight of a term found in each
+FIELDS = {
+    'Conference': (('name', 3), ('topics', 2), ('description', 1)),
+    'Session': (('name', 3), ('highlights', 1)),
+}
+MODELS = {'Conference': Conference, 'Session': Session}
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+STOPWORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in',
+    'is', 'it', 'of', 'on', 'or', 'that', 'the', 'this', 'to', 'with'))
+
+
+def tokenize(text):
+    """Return the searchable terms of a piece of text, in order."""
+    return [token for token in TOKEN_RE.findall((text or '').lower())
+            if len(token) > 1 and token not in STOPWORDS]
+
+
+def documentTerms(entity):
+    """Return {term: weight} for the indexed fields of a Conference or Session."""
+    terms = {}
+    for field, weight in FIELDS[entity.key.kind()]:
+        value = getattr(entity, field, None)
+        if isinstance(value, list):
+            value = ' '.join(value)
+        for term in tokenize(value):
+            terms[term] = terms.get(term, 0) + weight
+    return terms
+
+
+def postingShard(doc_id):
+    """Return the posting shard number of a websafe document key."""
+    return (zlib.crc32(doc_id) & 0xffffffff) % NUM_POSTING_SHARDS
+
+
+def postingKey(kind, term, shard):
+    return ndb.Key(PostingShard, '%s:%s:%d' % (kind, term, shard))
+
+
+def _documentKey(doc_key):
+    return ndb.Key(SearchDocument, 1, parent=doc_key)
+
+
+def _corpusKey(kind):
+    return ndb.Key(SearchCorpus, kind)
+
+
+# - - - Indexing - - - - - - - - - - - - - - - - - - - - - - -
+
+def enqueue(keys):
+    """Schedule indexing of the given Conference or Session keys."""
+    wskeys = [key.urlsafe() for key in keys]
+    tasks = [taskqueue.Task(params={'websafeKey': wskeys[i:i + INDEX_TASK_SIZE]},
+                            url='/tasks/index_documents')
+             for i in range(0, len(wskeys), INDEX_TASK_SIZE)]
+    queue = taskqueue.Queue()
+    for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+        queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+
+
+@ndb.transactional_tasklet()
+def _documentTxn(key):
+    """Bring an entity's SearchDocument in line with the entity.
+
+    The terms whose weight changed are added to the document's pending
+    terms, whose posting shards still have to be updated.  Returns
+    (version, pending terms, change in document count), or None when
+    the document is up to date and nothing is pending.
+    """
+    d_key = _documentKey(key)
+    entity, document = yield ndb.get_multi_async([key, d_key])
+    live = bool(document) and not document.removed
+    old = document.terms if live else {}
+    new = documentTerms(entity) if entity else {}
+    changed = set(term for term in set(old) | set(new) if old.get(term) != new.get(term))
+    if not document:
+        if not entity:
+            raise ndb.Return(None)
+        document = SearchDocument(key=d_key)
+    if changed or live != bool(entity):
+        document.terms = new
+        document.removed = not entity
+        document.pending = sorted(changed.union(document.pending or []))
+        document.version += 1
+        yield document.put_async()
+    if not document.pending:
+        raise ndb.Return(None)
+    raise ndb.Return((document.version, document.pending,
+                      bool(entity) - live))
+
+
+@ndb.transactional_tasklet(xg=True)
+def _applyPostingsTxn(p_key, term, keys):
+    """Copy term's weight in each entity's SearchDocument into one posting
+    shard, removing the entities whose document lacks the term."""
+    results = yield ndb.get_multi_async([p_key] + [_documentKey(key) for key in keys])
+    shard, documents = results[0], results[1:]
+    postings = dict(shard.postings or {}) if shard else {}
+    for key, document in zip(keys, documents):
+        weight = document.terms.get(term) if document else None
+        if weight is None:
+            postings.pop(key.urlsafe(), None)
+        else:
+            postings[key.urlsafe()] = weight
+    if postings:
+        yield PostingShard(key=p_key, postings=postings).put_async()
+    elif shard:
+        yield p_key.delete_async()
+
+
+@ndb.transactional_tasklet()
+def _settleDocumentTxn(key, version):
+    """Clear the pending terms of a SearchDocument whose postings were
+    updated, unless it changed again meanwhile."""
+    document = yield _documentKey(key).get_async()
+    if not document or document.version != version:
+        return
+    if document.removed:
+        yield document.key.delete_async()
+    else:
+        document.pending = []
+        yield document.put_async()
+
+
+@ndb.transactional()
+def _countDocumentsTxn(kind, delta):
+    corpus = _corpusKey(kind).get() or SearchCorpus(key=_corpusKey(kind))
+    corpus.docCount = max(corpus.docCount + delta, 0)
+    corpus.put()
+
+
+def indexEntities(keys):
+    """Bring the index in line with the current state of the given entities.
+
+    Each SearchDocument is compared with its entity and rewritten in a
+    transaction, which also records the terms that changed as pending.
+    Posting shards then take the weights of those terms from the
+    documents, in transactions that read the documents too, so whichever
+    of two concurrent runs writes a shard last writes the newest
+    weights.  A document's pending terms are only cleared once its
+    shards are written, so a task retried after failing part way
+    finishes the job, and running it twice is harmless.
+    """
+    keys = list(set(keys))
+    results = [future.get_result() for future in [_documentTxn(key) for key in keys]]
+
+    changes, settled, counts = {}, [], {}
+    for key, result in zip(keys, results):
+        if not result:
+            continue
+        version, pending, delta = result
+        shard = postingShard(key.urlsafe())
+        for term in pending:
+            changes.setdefault((postingKey(key.kind(), term, shard), term), []).append(key)
+        settled.append((key, version))
+        if delta:
+            counts[key.kind()] = counts.get(key.kind(), 0) + delta
+
+    # one small transaction per posting shard, all in flight together; a
+    # transaction reads the shard and at most XG_DOCUMENTS documents
+    ndb.Future.wait_all([
+        _applyPostingsTxn(p_key, term, d_keys[i:i + XG_DOCUMENTS])
+        for (p_key, term), d_keys in changes.items()
+        for i in range(0, len(d_keys), XG_DOCUMENTS)])
+    ndb.Future.wait_all([_settleDocumentTxn(key, version) for key, version in settled])
+    for kind, delta in counts.items():
+        _countDocumentsTxn(kind, delta)
+
+
+def backfill(kind, cursor=None):
+    """Index one batch of existing entities; returns the next cursor or None."""
+    keys, next_cursor, more = MODELS[kind].query().fetch_page(
+        BACKFILL_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+    indexEntities(keys)
+    return next_cursor if more else None
+
+
+# - - - Queries - - - - - - - - - - - - - - - - - - - - - - - -
+
+def rank(posting_lists, doc_count, limit=MAX_RESULTS, accept=None):
+    """Rank documents for a query by TF-IDF.
+
+    posting_lists maps each query term to its {document: weight} postings.
+    Returns the best `limit` documents (only those `accept` returns True
+    for, if given), best first; ties are broken by key so the order is
+    stable across pages.
+    """
+    scores = {}
+    for postings in posting_lists.values():
+        if not postings:
+            continue
+        # document frequency comes from the whole corpus, even when filtering
+        idf = math.log(1.0 + float(max(doc_count, len(postings))) / len(postings))
+        for doc_id, weight in postings.items():
+            scores[doc_id] = scores.get(doc_id, 0.0) + (1.0 + math.log(weight)) * idf
+    if accept:
+        scores = dict((doc_id, score) for doc_id, score in scores.items()
+                      if accept(doc_id))
+    return heapq.nsmallest(limit, scores, key=lambda doc_id: (-scores[doc_id], doc_id))
+
+
+def search(kind, query, ancestor=None):
+    """Return the websafe keys of the kind's entities matching query, best first.
+
+    The ranking of a query is cached briefly so that fetching the next
+    pages does not read the posting lists again.
+    """
+    terms = sorted(set(tokenize(query)))[:MAX_QUERY_TERMS]
+    if not terms:
+        return []
+    cache_key = MEMCACHE_SEARCH_KEY % hashlib.md5(repr(
+        (kind, terms, ancestor and ancestor.urlsafe()))).hexdigest()
+    ranked = memcache.get(cache_key)
+    if ranked is not None:
+        return ranked
+
+    p_keys = [postingKey(kind, term, shard)
+              for term in terms for shard in range(NUM_POSTING_SHARDS)]
+    shards = ndb.get_multi(p_keys + [_corpusKey(kind)])
+    corpus = shards.pop()
+    posting_lists = dict((term, {}) for term in terms)
+    for p_key, shard in zip(p_keys, shards):
+        if shard:
+            posting_lists[p_key.id().split(':')[1]].update(shard.postings)
+
+    accept = None
+    if ancestor:
+        accept = lambda doc_id: ndb.Key(urlsafe=doc_id).parent() == ancestor
+    ranked = rank(posting_lists, corpus.docCount if corpus else 0, accept=accept)
+    memcache.set(cache_key, ranked, time=SEARCH_CACHE_TIME)
+    return ranked
@@ -1,10 +1,152 @@
+import collections
+import hashlib
 import json
 import os
+import random
+import threading
 import time
 import uuid
 
+from google.appengine.api import memcache
 from google.appengine.api import urlfetch
 from models import Profile
+from models import ServiceUnavailableException
+from settings import TOKENINFO_STUB
+
+TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
+MEMCACHE_TOKENINFO_KEY = 'TOKENINFO:%s'
+# cached token info never outlives the token, nor this many seconds
+TOKENINFO_MAX_CACHE_TIME = 60 * 60
+# a rejected token is remembered in the instance for this many seconds
+TOKENINFO_INVALID_CACHE_TIME = 30
+TOKENINFO_LRU_SIZE = 1000
+TOKENINFO_DEADLINE = 2.0
+# after the endpoint failed to answer for a token, lookups of it fail fast
+# for this long; each further failure doubles it, with jitter, up to the max
+TOKENINFO_BACKOFF = 0.5
+TOKENINFO_MAX_BACKOFF = 30
+
+
+class _TokenInfoLRU(object):
+    """In-instance LRU of token info in front of memcache."""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] <= time.time():
+                return None
+            self.entries[key] = entry
+            return entry[1]
+
+    def set(self, key, info, ttl):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + ttl, info)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+_tokeninfo_lru = _TokenInfoLRU(TOKENINFO_LRU_SIZE)
+# (retry after, failures) of tokens whose last lookup got no answer
+_tokeninfo_retries = _TokenInfoLRU(TOKENINFO_LRU_SIZE)
+
+
+def _stubTokenInfo(token):
+    """Offline tokeninfo: 'stub:<user_id>[:<expires_in>]' tokens are valid."""
+    parts = token.split(':')
+    if parts[0] != 'stub' or len(parts) < 2:
+        return {}
+    return {'user_id': parts[1],
+            'expires_in': int(parts[2]) if len(parts) > 2 else 3600}
+
+
+def _tokenInfoRpc(token, token_type):
+    """Start an asynchronous fetch of a token's info; returns the RPC."""
+    rpc = urlfetch.create_rpc(deadline=TOKENINFO_DEADLINE)
+    urlfetch.make_fetch_call(rpc, TOKENINFO_URL % (token_type, token))
+    return rpc
+
+
+def _fetchTokenInfo(token, token_type):
+    """Ask the tokeninfo endpoint about a token.
+
+    Returns (info, definite): info is {} for a rejected token, and
+    definite is False when the endpoint gave no answer (timeouts, 5xx).
+    Nothing waits to retry; a failed lookup is retried by a later call,
+    once its backoff (see getTokenInfo) is over.
+    """
+    if TOKENINFO_STUB:
+        return _stubTokenInfo(token), True
+    rpc = _tokenInfoRpc(token, token_type)
+    while True:
+        try:
+            resp = rpc.get_result()
+        except urlfetch.Error:
+            return {}, False
+        if resp.status_code == 200:
+            return json.loads(resp.content), True
+        if not 400 <= resp.status_code < 500:
+            return {}, False
+        # an id_token the endpoint does not know may be an access token
+        if 'invalid_token' in resp.content and token_type == 'id_token':
+            token_type = 'access_token'
+            rpc = _tokenInfoRpc(token, token_type)
+            continue
+        return {}, True
+
+
+def _retryDelay(failures):
+    """Return the jittered backoff after a token's nth failed lookup."""
+    return min(TOKENINFO_BACKOFF * 2 ** (failures - 1),
+               TOKENINFO_MAX_BACKOFF) * random.uniform(0.5, 1.5)
+
+
+def getTokenInfo(token, token_type):
+    """Return the tokeninfo of an OAuth token, cached until it expires.
+
+    A token the endpoint rejected is remembered briefly; a lookup that
+    failed for lack of an answer is not remembered.  Instead the token
+    backs off: until a jittered, growing delay has passed, lookups of it
+    raise ServiceUnavailableException telling the client when to retry,
+    without waiting on the endpoint.
+    """
+    key = hashlib.sha256(token).hexdigest()
+    info = _tokeninfo_lru.get(key)
+    if info is not None:
+        return info
+    cached = memcache.get(MEMCACHE_TOKENINFO_KEY % key)
+    if cached is not None:
+        info, expires = cached
+        if expires > time.time():
+            _tokeninfo_lru.set(key, info, expires - time.time())
+            return info
+
+    retry_at, failures = _tokeninfo_retries.get(key) or (0, 0)
+    if retry_at > time.time():
+        raise ServiceUnavailableException(
+            'Token verification unavailable, retry in %.1f seconds'
+            % (retry_at - time.time()))
+    info, definite = _fetchTokenInfo(token, token_type)
+    if not definite:
+        delay = _retryDelay(failures + 1)
+        _tokeninfo_retries.set(key, (time.time() + delay, failures + 1),
+                               2 * TOKENINFO_MAX_BACKOFF)
+        raise ServiceUnavailableException(
+            'Token verification unavailable, retry in %.1f seconds' % delay)
+    if not info.get('user_id'):
+        _tokeninfo_lru.set(key, info, TOKENINFO_INVALID_CACHE_TIME)
+        return info
+    ttl = min(int(info.get('expires_in', 0)) or TOKENINFO_MAX_CACHE_TIME,
+              TOKENINFO_MAX_CACHE_TIME)
+    memcache.set(MEMCACHE_TOKENINFO_KEY % key, (info, time.time() + ttl), time=ttl)
+    _tokeninfo_lru.set(key, info, ttl)
+    return info
+
 
 def getUserId(user, id_type="email"):
     if id_type == "email":
@@ -17,22 +159,7 @@ def getUserId(user, id_type="email"):
         token_type = 'id_token'
         if 'OAUTH_USER_ID' in os.environ:
             token_type = 'access_token'
-        url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-               % (token_type, token))
-        user = {}
-        wait = 1
-        for i in range(3):
-            resp = urlfetch.fetch(url)
-            if resp.status_code == 200:
-                user = json.loads(resp.content)
-                break
-            elif resp.status_code == 400 and 'invalid_token' in resp.content:
-                url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-                       % ('access_token', token))
-            else:
-                time.sleep(wait)
-                wait = wait + i
-        return user.get('user_id', '')
+        return getTokenInfo(token, token_type).get('user_id', '')
 
     if id_type == "custom":
         # implement your own user_id creation and getting algorythm